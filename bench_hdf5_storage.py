@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""
+Benchmark the HDF5 storage profiles of saveMusicArrayToHDF5() (see
+hdf5_api.STORAGE_PROFILES) on a fully processed synthetic event.
+
+A synthetic radar day with a known MSTID (see mstid.synthetic) is run
+through run_music() to the music level. The saved event is then written and
+read back with each storage profile, and the median write time, read time
+and file size are reported, along with the time to read one beam of the
+original data cube with a lazy, selective load (see loadMusicArrayFromHDF5())
+and the stored size of the original data cube and the spectrum.
+
+Usage: ./bench_hdf5_storage.py [small|medium|large] [n_runs] [output_dir]
+"""
+import os
+import sys
+import time
+import shutil
+import datetime
+import matplotlib
+matplotlib.use('Agg')
+
+import h5py
+import numpy as np
+
+from mstid import more_music, synthetic
+from hdf5_api import saveMusicArrayToHDF5, loadMusicArrayFromHDF5, closeMusicArrayHDF5, STORAGE_PROFILES
+
+# Synthetic data sizes: beams and range gates.
+sizes = {}
+sizes['small']  = {'n_beams':16,'n_gates':50}
+sizes['medium'] = {'n_beams':24,'n_gates':75}
+sizes['large']  = {'n_beams':24,'n_gates':110}
+
+radar       = 'bks'
+sTime       = datetime.datetime(2017,11,3,12)
+eTime       = datetime.datetime(2017,11,3,14)
+
+run_params  = {}
+run_params['gate_limits']       = (0,80)
+run_params['interp_resolution'] = 60.
+run_params['filter_numtaps']    = 101.
+run_params['make_plots']        = False
+run_params['db_name']           = None
+run_params['rti_engine']        = 'mstid'
+run_params['music_engine']      = 'mstid'
+
+size        = sys.argv[1] if len(sys.argv) > 1 else 'small'
+n_runs      = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+output_dir  = sys.argv[3] if len(sys.argv) > 3 else os.path.join('output','bench')
+bench_dir   = os.path.join(output_dir,'bench_hdf5_{!s}'.format(size))
+if os.path.exists(bench_dir):
+    shutil.rmtree(bench_dir)
+os.makedirs(bench_dir)
+
+# Process one event to the music level. ############################################
+pad_s       = run_params['filter_numtaps']*run_params['interp_resolution']/2.
+srcPath     = os.path.join(bench_dir,'synthetic_{!s}.h5'.format(radar))
+synthetic.save_synthetic_music_obj(srcPath,radar,
+        sTime-datetime.timedelta(seconds=pad_s+600.),eTime+datetime.timedelta(seconds=pad_s+600.),
+        n_beams=sizes[size]['n_beams'],n_gates=sizes[size]['n_gates'])
+
+data_path   = os.path.join(bench_dir,'music')
+more_music.run_music(radar,sTime,eTime,data_path=data_path,srcPath=srcPath,**run_params)
+hdf5_path   = more_music.get_hdf5_name(radar,sTime,eTime,data_path=data_path,getPath=True)
+dataObj     = more_music.load_saved_dataObj(hdf5_path)
+
+def stored_mb(fl,name):
+    if name not in fl:
+        return np.nan
+    return fl[name].id.get_storage_size()/1024.**2
+
+# Write and read back with each profile. ###########################################
+print()
+print('HDF5 storage benchmark: {!s} ({!s} beams, {!s} gates), median of {!s} runs'.format(size,
+    sizes[size]['n_beams'],sizes[size]['n_gates'],n_runs))
+print('{:8s} {:>10s} {:>10s} {:>10s} {:>10s} {:>8s} {:>14s} {:>14s}'.format('profile','write [s]','read [s]',
+    'beam [s]','size [MB]','ratio','DS000 [MB]','spectrum [MB]'))
+
+base_size   = None
+for storage in STORAGE_PROFILES:
+    path        = os.path.join(bench_dir,'storage_{!s}.h5'.format(storage))
+    write_times = []
+    read_times  = []
+    beam_times  = []
+    for run in range(n_runs):
+        t0  = time.perf_counter()
+        saveMusicArrayToHDF5(dataObj,path,storage=storage)
+        write_times.append(time.perf_counter() - t0)
+
+        t0  = time.perf_counter()
+        loaded  = loadMusicArrayFromHDF5(path)
+        read_times.append(time.perf_counter() - t0)
+
+        t0  = time.perf_counter()
+        lazy    = loadMusicArrayFromHDF5(path,datasets=['DS000_originalFit'],lazy=True)
+        beam    = lazy.DS000_originalFit.readSlice('data',(slice(None),0))
+        closeMusicArrayHDF5(lazy)
+        beam_times.append(time.perf_counter() - t0)
+
+    for name in ['DS000_originalFit','active']:
+        orig    = getattr(dataObj,name).data
+        back    = getattr(loaded,name).data
+        if not np.array_equal(orig,back,equal_nan=True):
+            raise RuntimeError('{!s}: {!s}.data changed in the round trip'.format(storage,name))
+    if not np.array_equal(dataObj.DS000_originalFit.data[:,0],beam,equal_nan=True):
+        raise RuntimeError('{!s}: lazy beam read differs from the data'.format(storage))
+
+    size_mb     = os.path.getsize(path)/1024.**2
+    if base_size is None:
+        base_size = size_mb
+    with h5py.File(path,'r') as fl:
+        ds000_mb    = stored_mb(fl,'DS000_originalFit/data')
+        spect_mb    = stored_mb(fl,'active/spectrum')
+
+    print('{:8s} {:10.3f} {:10.3f} {:10.3f} {:10.2f} {:8.2f} {:14.2f} {:14.2f}'.format(storage,
+        np.median(write_times),np.median(read_times),np.median(beam_times),size_mb,base_size/size_mb,ds000_mb,spect_mb))
+
+sys.exit()
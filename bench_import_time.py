@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""
+Benchmark how long the mstid package takes to import and check that the
+lightweight entry points do not pull in the heavy dependencies.
+
+Each import is timed in a fresh Python process. The script exits with a
+non-zero status if one of the checked imports loads a forbidden module or
+takes longer than its time budget, so it can be run as a regression check.
+
+Usage: ./bench_import_time.py [n_runs]
+"""
+import os
+import sys
+import json
+import subprocess
+
+import numpy as np
+
+# Modules that only the processing and plotting code should need.
+heavy_modules   = ['matplotlib','pandas','scipy','pydarn','pyDARNmusic','cartopy','h5py']
+
+# (statement, modules it must not load, time budget [s])
+checks = []
+checks.append(('import mstid',                          heavy_modules,  0.5))
+checks.append(('from mstid import general_lib',         heavy_modules,  0.5))
+checks.append(('from mstid import mongo_tools',         heavy_modules,  1.0))
+checks.append(('from mstid import worker_pool',         heavy_modules,  0.5))
+checks.append(('from mstid import run_helper',          [],             None))
+checks.append(('from mstid import more_music',          [],             None))
+checks.append(('import mstid; mstid.calendar_plot',     [],             None))
+
+n_runs  = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+code_tmpl = """
+import sys, time, json
+t0 = time.perf_counter()
+{stmt}
+dt = time.perf_counter() - t0
+print(json.dumps({{'seconds':dt,'modules':sorted(sys.modules.keys())}}))
+"""
+
+this_dir    = os.path.dirname(os.path.abspath(__file__))
+failures    = []
+print('{:40s} {:>10s} {:>10s} {:>10s}'.format('import','median [s]','max [s]','budget [s]'))
+for stmt,forbidden,budget in checks:
+    times   = []
+    for run in range(n_runs):
+        out     = subprocess.check_output([sys.executable,'-c',code_tmpl.format(stmt=stmt)],cwd=this_dir)
+        result  = json.loads(out.decode('utf-8').strip().splitlines()[-1])
+        times.append(result['seconds'])
+
+    loaded  = [mod for mod in forbidden if mod in result['modules']]
+    median  = np.median(times)
+    print('{:40s} {:10.3f} {:10.3f} {:>10s}'.format(stmt,median,np.max(times),
+        '-' if budget is None else '{:.2f}'.format(budget)))
+
+    if len(loaded) > 0:
+        failures.append('{!s}: loads {!s}'.format(stmt,', '.join(loaded)))
+    if budget is not None and median > budget:
+        failures.append('{!s}: {:.3f} s is over the {:.2f} s budget'.format(stmt,median,budget))
+
+if len(failures) > 0:
+    print()
+    print('FAILED:')
+    for failure in failures:
+        print('    '+failure)
+    sys.exit(1)
+
+sys.exit()
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+"""
+Benchmark the MSTID/MUSIC processing on synthetic data so that changes to
+the pipeline can be compared without fitacf files or a MongoDB server.
+
+A synthetic radar day with a known MSTID (see mstid.synthetic) is saved to
+HDF5 and used as the srcPath of run_music(). The events are run to each
+ProcessLevel with stage instrumentation using the 'mstid' RTI engine, and to
+the rti_interp level with each RTI engine (see more_music.RTI_ENGINES). Then the HDF5 save/load round
+trip and the spectral classification of the events are timed. The strongest
+signal detected in each event is printed next to the injected wave, for
+the run_music() output and for each MUSIC engine (see
+more_music.MUSIC_ENGINES) run on the fft level output.
+
+Usage: ./bench_music_pipeline.py [small|medium|large] [output_dir]
+
+The stage report is printed and written to <output_dir>/bench_<size>.txt.
+"""
+import os
+import sys
+import shutil
+import datetime
+import matplotlib
+matplotlib.use('Agg')
+
+import numpy as np
+import pandas as pd
+
+import pyDARNmusic
+import mstid
+from mstid import more_music, classify, synthetic
+from mstid.stage_timer import StageTimer, load_stage_timing, stage_report
+from hdf5_api import saveMusicArrayToHDF5, closeMusicArrayHDF5
+
+# Synthetic data sizes: beams, range gates, and number of 2-hour events.
+sizes = {}
+sizes['small']  = {'n_beams':16,'n_gates':50,'n_events':2}
+sizes['medium'] = {'n_beams':24,'n_gates':75,'n_events':4}
+sizes['large']  = {'n_beams':24,'n_gates':110,'n_events':8}
+
+radar           = 'bks'
+sDate           = datetime.datetime(2017,11,3,12)
+event_hours     = 2
+process_levels  = ['rti_interp','fft','music']
+
+# MSTID injected into the synthetic data.
+waves           = [{'wavelength_km':300.,'azimuth_deg':135.,'period_min':40.,'amplitude_db':6.}]
+
+run_params  = {}
+run_params['boxcar_filter']     = True
+run_params['rti_engine']        = 'mstid'
+run_params['gate_limits']       = (0,80)
+run_params['interp_resolution'] = 60.
+run_params['filter_numtaps']    = 101.
+run_params['make_plots']        = False
+run_params['db_name']           = None
+run_params['instrument']        = 'file'
+
+size        = sys.argv[1] if len(sys.argv) > 1 else 'small'
+output_dir  = sys.argv[2] if len(sys.argv) > 2 else os.path.join('output','bench')
+bench_dir   = os.path.join(output_dir,'bench_{!s}'.format(size))
+if os.path.exists(bench_dir):
+    shutil.rmtree(bench_dir)
+os.makedirs(bench_dir)
+
+n_events    = sizes[size]['n_events']
+events      = []
+for event_inx in range(n_events):
+    sTime   = sDate + datetime.timedelta(hours=event_inx*event_hours)
+    eTime   = sTime + datetime.timedelta(hours=event_hours)
+    events.append((sTime,eTime))
+
+# Cover the filter padding of the first and last events.
+pad_s       = run_params['filter_numtaps']*run_params['interp_resolution']/2.
+syn_sTime   = events[0][0]  - datetime.timedelta(seconds=pad_s+600.)
+syn_eTime   = events[-1][1] + datetime.timedelta(seconds=pad_s+600.)
+
+timer       = StageTimer()
+timer.start('synthetic_generate')
+srcPath     = os.path.join(bench_dir,'synthetic_{!s}.h5'.format(radar))
+synthetic.save_synthetic_music_obj(srcPath,radar,syn_sTime,syn_eTime,
+        n_beams=sizes[size]['n_beams'],n_gates=sizes[size]['n_gates'],waves=waves)
+timer.stop()
+
+# Run every event to each ProcessLevel. ############################################
+records     = []
+for process_level in process_levels:
+    data_path   = os.path.join(bench_dir,process_level)
+    for sTime,eTime in events:
+        more_music.run_music(radar,sTime,eTime,process_level=process_level,
+                data_path=data_path,srcPath=srcPath,**run_params)
+
+    for rec in load_stage_timing(data_path):
+        rec['stage'] = '{!s}:{!s}'.format(process_level,rec['stage'])
+        records.append(rec)
+
+# Run the rti_interp level with each RTI engine (see more_music.RTI_ENGINES). ######
+# Releases of pyDARNmusic without boxcarFilter() are compared without the boxcar.
+engine_params   = dict(run_params)
+if not hasattr(pyDARNmusic,'boxcarFilter'):
+    print('pyDARNmusic has no boxcarFilter(); comparing the RTI engines without the boxcar filter.')
+    engine_params['boxcar_filter'] = False
+for engine in more_music.RTI_ENGINES:
+    data_path   = os.path.join(bench_dir,'rti_engine_{!s}'.format(engine))
+    engine_params['rti_engine'] = engine
+    for sTime,eTime in events:
+        more_music.run_music(radar,sTime,eTime,process_level='rti_interp',
+                data_path=data_path,srcPath=srcPath,**engine_params)
+
+    for rec in load_stage_timing(data_path):
+        rec['stage'] = 'rti_engine:{!s}:{!s}'.format(engine,rec['stage'])
+        records.append(rec)
+
+# HDF5 round trip of a fully processed event. ######################################
+data_path   = os.path.join(bench_dir,process_levels[-1])
+sTime,eTime = events[0]
+hdf5_path   = more_music.get_hdf5_name(radar,sTime,eTime,data_path=data_path,getPath=True)
+rt_path     = os.path.join(bench_dir,'roundtrip.h5')
+
+timer.start('hdf5_load')
+dataObj     = more_music.load_saved_dataObj(hdf5_path)
+timer.start('hdf5_save')
+saveMusicArrayToHDF5(dataObj,rt_path)
+timer.stop()
+del dataObj
+
+# Classification of the events, as in classify.load_data_dict(). ##################
+timer.start('classify_load')
+data_path   = os.path.join(bench_dir,'fft')
+data_dict   = {'unclassified':{'color':'blue'},'mstid':{'color':'red'},'quiet':{'color':'green'}}
+data_dict['categs']     = ['unclassified']
+data_dict['mstid_list'] = 'bench_{!s}'.format(size)
+data_dict['data_path']  = data_path
+
+spect       = {}
+rti_info    = {}
+radar_times = {}
+for event_inx,(sTime,eTime) in enumerate(events):
+    dataObj = more_music.get_dataObj(radar,sTime,eTime,data_path=data_path,
+            datasets=['DS000_originalFit','active'],lazy=True)
+    if dataObj is None:
+        continue
+    try:
+        if not hasattr(dataObj.active,'spectrum'):
+            continue
+        rti_info[event_inx]     = more_music.get_orig_rti_info(dataObj,sTime,eTime)
+        spec                    = np.abs(dataObj.active.spectrum)
+        spec                    = np.nansum(np.nansum(spec,axis=2),axis=1)
+        spect[event_inx]        = pd.Series(spec,dataObj.active.freqVec)
+    finally:
+        closeMusicArrayHDF5(dataObj)
+    radar_times[event_inx]  = (radar,sTime,eTime)
+
+data_dict['unclassified']['spect_df']           = pd.DataFrame(spect)
+data_dict['unclassified']['orig_rti_info']      = pd.DataFrame.from_dict(rti_info,orient='index')
+data_dict['unclassified']['radar_sTime_eTime']  = radar_times
+
+timer.start('classify')
+data_dict['all_spect_df']   = classify.create_all_spect_df(data_dict)
+data_dict   = classify.sort_by_spectrum(data_dict,'meanSubIntSpect_by_rtiCnt')
+data_dict   = classify.classify_mstid_events(data_dict,read_only=True)
+timer.stop()
+
+# Run both MUSIC engines on the fft level events. #################################
+engine_sigs = {}
+for engine in more_music.MUSIC_ENGINES:
+    engine_sigs[engine] = []
+    for sTime,eTime in events:
+        hdf5_path   = more_music.get_hdf5_name(radar,sTime,eTime,data_path=data_path,getPath=True)
+        dataObj     = more_music.load_saved_dataObj(hdf5_path)
+        if dataObj is None or not hasattr(dataObj.active,'spectrum'):
+            continue
+        timer.start('music_engine:{!s}'.format(engine))
+        if engine == 'mstid':
+            more_music.calculate_dlm(dataObj)
+            more_music.calculate_karr(dataObj)
+            more_music.detect_signals(dataObj)
+        else:
+            pyDARNmusic.calculateDlm(dataObj)
+            pyDARNmusic.calculateKarr(dataObj)
+            pyDARNmusic.detectSignals(dataObj)
+        timer.stop()
+        dataObj.active.sigDetect.reorder()
+        engine_sigs[engine].append((sTime,dataObj.active.sigDetect.info[:1]))
+
+records    += timer.records
+
+# Compare the strongest detected signal with the injected wave. ###################
+data_path   = os.path.join(bench_dir,'music')
+print()
+print('Injected: lambda={wavelength_km:.0f} km azm={azimuth_deg:.0f} deg period={period_min:.0f} min'.format(**waves[0]))
+for sTime,eTime in events:
+    dataObj = more_music.get_dataObj(radar,sTime,eTime,data_path=data_path)
+    sigs    = getattr(getattr(dataObj,'active',None),'sigDetect',None)
+    if sigs is None or len(sigs.info) == 0:
+        print('{!s}: no signals detected'.format(sTime))
+        continue
+    sig     = sigs.info[0]
+    print('{!s}: lambda={:.0f} km azm={:.0f} deg period={:.0f} min'.format(sTime,
+        sig['lambda'],sig['azm'],sig['period']/60.))
+
+for engine,sigs in engine_sigs.items():
+    for sTime,info in sigs:
+        if len(info) == 0:
+            print('{!s} {!s}: no signals detected'.format(engine,sTime))
+            continue
+        print('{!s} {!s}: lambda={:.0f} km azm={:.0f} deg'.format(engine,sTime,
+            info[0]['lambda'],info[0]['azm']))
+
+print()
+print('MUSIC pipeline benchmark: {!s} ({!s} beams, {!s} gates, {!s} events)'.format(size,
+    sizes[size]['n_beams'],sizes[size]['n_gates'],n_events))
+stage_report(records,output_file=os.path.join(output_dir,'bench_{!s}.txt'.format(size)))
+
+sys.exit()
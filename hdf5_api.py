@@ -10,6 +10,22 @@ from pyDARNmusic.music.music_array import musicArray
 from pyDARNmusic.music.music_data_object import musicDataObj
 from pyDARNmusic.music.signals_detected import SigDetect
 
+# Storage profiles for the large numeric datasets (see createArrayDataset()).
+#   none: contiguous and uncompressed.
+#   lzf:  chunked, LZF compression (fast, moderate compression).
+#   gzip: chunked, shuffle filter and gzip compression (slower, smallest files).
+STORAGE_PROFILES = {
+    'none': {},
+    'lzf':  {'compression': 'lzf'},
+    'gzip': {'compression': 'gzip', 'compression_opts': 4, 'shuffle': True},
+}
+
+# Arrays smaller than this are always stored contiguous and uncompressed.
+MIN_STORAGE_BYTES = 16 * 1024
+
+# Target size of a chunk of a chunked dataset.
+CHUNK_BYTES = 256 * 1024
+
 def formatData(obj):
     """
     Recursively format objects to their needed types for HDF5 storage.
@@ -33,9 +49,37 @@ def formatData(obj):
     else:
         return str(obj)
 
-def saveDictToHDF5(hdf5Group, dictionary):
+def getChunkShape(shape, itemsize, chunkBytes=CHUNK_BYTES):
+    """
+    Chunk shape aligned to slices along the first (time) axis: each chunk
+    holds whole slices of the other axes, as many as fit in chunkBytes (at
+    least one). 1D arrays are cut into runs of about chunkBytes.
+    """
+    if len(shape) == 1:
+        return (max(1, min(shape[0], chunkBytes // itemsize)),)
+    sliceBytes = itemsize * int(np.prod(shape[1:]))
+    nrSlices = max(1, min(shape[0], chunkBytes // max(1, sliceBytes)))
+    return (nrSlices,) + tuple(shape[1:])
+
+def createArrayDataset(hdf5Group, key, values, storage='none'):
+    """
+    Create a dataset from a numeric numpy array using a storage profile from
+    STORAGE_PROFILES. Arrays smaller than MIN_STORAGE_BYTES, scalars, and
+    non-numeric arrays are stored as with storage='none'.
     """
-    Save the contents of a dictionary to an HDF5 group.
+    if storage not in STORAGE_PROFILES:
+        raise ValueError(f"Unknown storage profile: {storage}")
+    options = STORAGE_PROFILES[storage]
+    if (not options or values.ndim == 0 or values.size == 0 or values.nbytes < MIN_STORAGE_BYTES
+            or values.dtype.kind not in {'b', 'i', 'u', 'f', 'c'}):
+        return hdf5Group.create_dataset(key, data=values)
+    chunks = getChunkShape(values.shape, values.dtype.itemsize)
+    return hdf5Group.create_dataset(key, data=values, chunks=chunks, **options)
+
+def saveDictToHDF5(hdf5Group, dictionary, storage='none'):
+    """
+    Save the contents of a dictionary to an HDF5 group. Large numeric arrays
+    are stored with the given storage profile (see STORAGE_PROFILES).
     """
     for key, values in dictionary.items():
         try:
@@ -90,11 +134,11 @@ def saveDictToHDF5(hdf5Group, dictionary):
                         hdf5Group.create_dataset(key, data=np.array(values))
                     # Save numpy N-dimensional arrays directly within a dataset.
                     elif isinstance(values, np.ndarray):
-                        hdf5Group.create_dataset(key, data=values)
+                        createArrayDataset(hdf5Group, key, values, storage)
                     # Save dictionaries as a subgroup and save their contents.
                     elif isinstance(values, dict):
                         subGroup = hdf5Group.create_group(key)
-                        saveDictToHDF5(subGroup, values)
+                        saveDictToHDF5(subGroup, values, storage)
                     # Save scalars directly within a dataset (or as a numpy string if the values are strings).
                     elif isinstance(values, (int, float, str)):
                         hdf5Group.create_dataset(key, data=np.bytes_(values) if isinstance(values, str) else values)
@@ -110,7 +154,7 @@ def saveDictToHDF5(hdf5Group, dictionary):
             elif isinstance(values, dict):
                 subGroup = hdf5Group.create_group(key)
                 formattedValues = formatData(values)
-                saveDictToHDF5(subGroup, formattedValues)
+                saveDictToHDF5(subGroup, formattedValues, storage)
             # Save lists consisting entirely of ints/np ints or floats/np floats as datasets composed of a numpy array 
             # of those values, and saves generic lists as datasets composed of numpy arrays of formatted values. 
             elif isinstance(values, list):
@@ -128,7 +172,7 @@ def saveDictToHDF5(hdf5Group, dictionary):
                         formattedValues = np.array([formatData(item) for item in values], dtype='S')
                         hdf5Group.create_dataset(key, data=formattedValues)
                 else:
-                    hdf5Group.create_dataset(key, data=values)
+                    createArrayDataset(hdf5Group, key, values, storage)
             # Saves bools, ints, and floats directly within datasets.
             elif isinstance(values, (bool, int, float)):
                 hdf5Group.create_dataset(key, data=values)
@@ -139,9 +183,11 @@ def saveDictToHDF5(hdf5Group, dictionary):
         except Exception as e:
             print(f"Could not save {key} in {hdf5Group.name}: {e}")
 
-def saveMusicArrayToHDF5(musicArrayObj, filename):
+def saveMusicArrayToHDF5(musicArrayObj, filename, storage='none'):
     """
     Save the contents of a musicArray object ('DS###_*', 'active', 'prm' and 'messages' attributes) to HDF5.
+    The data cubes, spectra and other large numeric arrays are stored with the given storage profile
+    (see STORAGE_PROFILES). 'active' is stored as a link to the 'DS###_*' group it points to.
     """
     with h5py.File(filename, 'w') as hdf5File:
         for attributeName in dir(musicArrayObj):
@@ -152,67 +198,185 @@ def saveMusicArrayToHDF5(musicArrayObj, filename):
             # Create an HDF5 group for dict attributes (prm) and save its contents.
             if isinstance(attributeValue, dict):
                 group = hdf5File.create_group(attributeName)
-                saveDictToHDF5(group, attributeValue)
+                saveDictToHDF5(group, attributeValue, storage)
             # Store list attributes (messages) as numpy arrays of strings.
             elif isinstance(attributeValue, list):
                 hdf5File.create_dataset(attributeName, data=np.array(attributeValue, dtype='S'))
             # Create individual HDF5 groups for 'DS' and 'active' attributes and save their __dict__'s.
             elif attributeName.startswith('DS') or attributeName.startswith('active'):
+                # dir() lists the 'DS###_*' attributes before 'active', so the group 'active'
+                # points to has already been saved.
+                if attributeName == 'active':
+                    dsNames = [name for name in dir(musicArrayObj)
+                               if name.startswith('DS') and getattr(musicArrayObj, name) is attributeValue]
+                    if dsNames and dsNames[0] in hdf5File:
+                        hdf5File['active'] = h5py.SoftLink('/' + dsNames[0])
+                        continue
+                # Read the attributes of lazily loaded data sets that have not been read yet.
+                if isinstance(attributeValue, LazyMusicDataObj):
+                    attributeValue.loadAll()
                 dsGroup = hdf5File.create_group(attributeName)
-                saveDictToHDF5(dsGroup, attributeValue.__dict__)
+                saveDictToHDF5(dsGroup, attributeValue.__dict__, storage)
+
+class LazyMusicDataObj(musicDataObj):
+    """
+    musicDataObj that reads each of its attributes from an open HDF5 group the first time it is accessed
+    (see loadMusicArrayFromHDF5(lazy=True)). Attributes that have been read are kept like those of a
+    musicDataObj.
+    """
+    def __init__(self, hdf5Items, parent=0):
+        musicDataObj.__init__(self, time=None, data=None, parent=parent)
+        # Drop the defaults set by musicDataObj so that the stored values are read instead.
+        for key in hdf5Items:
+            self.__dict__.pop(key, None)
+        self._hdf5Items = hdf5Items
+
+    def __getattr__(self, name):
+        # Only called for attributes that are not in __dict__, i.e. not read yet.
+        hdf5Items = self.__dict__.get('_hdf5Items', {})
+        if name not in hdf5Items:
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+        value = loadDataObjItemFromHDF5(name, hdf5Items[name])
+        self.__dict__[name] = value
+        return value
+
+    def __delattr__(self, name):
+        hdf5Items = self.__dict__.get('_hdf5Items', {})
+        if name in hdf5Items:
+            # Copies made with copy.copy() share the dict of unread items, so replace rather than modify it.
+            self._hdf5Items = {key: item for key, item in hdf5Items.items() if key != name}
+            if name not in self.__dict__:
+                return
+        musicDataObj.__delattr__(self, name)
+
+    def readSlice(self, name, index):
+        """
+        Read index (integers and slices) of the array attribute name. If the attribute has not been
+        read yet, only the selection is read from the file.
+        """
+        item = self.__dict__.get('_hdf5Items', {}).get(name)
+        if (name in self.__dict__ or not isinstance(item, h5py.Dataset)
+                or item.dtype.kind not in {'b', 'i', 'u', 'f', 'c'}):
+            return np.asarray(getattr(self, name))[index]
+        return item[index]
+
+    def loadAll(self):
+        """
+        Read every attribute that has not been read yet and detach from the HDF5 file.
+        """
+        for name in self.__dict__.get('_hdf5Items', {}):
+            if name not in self.__dict__:
+                getattr(self, name)
+        self.__dict__.pop('_hdf5Items', None)
+
+def loadDataObjItemFromHDF5(key, hdf5Item):
+    """
+    Read one musicDataObj attribute from its HDF5 group or dataset.
+    """
+    if key == "sigDetect":
+        return loadSigDetectFromHDF5(hdf5Item)
+    return extractDataFromHDF5(hdf5Item)
 
-def loadMusicArrayFromHDF5(hdf5FilePath):
+def loadMusicArrayFromHDF5(hdf5FilePath, datasets=None, fields=None, lazy=False):
     """
     Reconstruct a musicArray object from an HDF5 file.
+
+    datasets: Names of the 'DS###_*' and 'active' data sets to load, e.g. ['DS000_originalFit', 'active'].
+              All data sets are loaded if None.
+    fields:   Names of the musicDataObj attributes to load from each data set, e.g. ['time', 'fov', 'data'].
+              All attributes are loaded if None.
+    lazy:     Keep the file open and read each musicDataObj attribute the first time it is accessed
+              (see LazyMusicDataObj). The file is closed with closeMusicArrayHDF5(), and cannot be
+              overwritten while it is open.
     """
-    with h5py.File(hdf5FilePath, 'r') as hdf5File:
-        # Extract metadata from first level of processing.
-        try:
-            metadata = hdf5File['DS000_originalFit/metadata']
-        except KeyError:
-            # The file does not have metadata, i.e. "No data for this time period" in messages dataset.
-            return None
-            
-        sTime         = metadata['sTime']
-        eTime         = metadata['eTime']
-        param         = metadata['param']
-        gscat         = metadata['gscat']
-        fovModel      = metadata['model']
-        fovElevation  = metadata['elevation']
-        fovCoords     = metadata['coords']
-        channel       = metadata['channel']
-        file_type     = metadata['fType']
+    hdf5File = h5py.File(hdf5FilePath, 'r')
+    try:
+        reconstructedMusicArray = readMusicArrayFromHDF5(hdf5File, datasets, fields, lazy)
+    except Exception:
+        hdf5File.close()
+        raise
 
-        reconstructedMusicArray = musicArray(
-            fitacf=None,
-            sTime=sTime,
-            eTime=eTime,
-            param=param,
-            gscat=gscat,
-            fovElevation=fovElevation,
-            fovModel=fovModel,
-            fovCoords=fovCoords,
-            channel=channel,
-            file_type=file_type
-        )
+    # A lazy musicArray keeps the file open until closeMusicArrayHDF5().
+    if lazy and reconstructedMusicArray is not None:
+        reconstructedMusicArray._hdf5File = hdf5File
+    else:
+        hdf5File.close()
+    return reconstructedMusicArray
 
-        # Iterate over hdf5 file's 'DS' and 'active' keys, extract their data, and save the data to the 
-        # newly reconstructed musicArray as a new musicDataObj. Otherwise, save the data to the newly 
-        # reconstructed musicArray directly.
-        for key in hdf5File.keys():
-            if key.startswith("DS") or key.startswith("active"):
-                dsGroup = hdf5File[key]
-                newMusicDataObj = musicDataObj(time=None, data=None, parent=reconstructedMusicArray)
-                for subkey in dsGroup.keys():
-                    if subkey == "sigDetect":
-                        newMusicDataObj.sigDetect = loadSigDetectFromHDF5(dsGroup[subkey])
-                    else:
-                        newMusicDataObj.__dict__[subkey] = extractDataFromHDF5(dsGroup[subkey])
-                setattr(reconstructedMusicArray, key, newMusicDataObj)
+def readMusicArrayFromHDF5(hdf5File, datasets=None, fields=None, lazy=False):
+    """
+    Reconstruct a musicArray object from an open HDF5 file (see loadMusicArrayFromHDF5()).
+    """
+    # Extract metadata from first level of processing.
+    try:
+        metadata = hdf5File['DS000_originalFit/metadata']
+    except KeyError:
+        # The file does not have metadata, i.e. "No data for this time period" in messages dataset.
+        return None
+
+    sTime         = metadata['sTime']
+    eTime         = metadata['eTime']
+    param         = metadata['param']
+    gscat         = metadata['gscat']
+    fovModel      = metadata['model']
+    fovElevation  = metadata['elevation']
+    fovCoords     = metadata['coords']
+    channel       = metadata['channel']
+    file_type     = metadata['fType']
+
+    reconstructedMusicArray = musicArray(
+        fitacf=None,
+        sTime=sTime,
+        eTime=eTime,
+        param=param,
+        gscat=gscat,
+        fovElevation=fovElevation,
+        fovModel=fovModel,
+        fovCoords=fovCoords,
+        channel=channel,
+        file_type=file_type
+    )
+
+    # Iterate over hdf5 file's 'DS' and 'active' keys, extract their data, and save the data to the
+    # newly reconstructed musicArray as a new musicDataObj. Otherwise, save the data to the newly
+    # reconstructed musicArray directly. The 'DS' keys come first, so that an 'active' link to a
+    # loaded data set reuses its musicDataObj.
+    loadedDataSets = {}
+    for key in sorted(hdf5File.keys(), key=lambda name: name.startswith("active")):
+        if key.startswith("DS") or key.startswith("active"):
+            if datasets is not None and key not in datasets:
+                continue
+            link = hdf5File.get(key, getlink=True)
+            if isinstance(link, h5py.SoftLink) and link.path.lstrip('/') in loadedDataSets:
+                setattr(reconstructedMusicArray, key, loadedDataSets[link.path.lstrip('/')])
+                continue
+            dsGroup = hdf5File[key]
+            subkeys = [subkey for subkey in dsGroup.keys() if fields is None or subkey in fields]
+            if lazy:
+                newMusicDataObj = LazyMusicDataObj({subkey: dsGroup[subkey] for subkey in subkeys},
+                                                   parent=reconstructedMusicArray)
             else:
-                setattr(reconstructedMusicArray, key, extractDataFromHDF5(hdf5File[key]))
+                newMusicDataObj = musicDataObj(time=None, data=None, parent=reconstructedMusicArray)
+                for subkey in subkeys:
+                    newMusicDataObj.__dict__[subkey] = loadDataObjItemFromHDF5(subkey, dsGroup[subkey])
+            loadedDataSets[key] = newMusicDataObj
+            setattr(reconstructedMusicArray, key, newMusicDataObj)
+        else:
+            setattr(reconstructedMusicArray, key, extractDataFromHDF5(hdf5File[key]))
     return reconstructedMusicArray
 
+def closeMusicArrayHDF5(musicArrayObj):
+    """
+    Close the HDF5 file of a musicArray loaded with lazy=True. Attributes that have not been read
+    yet are no longer available; call loadAll() on a data set first to keep all of them.
+    """
+    for value in vars(musicArrayObj).values():
+        if isinstance(value, LazyMusicDataObj):
+            value.__dict__.pop('_hdf5Items', None)
+    hdf5File = vars(musicArrayObj).pop('_hdf5File', None)
+    if hdf5File is not None:
+        hdf5File.close()
+
 def convertToUnicode(data):
     """
     If inputted data is a UTF-8 encoded byte string, convert to Unicode.
@@ -1,14 +1,48 @@
 from . import general_lib
 from .general_lib import prepare_output_dirs
 
-from . import run_helper
+# The rest of the package pulls in matplotlib, pandas, pydarn and
+# pyDARNmusic, so it is imported the first time it is used. For example,
+# mstid.run_music imports mstid.more_music on first access.
+_lazy_modules = ['run_helper','worker_pool','work_queue','pipeline','render_queue',
+        'stage_timer','synthetic','fov_cache','mongo_tools','classify','more_music','drivers',
+        'polar_met','music_support','musicRTI3','stats_support']
 
-from .mongo_tools import events_from_mongo, generate_mongo_list, \
-        updateDb_mstid_list, createTunnel
-from . import classify
-
-from .more_music import run_music, generate_initial_param_file, run_music_init_param_file
-from . import calendar_plot as calendar_plot_lib
-from .calendar_plot import calendar_plot,calendar_plot_with_polar_data, \
-    calculate_reduced_mstid_index,calendar_plot_vortex_movie_strip
+_lazy_attrs = {}
+_lazy_attrs['calendar_plot_lib']                    = ('calendar_plot',None)
+_lazy_attrs['events_from_mongo']                    = ('mongo_tools','events_from_mongo')
+_lazy_attrs['generate_mongo_list']                  = ('mongo_tools','generate_mongo_list')
+_lazy_attrs['updateDb_mstid_list']                  = ('mongo_tools','updateDb_mstid_list')
+_lazy_attrs['createTunnel']                         = ('mongo_tools','createTunnel')
+_lazy_attrs['run_music']                            = ('more_music','run_music')
+_lazy_attrs['generate_initial_param_file']          = ('more_music','generate_initial_param_file')
+_lazy_attrs['run_music_init_param_file']            = ('more_music','run_music_init_param_file')
+_lazy_attrs['calendar_plot']                        = ('calendar_plot','calendar_plot')
+_lazy_attrs['calendar_plot_with_polar_data']        = ('calendar_plot','calendar_plot_with_polar_data')
+_lazy_attrs['calculate_reduced_mstid_index']        = ('calendar_plot','calculate_reduced_mstid_index')
+_lazy_attrs['calendar_plot_vortex_movie_strip']     = ('calendar_plot','calendar_plot_vortex_movie_strip')
 #from calendar_plot_vert import calendar_plot as calendar_plot_vert
+
+def __getattr__(name):
+    import importlib
+    if name in _lazy_attrs:
+        module_name, attr = _lazy_attrs[name]
+    elif name in _lazy_modules:
+        module_name, attr = name, None
+    else:
+        raise AttributeError('module {!r} has no attribute {!r}'.format(__name__,name))
+
+    module  = importlib.import_module('.'+module_name,__name__)
+
+    # Importing a submodule binds it as an attribute of the package, which
+    # hides a function of the same name (calendar_plot).
+    for key,(mod,att) in _lazy_attrs.items():
+        if mod == module_name and att is not None and globals().get(key) is module:
+            globals()[key] = getattr(module,att)
+
+    value   = module if attr is None else getattr(module,attr)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(list(globals().keys()) + _lazy_modules + list(_lazy_attrs.keys()))
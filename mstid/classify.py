@@ -38,7 +38,7 @@ import pymongo
 from .general_lib import prepare_output_dirs
 from . import more_music
 from .more_music import get_output_path
-from hdf5_api import loadMusicArrayFromHDF5, saveMusicArrayToHDF5
+from hdf5_api import loadMusicArrayFromHDF5, saveMusicArrayToHDF5, closeMusicArrayHDF5
 
 def mstid_classification(radar,list_sDate,list_eDate,mstid_list,
         sort_key='meanSubIntSpect_by_rtiCnt',
@@ -542,22 +542,27 @@ def load_data_dict(mstid_list,data_path,use_cache=True,cache_dir='data',read_onl
                 fDatetime   = item['fDatetime']
 
                 print(("MSTID Classification: Loading dataObj ({!s}/{!s}): {!s} {!s}-{!s}".format(item_inx,count,radar,sDatetime,fDatetime)))
-                dataObj = more_music.get_dataObj(radar,sDatetime,fDatetime,data_path=data_path)
+                # Only the original data and the spectrum are needed; read them on access.
+                dataObj = more_music.get_dataObj(radar,sDatetime,fDatetime,data_path=data_path,
+                        datasets=['DS000_originalFit','active'],lazy=True)
 
                 if dataObj is None:
                     continue
 
-                if not hasattr(dataObj.active,'spectrum'):
-                    continue
+                try:
+                    if not hasattr(dataObj.active,'spectrum'):
+                        continue
 
-                # Get basic statistics on dataObj.DS000_originalFit data using the ranges of dataObj.active.
-                orig_rti_info   = more_music.get_orig_rti_info(dataObj,sDatetime,fDatetime)
+                    # Get basic statistics on dataObj.DS000_originalFit data using the ranges of dataObj.active.
+                    orig_rti_info   = more_music.get_orig_rti_info(dataObj,sDatetime,fDatetime)
 
-                # Reduce spectrum by integrating over beam and gate leaving it only a function of frequency.
-                fvec        = dataObj.active.freqVec
-                spec        = np.abs(dataObj.active.spectrum)
-                spec        = np.nansum(spec,axis=2)
-                spec        = np.nansum(spec,axis=1)
+                    # Reduce spectrum by integrating over beam and gate leaving it only a function of frequency.
+                    fvec        = dataObj.active.freqVec
+                    spec        = np.abs(dataObj.active.spectrum)
+                    spec        = np.nansum(spec,axis=2)
+                    spec        = np.nansum(spec,axis=1)
+                finally:
+                    closeMusicArrayHDF5(dataObj)
                 
                 # Put the reduced spectrum into a pandas series object.
                 series      = pd.Series(spec,fvec)
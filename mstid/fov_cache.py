@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+"""
+On-disk cache of radar field-of-view geometry.
+
+musicArray() computes the beam and gate corner positions of a radar from
+its hardware information every time it is created from fitacf data. They
+only depend on the radar hardware, the range separation, the first range,
+the number of range gates, the scatter mapping model and the coordinate
+system, so they are kept in one small .npz file per geometry key and read
+back instead of recomputed:
+
+    with fov_cache.cached_fov(cache_dir):
+        dataObj = music.musicArray(fitacf,fovModel='GS')
+
+create_music_obj() and load_music_day() do this unless fov_cache_dir is None.
+The hardware information is part of the key, so a change to the hardware
+file starts a new cache entry.
+"""
+import os
+import hashlib
+import threading
+import contextlib
+
+import numpy as np
+
+from pydarn import Coords, SuperDARNRadars, RangeEstimation
+from pyDARNmusic.music import music_array
+
+FOV_CACHE_DIR = os.path.join('music_data','fov_cache')
+
+# Corner arrays already read in this process.
+_fov_mem    = {}
+
+# Held while cached_fov() has replaced music_array.Coords.
+_coords_lock = threading.RLock()
+
+def get_range_estimation(fovModel='GS'):
+    """
+    The pydarn RangeEstimation musicArray() uses for a scatter mapping model.
+    """
+    if fovModel == 'GS':
+        return RangeEstimation.GSMR
+    elif fovModel == 'HALF_SLANT':
+        return RangeEstimation.HALF_SLANT
+    else:
+        return RangeEstimation.SLANT_RANGE
+
+def get_fov_key(rad_enum,rsep,frang,nrang,fovModel='GS',coords='geo'):
+    """
+    Returns the cache key of a FOV geometry, e.g.
+    'bks_rsep45_frang180_nrang75_GS_geo_1a2b3c4d5e'. The last part is a
+    hash of the radar's hardware information.
+    """
+    hdw         = SuperDARNRadars.radars[rad_enum].hardware_info
+    hdw_hash    = hashlib.sha1(repr(hdw).encode('utf-8')).hexdigest()[:10]
+    key = '{!s}_rsep{:g}_frang{:g}_nrang{:d}_{!s}_{!s}_{!s}'.format(hdw.abbrev,
+            float(rsep),float(frang),int(nrang),fovModel,coords,hdw_hash)
+    return key
+
+def compute_fov_corners(rad_enum,rsep,frang,nrang,fovModel='GS'):
+    """
+    Beam and gate corner latitudes and longitudes, as returned by
+    pydarn.Coords.GEOGRAPHIC() for gates (0, nrang).
+    """
+    lats, lons = Coords.GEOGRAPHIC(rad_enum,rsep=rsep,frang=frang,gates=[0,nrang],
+            range_estimation=get_range_estimation(fovModel))
+    return lats, lons
+
+def get_fov_corners(rad_enum,rsep,frang,nrang,fovModel='GS',coords='geo',cache_dir=FOV_CACHE_DIR):
+    """
+    compute_fov_corners() through the in-memory and on-disk caches. Returns
+    read-only (lats, lons) arrays. With cache_dir None, only the in-memory
+    cache is used.
+    """
+    key     = get_fov_key(rad_enum,rsep,frang,nrang,fovModel,coords)
+    corners = _fov_mem.get(key)
+    if corners is not None:
+        return corners
+
+    path    = None
+    if cache_dir is not None:
+        path    = os.path.join(cache_dir,key+'.npz')
+
+    if path is not None and os.path.exists(path):
+        try:
+            with np.load(path) as npz:
+                corners = (npz['lats'],npz['lons'])
+        except Exception as err:
+            print('Cannot read FOV cache file {!s}: {!s}'.format(path,err))
+
+    if corners is None:
+        corners = compute_fov_corners(rad_enum,rsep,frang,nrang,fovModel)
+
+    if path is not None and not os.path.exists(path):
+        # Write to a temporary file first so parallel workers never read a
+        # partial file.
+        os.makedirs(cache_dir,exist_ok=True)
+        tmp_path = '{!s}.{:d}.tmp'.format(path,os.getpid())
+        with open(tmp_path,'wb') as fl:
+            np.savez(fl,lats=corners[0],lons=corners[1])
+        os.replace(tmp_path,path)
+
+    for arr in corners:
+        arr.flags.writeable = False
+    _fov_mem[key] = corners
+    return corners
+
+class CachedCoords(object):
+    """
+    Stand-in for pydarn.Coords inside musicArray() that serves the
+    GEOGRAPHIC corners from get_fov_corners().
+    """
+    def __init__(self,cache_dir=FOV_CACHE_DIR,fovModel='GS'):
+        self.cache_dir  = cache_dir
+        self.fovModel   = fovModel
+
+    def GEOGRAPHIC(self,rad_enum,rsep,frang,gates,date=None,range_estimation=None):
+        lats, lons = get_fov_corners(rad_enum,rsep,frang,gates[1],self.fovModel,
+                'geo',cache_dir=self.cache_dir)
+        # musicArray() pads the arrays it is given.
+        return lats.copy(), lons.copy()
+
+    def __getattr__(self,name):
+        return getattr(Coords,name)
+
+@contextlib.contextmanager
+def cached_fov(cache_dir=FOV_CACHE_DIR,fovModel='GS'):
+    """
+    Context manager under which musicArray() gets its FOV corners from the
+    cache. fovModel must be the one passed to musicArray().
+
+    This replaces the process-wide music_array.Coords. A module lock makes
+    cached_fov() blocks in different threads run one at a time, but nothing
+    protects a musicArray() created in another thread without cached_fov(),
+    so do not use it while other threads may create musicArray objects.
+    """
+    with _coords_lock:
+        orig_coords         = music_array.Coords
+        music_array.Coords  = CachedCoords(cache_dir,fovModel)
+        try:
+            yield
+        finally:
+            music_array.Coords  = orig_coords
+
+def clear_fov_cache(cache_dir=FOV_CACHE_DIR):
+    """
+    Forget the FOV corners already read and delete the cached files in
+    cache_dir.
+    """
+    _fov_mem.clear()
+    if cache_dir is None or not os.path.isdir(cache_dir):
+        return
+    for fname in os.listdir(cache_dir):
+        if fname.endswith('.npz'):
+            os.remove(os.path.join(cache_dir,fname))
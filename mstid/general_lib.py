@@ -1,14 +1,18 @@
 import os
+import sys
 import shutil
+import logging
+import contextlib
 
 import collections
 
 import numpy as np
-import matplotlib
 
-import pydarn
+# matplotlib and pydarn are slow to import, so they are imported by the
+# functions that use them.
 
 def truncate_colormap(cmap, minval=0.0, maxval=1.0, n=None,name=None):
+    import matplotlib
     if n is None:
         n = cmap.N
 
@@ -22,6 +26,7 @@ def truncate_colormap(cmap, minval=0.0, maxval=1.0, n=None,name=None):
     return new_cmap
 
 def combine_cmaps(cmaps,minval=0.0,maxval=1.0,n=None,name='Combined CMAP'):
+    import matplotlib
     lsc             = matplotlib.colors.LinearSegmentedColormap
     new_list        = np.array([])
     new_list.shape  = (0,4)
@@ -39,6 +44,7 @@ def combine_cmaps(cmaps,minval=0.0,maxval=1.0,n=None,name='Combined CMAP'):
     return new_cmap
 
 def get_custom_cmap(name='blue_red'):
+    import matplotlib
     if name == 'blue_red':
         l_cut       = 0.30
         u_cut       = 0.0
@@ -65,6 +71,7 @@ def generate_radar_dict():
     the lat/lon of the SuperDARN transmitter location from the pyDARN
     hardware.dat files.
     """
+    import pydarn
 
     rads = pydarn.utils.superdarn_radars.SuperDARNRadars.radars
 
@@ -102,6 +109,59 @@ def generate_radar_dict():
 
     return radar_dict
 
+_radar_dict = None
+
+def get_radar_dict():
+    """
+    Returns the generate_radar_dict() dictionary, building it the first time
+    it is needed.
+    """
+    global _radar_dict
+    if _radar_dict is None:
+        _radar_dict = generate_radar_dict()
+    return _radar_dict
+
+def get_rss_mb():
+    """
+    Returns the current resident set size (RSS) of this process in megabytes.
+
+    /proc/self/statm is used when available. On systems without /proc, the
+    peak RSS reported by the resource module is returned instead.
+    """
+    try:
+        with open('/proc/self/statm','r') as fl:
+            rss_pages = int(fl.readline().split()[1])
+        return rss_pages * os.sysconf('SC_PAGE_SIZE') / 1024.**2
+    except (OSError, ValueError, IndexError):
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and kilobytes on Linux.
+        if sys.platform == 'darwin':
+            rss = rss / 1024.
+        return rss / 1024.
+
+def get_total_mem_mb():
+    """
+    Returns the physical memory of this host in megabytes.
+    """
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024.**2
+
+@contextlib.contextmanager
+def log_to_file(log_path,level=logging.WARN):
+    """
+    Context manager that also appends the root logger's records at level
+    and above to log_path. The file is only created if something is logged.
+    """
+    logger  = logging.getLogger()
+    handler = logging.FileHandler(log_path,mode='a',encoding='utf-8',delay=True)
+    handler.setLevel(level)
+    logger.addHandler(handler)
+    try:
+        yield
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
+
 def prepare_output_dirs(output_dirs={0:'output'},clear_output_dirs=False,img_extra=''):
     txt = []
     txt.append('<?php')
@@ -10,7 +10,6 @@ import time
 import sh
 
 import numpy as np
-import pandas as pd
 
 import ephem # pip install pyephem (on Python 2)
              # pip install ephem   (on Python 3)
@@ -18,14 +17,13 @@ import ephem # pip install pyephem (on Python 2)
 
 import pymongo
 
-import pydarn
-import pyDARNmusic
+from .general_lib import get_radar_dict
 
-from . import more_music
-from .general_lib import generate_radar_dict
-
-
-radar_dict  = generate_radar_dict()
+def __getattr__(name):
+    # radar_dict is built on first use rather than at import.
+    if name == 'radar_dict':
+        return get_radar_dict()
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__,name))
 
 class FakeTunnel(object):
     def kill(self):
@@ -96,9 +94,102 @@ def solartime(observer, sun=ephem.Sun()):
     # Note: ephem.hours is a float number that represents an angle in radians and converts to/from a string as "hh:mm:ss.ff".
     return ephem_slt/(2.*np.pi) * 24
 
+def get_event_key(record):
+    """
+    Return the fields that uniquely identify an event window in an MSTID list.
+    """
+    return {'radar':record['radar'],'sDatetime':record['sDatetime'],'fDatetime':record['fDatetime']}
+
+def report_duplicate_windows(coll,max_print=10):
+    """
+    Print the event windows that appear more than once in an MSTID list
+    collection and return them as a list of
+    ({'radar','sDatetime','fDatetime'}, count) tuples.
+    """
+    pipeline = [{'$group':{'_id':{'radar':'$radar','sDatetime':'$sDatetime','fDatetime':'$fDatetime'},
+                           'count':{'$sum':1}}},
+                {'$match':{'count':{'$gt':1}}},
+                {'$sort':{'_id.sDatetime':1}}]
+    dups = [(item['_id'],item['count']) for item in coll.aggregate(pipeline)]
+
+    print('{!s}: {:d} event windows appear more than once; the list has no unique index.'.format(
+        coll.name,len(dups)))
+    for key,count in dups[:max_print]:
+        print('    {!s} {!s} {!s}: {:d} copies'.format(key['radar'],key['sDatetime'],key['fDatetime'],count))
+    if len(dups) > max_print:
+        print('    ...')
+    return dups
+
+def ensure_event_index(coll):
+    """
+    Make sure an MSTID list collection has an index on (radar, sDatetime,
+    fDatetime) and return whether it is unique. An existing index on these
+    keys is kept as it is. A new index is unique unless the list already
+    holds duplicate windows (lists written before the index existed); these
+    are reported and the index is created non-unique.
+    """
+    keys = [('radar',pymongo.ASCENDING),('sDatetime',pymongo.ASCENDING),('fDatetime',pymongo.ASCENDING)]
+    # create_index() with different options than an existing index on the same
+    # keys fails, so a non-unique index from an earlier run is left alone.
+    for index in coll.index_information().values():
+        if list(index['key']) == keys:
+            return index.get('unique',False)
+
+    try:
+        coll.create_index(keys,unique=True)
+        return True
+    except pymongo.errors.DuplicateKeyError:
+        report_duplicate_windows(coll)
+        coll.create_index(keys)
+        return False
+
+def write_mongo_list(coll,records,incremental=False,skip_duplicates=True):
+    """
+    Write a list of event window records to an MSTID list collection in one
+    bulk operation.
+
+    incremental: If False, the records are inserted as-is (the caller is
+        expected to have dropped the collection). If True, each record is
+        upserted on (radar, sDatetime, fDatetime) with $setOnInsert, so windows
+        that already exist keep all of their computed fields and only missing
+        windows are added.
+    skip_duplicates: With incremental=False, records whose window is already
+        in the collection are not inserted. If False, every record is
+        inserted and the index is created afterwards (see
+        ensure_event_index()), which reports any duplicate windows.
+    """
+    if not incremental and not skip_duplicates:
+        n_inserted = 0
+        if len(records) > 0:
+            n_inserted = len(coll.insert_many(records).inserted_ids)
+        ensure_event_index(coll)
+        return n_inserted
+
+    ensure_event_index(coll)
+
+    if len(records) == 0:
+        return 0
+
+    if not incremental:
+        try:
+            result = coll.insert_many(records,ordered=False)
+            return len(result.inserted_ids)
+        except pymongo.errors.BulkWriteError as err:
+            # Duplicate windows are skipped, as the old find_one() check of
+            # generate_mongo_list() did.
+            write_errors = err.details.get('writeErrors',[])
+            if any([x.get('code') != 11000 for x in write_errors]):
+                raise
+            return err.details.get('nInserted')
+
+    requests = [pymongo.UpdateOne(get_event_key(record),{'$setOnInsert':record},upsert=True)
+                    for record in records]
+    result = coll.bulk_write(requests,ordered=False)
+    return result.upserted_count
+
 def generate_mongo_list_from_list(mstid_list,db_name,mongo_port,
         input_mstid_list,input_db_name,input_mongo_port,
-        category=None):
+        category=None,incremental=False):
     """
     Copy an existing MongoDB MSTID List into a new MSTID List, keeping only the following fields:
         'radar'
@@ -113,6 +204,10 @@ def generate_mongo_list_from_list(mstid_list,db_name,mongo_port,
         'gscat'
         'category_auto'
         'category_manu'
+
+    If incremental is True, the output list is not dropped first. Only events
+    that are missing from it are added; existing events and their computed
+    results are left alone.
     """
 
     #### Connect to output and input databases.
@@ -128,7 +223,8 @@ def generate_mongo_list_from_list(mstid_list,db_name,mongo_port,
         db.listTracker.insert_one({'name': mstid_list})
 
     #### Clean out the output database.
-    db[mstid_list].drop()
+    if not incremental:
+        db[mstid_list].drop()
 
     #### Identify which fields to keep.
     keep    = []
@@ -156,6 +252,7 @@ def generate_mongo_list_from_list(mstid_list,db_name,mongo_port,
         category = category.tolist()
 
     # Insert new entry into db.
+    records = []
     for item in crsr:
         if category is not None:
             # Allow for a list of categories.
@@ -184,13 +281,15 @@ def generate_mongo_list_from_list(mstid_list,db_name,mongo_port,
         record['intpsd_max']    = 'NaN'
         record['intpsd_mean']   = 'NaN'
 
-        db[mstid_list].insert_one(record)
+        records.append(record)
 
+    # Like the old insert_one() loop, copy every record, including duplicate windows.
+    write_mongo_list(db[mstid_list],records,incremental=incremental,skip_duplicates=False)
     mongo.close()
 
 def generate_mongo_list(mstid_list,radar,list_sDate,list_eDate,
         lat=None,lon=None,slt_range=(6,18),height=350.,timedelta=datetime.timedelta(hours=2),
-        db_name='mstid',mongo_port=27017,**kwargs):
+        db_name='mstid',mongo_port=27017,incremental=False,**kwargs):
     """
     Generates a MongoDB collection with one entry for every period being studied. A single
     collection is defined for a single radar and range of dates. While any name may be given
@@ -217,7 +316,8 @@ def generate_mongo_list(mstid_list,radar,list_sDate,list_eDate,
             'category_auto':    'None'          # Placeholder for MSTID classification
             'height_km':        height          # Height in kilometers used to calculate SLT and MLT.
 
-    WARNING: This function will delete and overwrite the MongoDB collection specified in mstid_list.
+    WARNING: Unless incremental=True, this function will delete and overwrite the MongoDB
+    collection specified in mstid_list.
 
     Arguments:
         mstid_list: <str> Name of MongoDB collection to be created. Existing collection will
@@ -235,9 +335,13 @@ def generate_mongo_list(mstid_list,radar,list_sDate,list_eDate,
         timedelta:  <datetime.timedelta(hours=2)> Duration of event.
         db_name:    <'mstid'> Name of MongoDB database to use.
         mongo_port: <27017> Port number to connect to MongoDB server.
+        incremental: <False> If True, do not drop the collection. Only event periods in
+            [list_sDate, list_eDate) that are not already in the collection are added, so
+            existing events keep their computed results. Use this to extend a list.
         **kwargs:   No kwargs used by this function. This is here to ignore any other keyword
             arguements passed to the function.
     """
+    import pydarn
 
     mongo   = pymongo.MongoClient(port=mongo_port)
     db      = mongo[db_name]
@@ -247,8 +351,16 @@ def generate_mongo_list(mstid_list,radar,list_sDate,list_eDate,
         db.listTracker.insert_one({'name': mstid_list})
 
     # WARNING!  Double check the next line before running this script! #############
-    db[mstid_list].drop()
+    existing = set()
+    if not incremental:
+        db[mstid_list].drop()
+    else:
+        crsr = db[mstid_list].find({'radar':radar,'sDatetime':{'$gte':list_sDate,'$lt':list_eDate}},
+                {'sDatetime':1,'fDatetime':1})
+        for item in crsr:
+            existing.add((item['sDatetime'],item['fDatetime']))
 
+    radar_dict  = get_radar_dict()
     if lat is None: lat = radar_dict[radar]['lat']
     if lon is None: lon = radar_dict[radar]['lon']
     
@@ -257,10 +369,15 @@ def generate_mongo_list(mstid_list,radar,list_sDate,list_eDate,
     o.lat       = np.radians(lat)
     o.elevation = height*1000. # pyEphem expects height in m.
     
+    records     = []
     currentDate = list_sDate
     while currentDate < list_eDate: 
         nextDate = currentDate + timedelta
 
+        if (currentDate,nextDate) in existing:
+            currentDate = nextDate
+            continue
+
         tm              = currentDate
         mlat, mlon, r   = pydarn.utils.coordinates.aacgmv2.convert_latlon(lat,lon,height,tm,'G2A')
         mlt             = (pydarn.utils.coordinates.aacgmv2.convert_mlt(mlon,tm))[0]
@@ -280,19 +397,38 @@ def generate_mongo_list(mstid_list,radar,list_sDate,list_eDate,
         intpsd_max  = 'NaN'
         intpsd_mean = 'NaN'
 
-        crsr = db[mstid_list].find_one({'date':currentDate, 'sDatetime': currentDate, 'fDatetime': nextDate, 'radar':radar})
-        if not crsr:
-            record= {'date':currentDate, 'sDatetime': currentDate, 'fDatetime': nextDate, 'radar':radar,
-                     'intpsd_sum': intpsd_sum, 'intpsd_max': intpsd_max, 'intpsd_mean': intpsd_mean,
-                     'lat': lat, 'lon': lon, 'slt': slt, 'mlt': mlt,'gscat': 1, 'category_auto':'None',
-                     'height_km': height}
-            db[mstid_list].insert_one(record)
+        record= {'date':currentDate, 'sDatetime': currentDate, 'fDatetime': nextDate, 'radar':radar,
+                 'intpsd_sum': intpsd_sum, 'intpsd_max': intpsd_max, 'intpsd_mean': intpsd_mean,
+                 'lat': lat, 'lon': lon, 'slt': slt, 'mlt': mlt,'gscat': 1, 'category_auto':'None',
+                 'height_km': height}
+        records.append(record)
 
         currentDate = nextDate
+
+    write_mongo_list(db[mstid_list],records,incremental=incremental)
+    mongo.close()
+
+def update_stage_timing(radar,sTime,eTime,records,
+        mstid_list,db_name='mstid',mongo_port=27017,**kwargs):
+    """
+    Save the stage timing records of a run_music() call (see
+    mstid.stage_timer) in the stage_timing field of the event's document.
+    """
+    if mstid_list is None:
+        return
+
+    mongo   = pymongo.MongoClient(port=mongo_port)
+    db      = mongo[db_name]
+
+    srch_dct    = {'radar':radar,'sDatetime':sTime,'fDatetime':eTime}
+    db[mstid_list].update_one(srch_dct,{'$set':{'stage_timing':records}})
     mongo.close()
 
 def dataObj_update_mongoDb(radar,sTime,eTime,dataObj,
         mstid_list,db_name='mstid',mongo_port=27017,**kwargs):
+    import pyDARNmusic
+    from . import more_music
+
     if mstid_list is None:
         return
 
@@ -385,6 +521,8 @@ def dataObj_update_mongoDb(radar,sTime,eTime,dataObj,
     return status
 
 def updateDb_mstid_list_event(event_tuple):
+    from . import more_music
+
     path   = os.path.split(inspect.getfile(inspect.currentframe()))[0]
 
     radar, sTime, eTime, data_path, mstid_list, db_name, mongo_port = event_tuple
@@ -406,16 +544,29 @@ def updateDb_mstid_list_event(event_tuple):
 #    print(' '.join(cmd))
 #    subprocess.check_call(cmd)
     
-    dataObj     = more_music.get_dataObj(radar,sTime,eTime,data_path)
+    from hdf5_api import closeMusicArrayHDF5
+    # Only the original data statistics, the terminator and the signals of
+    # the active data set are used; read them on access.
+    dataObj     = more_music.get_dataObj(radar,sTime,eTime,data_path,
+                    datasets=['DS000_originalFit','active'],lazy=True)
     if dataObj is None:
         print("No valid dataObj for {} {} - skipping update.".format(radar, sTime))
         return
-    status      = dataObj_update_mongoDb(radar,sTime,eTime,dataObj,mstid_list,
-                    db_name,mongo_port)
+    try:
+        status      = dataObj_update_mongoDb(radar,sTime,eTime,dataObj,mstid_list,
+                        db_name,mongo_port)
+    finally:
+        closeMusicArrayHDF5(dataObj)
 
 def updateDb_mstid_list(mstid_list,
         db_name='mstid',mongo_port=27017,data_path='music_data/music',
-        multiproc=True,nprocs=None,**kwargs):
+        multiproc=True,nprocs=None,pool=None,**kwargs):
+    """
+    Update the MongoDB MSTID list with the results of the MUSIC processing.
+
+    pool: Optional mstid.worker_pool.WorkerPool to run the updates in
+        instead of creating a new multiprocessing.Pool.
+    """
 
     print('updateDb_mstid_list')
     mongo   = pymongo.MongoClient(port=mongo_port)
@@ -431,7 +582,9 @@ def updateDb_mstid_list(mstid_list,
         tmp = (radar, sTime, eTime, data_path, mstid_list, db_name, mongo_port)
         event_list.append(tmp)
 
-    if multiproc:
+    if pool is not None:
+        pool.map(updateDb_mstid_list_event,event_list)
+    elif multiproc:
         pool = multiprocessing.Pool(nprocs)
         pool.map(updateDb_mstid_list_event,event_list)
         pool.close()
@@ -442,10 +595,149 @@ def updateDb_mstid_list(mstid_list,
 
     mongo.close()
 
+# (server address, database, collection) of the processing_state collections
+# whose index has already been created by this process.
+_process_state_indexed  = set()
+
+def get_process_state_collection(db,collection='processing_state'):
+    """
+    Return the MongoDB collection that records the completed processing level
+    of every event, making sure its unique index exists. The index is only
+    created on the first call for each server, database and collection.
+
+    Each document is keyed by (data_path, radar, sTime, eTime) and holds the
+    completed ProcessLevel name and rank, the run parameter hash, and
+    created/updated timestamps.
+    """
+    coll    = db[collection]
+    key     = (db.client.address,db.name,collection)
+    if key not in _process_state_indexed:
+        coll.create_index([('data_path',pymongo.ASCENDING),('radar',pymongo.ASCENDING),
+            ('sTime',pymongo.ASCENDING),('eTime',pymongo.ASCENDING)],unique=True)
+        _process_state_indexed.add(key)
+    return coll
+
+def update_process_state(level,radar,sTime,eTime,data_path='music_data/music',
+        param_hash=None,db_name='mstid',mongo_port=27017,**kwargs):
+    """
+    Atomically record the completed processing level of an event in the
+    processing_state collection.
+    """
+    from . import more_music
+    level   = more_music.ProcessLevel(str(level))
+    now     = datetime.datetime.now(datetime.timezone.utc)
+
+    mongo   = pymongo.MongoClient(port=mongo_port)
+    db      = mongo[db_name]
+    coll    = get_process_state_collection(db)
+
+    key     = {'data_path':os.path.normpath(data_path),'radar':radar,
+               'sTime':sTime,'eTime':eTime}
+    update  = {'$set':{'level':str(level),'rank':level.rank,
+                       'param_hash':param_hash,'updated':now},
+               '$setOnInsert':{'created':now}}
+    coll.update_one(key,update,upsert=True)
+    mongo.close()
+
+def clear_process_state(radar,sTime,eTime,data_path='music_data/music',
+        db_name='mstid',mongo_port=27017,**kwargs):
+    """
+    Delete the processing_state document of an event, e.g. when its output
+    directory is cleared for a fresh run.
+    """
+    mongo   = pymongo.MongoClient(port=mongo_port)
+    db      = mongo[db_name]
+    coll    = get_process_state_collection(db)
+
+    key     = {'data_path':os.path.normpath(data_path),'radar':radar,
+               'sTime':sTime,'eTime':eTime}
+    coll.delete_one(key)
+    mongo.close()
+
+def get_process_states(db,radar=None,sTime=None,eTime=None,data_path='music_data/music'):
+    """
+    Return a dictionary of processing_state documents keyed by
+    (radar, sTime, eTime) for all events in data_path matching the
+    optional radar and time range. This is a single indexed query.
+    """
+    coll    = get_process_state_collection(db)
+
+    query   = {'data_path':os.path.normpath(data_path)}
+    if radar is not None:
+        query['radar'] = {'$in':list(set(np.atleast_1d(radar).tolist()))}
+    if sTime is not None:
+        query['sTime'] = {'$gte':sTime}
+    if eTime is not None:
+        query['eTime'] = {'$lte':eTime}
+
+    states = {}
+    for item in coll.find(query):
+        states[(item['radar'],item['sTime'],item['eTime'])] = item
+    return states
+
+def backfill_process_state(mstid_list,db_name='mstid',mongo_port=27017,
+        data_path='music_data/music',**kwargs):
+    """
+    Fill the processing_state collection from the
+    processing_level_completed.txt files of an existing MSTID list. This is
+    only needed once for data processed before the collection existed;
+    events_from_mongo() also backfills missing events as it finds them.
+    """
+    from . import more_music
+    mongo   = pymongo.MongoClient(port=mongo_port)
+    db      = mongo[db_name]
+    coll    = get_process_state_collection(db)
+    crsr    = db[mstid_list].find()
+
+    requests = []
+    for item in crsr:
+        radar   = str(item['radar'])
+        sTime   = item['sDatetime']
+        eTime   = item['fDatetime']
+        level   = more_music.get_process_level(radar,sTime,eTime,data_path=data_path)
+        if level.rank == 0:
+            continue
+        requests.append(_process_state_backfill_request(level,radar,sTime,eTime,data_path))
+
+    if len(requests) > 0:
+        coll.bulk_write(requests,ordered=False)
+    mongo.close()
+    return len(requests)
+
+def _process_state_backfill_request(level,radar,sTime,eTime,data_path):
+    """
+    Upsert request that only creates a processing_state document; it never
+    overwrites a level written by mark_process_level().
+    """
+    now     = datetime.datetime.now(datetime.timezone.utc)
+    key     = {'data_path':os.path.normpath(data_path),'radar':radar,
+               'sTime':sTime,'eTime':eTime}
+    update  = {'$setOnInsert':{'level':str(level),'rank':level.rank,
+                       'param_hash':None,'created':now,'updated':now}}
+    return pymongo.UpdateOne(key,update,upsert=True)
+
 def events_from_mongo(mstid_list,list_sDate=None,list_eDate=None,months=None,
         category=None,process_level='music',recompute=False,
-        db_name='mstid',mongo_port=27017,**kwargs):
-    """Allow connection to mongo database."""
+        db_name='mstid',mongo_port=27017,check_param_hash=False,verify_files=False,**kwargs):
+    """
+    Allow connection to mongo database.
+
+    Unless recompute is set, events that have already been processed to
+    process_level are dropped. Completed levels are looked up in the
+    processing_state collection with one query; events not in the collection
+    fall back to their processing_level_completed.txt file and are added to
+    the collection. run_music() clears the state of an event when it clears
+    the event's output directory.
+
+    check_param_hash: Also treat an event as pending if it was processed
+        with different run parameters (see more_music.get_param_hash()).
+    verify_files: Also check the processing_level_completed.txt file of
+        every event with a recorded state. A state whose file no longer
+        exists (e.g. data_path was deleted or moved outside of run_music())
+        is removed from the collection and the event is run again. This
+        reads one file per event.
+    """
+    from . import more_music
 
     mongo   = pymongo.MongoClient(port=mongo_port)
     db      = mongo[db_name]
@@ -514,19 +806,53 @@ def events_from_mongo(mstid_list,list_sDate=None,list_eDate=None,months=None,
     if not recompute:
         # If we want to use what has already been computed, add events to a new
         # list if they need to be computed.  Then make that the actual event_list.
+        data_path   = kwargs.get('data_path','music_data/music')
+        states      = {}
+        if len(event_list) > 0:
+            radars  = [event['radar'] for event in event_list]
+            states  = get_process_states(db,radar=radars,
+                        sTime=event_list[0]['sTime'],
+                        eTime=max([event['eTime'] for event in event_list]),
+                        data_path=data_path)
+
         event_list_1 = []
+        backfill     = []
+        stale        = []
         for event in event_list:
-            completed_process_level = more_music.get_process_level(**event)
+            state = states.get((event['radar'],event['sTime'],event['eTime']))
+            if verify_files and state is not None and more_music.ProcessLevel(state['level']).rank > 0 \
+                    and more_music.get_process_level(**event).rank == 0:
+                # The output has been deleted or moved since the state was
+                # recorded; forget the state and run the event again.
+                stale.append(state['_id'])
+                state = None
+
+            if state is None:
+                completed_process_level = more_music.get_process_level(**event)
+                if completed_process_level.rank > 0:
+                    backfill.append(_process_state_backfill_request(completed_process_level,
+                        event['radar'],event['sTime'],event['eTime'],data_path))
+            else:
+                completed_process_level = more_music.ProcessLevel(state['level'])
+                if check_param_hash and state.get('param_hash') != more_music.get_param_hash(event):
+                    completed_process_level = more_music.ProcessLevel('None')
+
             if completed_process_level < process_level:
                 event_list_1.append(event)
             else:
                 print('events_from_mongo() - SKIPPING - {} {} {!s} {!s}'.format(mstid_list,event['radar'],event['sTime'],event['eTime']))
         event_list = event_list_1
 
+        if len(stale) > 0:
+            get_process_state_collection(db).delete_many({'_id':{'$in':stale}})
+        if len(backfill) > 0:
+            get_process_state_collection(db).bulk_write(backfill,ordered=False)
+
     mongo.close()
     return event_list
 
 def get_mstid_value(mongo_item,sig_key,lambda_max=750,azm_lim=None):
+    import pandas as pd
     signals = mongo_item.get('signals')
     if signals is None:
         return 
@@ -567,6 +893,7 @@ def get_mstid_scores(sDate=None,eDate=None,
         None  --> +0
 
     """
+    import pandas as pd
     from . import run_helper #Needs to be imported here to avoid infinite loop import.
 
     mongo   = pymongo.MongoClient(port=mongo_port)
@@ -1,18 +1,26 @@
 import os
 import sys
+import copy
+import collections
 import shutil
 import datetime
 import json
+import hashlib
+import inspect
+import traceback
 import h5py
-from hdf5_api import saveMusicArrayToHDF5, loadMusicArrayFromHDF5, saveDictToHDF5
+from hdf5_api import saveMusicArrayToHDF5, loadMusicArrayFromHDF5, saveDictToHDF5, STORAGE_PROFILES
 
 import matplotlib
 from matplotlib import pyplot as plt
 
 import numpy as np
 import scipy as sp
+import scipy.fft
+import scipy.linalg
 from scipy import signal
 from scipy import stats
+from scipy import ndimage
 
 import multiprocessing
 
@@ -23,7 +31,9 @@ import pyDARNmusic
 from pyDARNmusic import music
 
 from mstid import mongo_tools
-from .general_lib import prepare_output_dirs
+from . import fov_cache
+from .general_lib import prepare_output_dirs, log_to_file
+from .stage_timer import StageTimer, STAGE_TIMING_FILE
 
 class NumpyEncoder(json.JSONEncoder):
     """
@@ -194,15 +204,169 @@ def read_init_param_file(json_path):
 
     return init_params
 
-def get_dataObj(radar, sTime, eTime, data_path='music_data/music'):
+def get_dataObj(radar, sTime, eTime, data_path='music_data/music',
+        datasets=None, fields=None, lazy=False):
+    """
+    Load the saved musicArray of an event, or return None if there is none.
+
+    datasets, fields, lazy: Passed to hdf5_api.loadMusicArrayFromHDF5() to
+        load only some data sets/attributes, or to read attributes on first
+        access. Close a lazy dataObj with hdf5_api.closeMusicArrayHDF5().
+    """
     hdf5_path = get_hdf5_name(radar, sTime, eTime, data_path, getPath=True)
     if os.path.exists(hdf5_path):
-        dataObj = loadMusicArrayFromHDF5(hdf5_path)
+        dataObj = loadMusicArrayFromHDF5(hdf5_path,datasets=datasets,fields=fields,lazy=lazy)
     else:
         dataObj = None
 
     return dataObj
 
+def load_music_day(radar, sTime, eTime
+        ,interp_resolution  = None
+        ,filterNumtaps      = None
+        ,fitacf_dir         = '/sd-data'
+        ,fit_sfx            = 'fitacf'
+        ,fovModel           = 'GS'
+        ,gscat              = 1
+        ,fov_cache_dir      = fov_cache.FOV_CACHE_DIR
+        ):
+    """
+    Load fitacf data once for a long period (usually one radar-day covering
+    many observation windows) and build a single musicArray from it.
+    Individual windows can then be cut out with slice_music_obj() instead of
+    re-reading and re-decompressing the same fitacf files for every window.
+
+    sTime, eTime:   Start of the first and end of the last window. The FIR
+                    filter padding is added here, just as in create_music_obj().
+    fov_cache_dir:  Directory of the FOV geometry cache (see mstid.fov_cache),
+                    or None to compute the FOV from the hardware file.
+    """
+    if interp_resolution != None and filterNumtaps != None:
+        load_sTime,load_eTime = pyDARNmusic.filterTimes(sTime,eTime,interp_resolution,filterNumtaps)
+    else:
+        load_sTime,load_eTime = (sTime, eTime)
+
+    fitacf  = pyDARNmusic.load_fitacf(radar,load_sTime,load_eTime,data_dir=fitacf_dir,fit_sfx=fit_sfx)
+    dataObj = make_music_array(fitacf,fovModel=fovModel,gscat=gscat,fov_cache_dir=fov_cache_dir)
+    del fitacf
+
+    return dataObj
+
+def make_music_array(fitacf,fovModel='GS',gscat=1,fov_cache_dir=fov_cache.FOV_CACHE_DIR):
+    """
+    music.musicArray() of fitacf records, with the FOV corners taken from
+    the FOV geometry cache in fov_cache_dir. None computes them as usual.
+    """
+    if fov_cache_dir is None:
+        return music.musicArray(fitacf,fovModel=fovModel,gscat=gscat)
+
+    with fov_cache.cached_fov(fov_cache_dir,fovModel):
+        dataObj = music.musicArray(fitacf,fovModel=fovModel,gscat=gscat)
+    return dataObj
+
+def get_slice_extent(dataObj_day,sTime,eTime):
+    """
+    What slice_music_obj() cuts out of a load_music_day() musicArray for
+    the [sTime, eTime) period: (prm_inxs, time_tf, nrBeams, nrGates), the
+    prm record indices, the time mask of DS000_originalFit and the number
+    of beams and gates up to the last one with data (0 if there is none).
+    Returns None if the range separation or first range changes within the
+    period.
+    """
+    ds_day  = dataObj_day.DS000_originalFit
+    prm_day = dataObj_day.prm
+
+    prm_times   = np.array(prm_day['time'])
+    prm_inxs    = np.where(np.logical_and(prm_times >= sTime, prm_times < eTime))[0]
+
+    # The day FOV was computed from the first record of the day.
+    for key in ['rsep','frang']:
+        vals    = [prm_day[key][inx] for inx in prm_inxs]
+        if len(vals) > 0 and np.any(np.array(vals) != prm_day[key][0]):
+            return None
+
+    time_tf = np.logical_and(ds_day.time >= sTime, ds_day.time < eTime)
+
+    good        = np.isfinite(ds_day.data[time_tf,:,:])
+    beam_inxs   = np.where(np.any(good,axis=(0,2)))[0]
+    gate_inxs   = np.where(np.any(good,axis=(0,1)))[0]
+    if beam_inxs.size == 0 or gate_inxs.size == 0:
+        return prm_inxs, time_tf, 0, 0
+    return prm_inxs, time_tf, beam_inxs.max() + 1, gate_inxs.max() + 1
+
+def slice_music_obj(dataObj_day,sTime,eTime):
+    """
+    Cut the [sTime, eTime) period out of a musicArray created by
+    load_music_day() and return it as a new musicArray that looks like it
+    was loaded directly from the fitacf files for that period.
+
+    As in musicArray(), the beam and gate dimensions are trimmed to the
+    largest beam and gate that actually have data in the period.
+
+    Returns None if the radar changed range separation or first range
+    within the loaded period, since the FOV of the day object would then not
+    be valid for this window. The caller should load the window on its own.
+    """
+    no_data_message = 'No data for this time period.'
+
+    new_obj = music.musicArray(None)
+    msgs    = []
+    for msg in getattr(dataObj_day,'messages',[]):
+        if msg != no_data_message and msg not in msgs:
+            msgs.append(msg)
+
+    if not hasattr(dataObj_day,'DS000_originalFit'):
+        new_obj.messages = msgs + [no_data_message]
+        return new_obj
+
+    ds_day  = dataObj_day.DS000_originalFit
+    prm_day = dataObj_day.prm
+
+    extent  = get_slice_extent(dataObj_day,sTime,eTime)
+    if extent is None:
+        return None
+    prm_inxs, time_tf, nrBeams, nrGates = extent
+
+    # Filter the radar operational parameters.
+    prm         = {}
+    for key,val in prm_day.items():
+        prm[key]    = [val[inx] for inx in prm_inxs]
+
+    if nrBeams == 0 or nrGates == 0:
+        new_obj.messages = msgs + [no_data_message]
+        return new_obj
+
+    data    = ds_day.data[time_tf,:nrBeams,:nrGates]
+
+    fov = {}
+    for key,val in ds_day.fov.items():
+        fov[key] = copy.deepcopy(val)
+    fov['beams']    = fov['beams'][:nrBeams]
+    fov['gates']    = fov['gates'][:nrGates]
+    for key in ['latCenter','lonCenter','slantRCenter']:
+        fov[key]    = fov[key][:nrBeams,:nrGates]
+    for key in ['latFull','lonFull','slantRFull']:
+        fov[key]    = fov[key][:nrBeams+1,:nrGates+1]
+
+    metadata    = copy.deepcopy(ds_day.metadata)
+    if len(prm['time']) > 0:
+        metadata['sTime']   = min(prm['time'])
+        metadata['eTime']   = max(prm['time'])
+    else:
+        metadata['sTime']   = sTime
+        metadata['eTime']   = eTime
+
+    dataSet = 'DS000_originalFit'
+    comment = '['+dataSet+'] '+ 'Original Fit Data'
+    new_ds  = music.musicDataObj(ds_day.time[time_tf],data,fov=fov,parent=new_obj,comment=comment)
+    new_ds.metadata = metadata
+    setattr(new_obj,dataSet,new_ds)
+    new_ds.setActive()
+
+    new_obj.prm         = prm
+    new_obj.messages    = msgs
+    return new_obj
+
 def create_music_obj(radar, sTime, eTime
         ,beam_limits        = None
         ,gate_limits        = None
@@ -213,10 +377,19 @@ def create_music_obj(radar, sTime, eTime
         ,fit_sfx            = 'fitacf'
         ,fovModel           = 'GS'
         ,gscat              = 1
+        ,dataObj_day        = None
+        ,fov_cache_dir      = fov_cache.FOV_CACHE_DIR
         ):
     """
-    srcPath:    Path to Saved hdf5 Files
+    srcPath:    Path to a saved hdf5 musicArray covering this event, used
+                instead of the fitacf files.
     fitacf_dir: Path to fitacf files
+    dataObj_day: musicArray from load_music_day() covering this event. If
+                given, the event is sliced out of it instead of loading the
+                fitacf files again.
+    fov_cache_dir: Directory of the FOV geometry cache consulted when the
+                data is loaded from fitacf files (see mstid.fov_cache), or
+                None to compute the FOV from the hardware file.
 
     * [**gscat**] (int): Ground scatter flag.
                     0: all backscatter data 
@@ -236,26 +409,28 @@ def create_music_obj(radar, sTime, eTime
 
     # Load in data and create data objects. ########################################
 #    myPtr   = pydarn.sdio.radDataOpen(load_sTime,radar,eTime=load_eTime,channel=channel,cp=cp,fileType=fileType,filtered=boxCarFilter)
-    if srcPath is None:
+    # Slice the window out of an already-loaded radar-day if one was given.
+    # slice_music_obj() returns None if the window must be loaded on its own.
+    dataObj = None
+    if dataObj_day is not None:
+        dataObj = slice_music_obj(dataObj_day,load_sTime,load_eTime)
+
+    if dataObj is None and srcPath is not None:
+        # A saved musicArray, e.g. from synthetic.save_synthetic_music_obj().
+        # Cut out the load window as if the data were loaded from fitacf.
+        dataObj_src = load_saved_dataObj(srcPath)
+        if dataObj_src is None:
+            raise IOError('Cannot load srcPath: {!s}'.format(srcPath))
+        dataObj = slice_music_obj(dataObj_src,load_sTime,load_eTime)
+        del dataObj_src
+        if dataObj is None:
+            raise ValueError('rsep or frang changes within the window; cannot slice srcPath: {!s}'.format(srcPath))
+
+    if dataObj is None:
 #        myPtr   = pydarn.sdio.radDataOpen(load_sTime,radar,eTime=load_eTime,filtered=fitfilter)
         fitacf  = pyDARNmusic.load_fitacf(radar,load_sTime,load_eTime,data_dir=fitacf_dir)
-    else:
-        myPtr = loadMusicArrayFromHDF5(srcPath)
-
-        # Force load_sTime, load_eTime as if simulated data were real data.
-        scan_inxs = []
-        for beam_obj in myPtr.beam_list[:]:
-            if beam_obj.time < load_sTime or beam_obj.time >= load_eTime:
-                myPtr.beam_list.remove(beam_obj)
-            else:
-                scan_inxs.append(beam_obj.prm.scan)
-
-        myPtr.sTime         = load_sTime
-        myPtr.eTime         = load_eTime
-        myPtr.scan_index    = np.min(scan_inxs)
-
-    dataObj = music.musicArray(fitacf,fovModel=fovModel,gscat=gscat)
-    del fitacf
+        dataObj = make_music_array(fitacf,fovModel=fovModel,gscat=gscat,fov_cache_dir=fov_cache_dir)
+        del fitacf
 
     bad = False # Innocent until proven guilty.
     if hasattr(dataObj,'messages'):
@@ -298,44 +473,42 @@ def create_music_obj(radar, sTime, eTime
         dataObj = pyDARNmusic.checkDataQuality(dataObj,dataSet='originalFit',sTime=sTime,eTime=eTime)
     return dataObj
 
-def auto_range(radar,sTime,eTime,dataObj,bad_range_km=500,
-        figsize = (20,7),output_dir='output',plot=False):
+def auto_range_hist(dists,gates,kernel_size=11):
     """
-    Automatically determine the range gates used in analysis.
+    Range gate histograms used by auto_range() for a (distribution, gate)
+    stack of range distributions. Each distribution is scaled to 1000 samples at its
+    maximum, histogrammed by gate with unit area, and median filtered.
 
-    bad_range_km: The minimum acceptable range away from the radar
-    (after the range mapping has been applied). 500 km for ground scatter
-    gets you past FOV distortion.
+    This is a weighted histogram of the gates, equivalent to repeating each
+    gate in proportion to its weight and histogramming the result.
     """
-
-    # Auto-ranging code ############################################################
-    currentData = dataObj.DS000_originalFit
-    timeInx = np.where(np.logical_and(currentData.time >= sTime,currentData.time <= eTime))[0]
-
-    bins    = currentData.fov['gates']
-    # Integrate over time and beams to give a distribution as a funtion of range
-    dist    = np.nansum(np.nansum(currentData.data[timeInx,:,:],axis=0),axis=0)
+    dists   = np.atleast_2d(np.array(dists,dtype=float))
+    gates   = np.array(gates)
 
     # Set max val of the distribution and convert all NaNs to 0.
-    dist    = np.nan_to_num(dist / np.nanmax(dist))
+    with np.errstate(invalid='ignore',divide='ignore'):
+        dists   = np.nan_to_num(dists / np.nanmax(dists,axis=1,keepdims=True))
 
     nrPts   = 1000
-    distArr = np.array([],dtype=int)
-    for rg in range(len(bins)):
-        gate    = bins[rg]
-        nrGate  = int(np.floor(dist[rg]*nrPts))
-        if nrGate < 0:
-            nrGate = 0
+    weights = np.clip(np.floor(dists*nrPts),0,None)
 
-        distArr = np.concatenate([distArr,np.ones(nrGate,dtype=int)*gate])
+    # np.histogram() puts the last gate in the last bin with the one before.
+    counts          = weights[:,:-1].copy()
+    counts[:,-1]   += weights[:,-1]
+    with np.errstate(invalid='ignore',divide='ignore'):
+        hist        = counts / np.diff(gates)[None,:] / counts.sum(axis=1,keepdims=True)
 
-    hist,bins           = np.histogram(distArr,bins=bins,density=True)
-    hist                = sp.signal.medfilt(hist,kernel_size=11)
+    hist    = sp.signal.medfilt(hist,kernel_size=(1,kernel_size))
+    return hist
 
+def _auto_range_limits(hist,bins,bad_range=None,thresh=0.18):
+    """
+    Find the gates connected to the peak of an auto_range_hist() histogram
+    that are above thresh times the peak.
+    """
     arg_max = np.argmax(hist)
 
     max_val = hist[arg_max]
-    thresh  = 0.18
 
     good    = [arg_max]
     #Search connected lower
@@ -363,10 +536,125 @@ def auto_range(radar,sTime,eTime,dataObj,bad_range_km=500,
     max_range   = max(good)
 
     #Check for and correct bad start gate (due to GS mapping algorithm)
-    if bad_range_km is not None:
-        bad_range   = np.max(np.where(dataObj.DS000_originalFit.fov['slantRCenter'] < bad_range_km)[1])
+    if bad_range is not None:
         if min_range <= bad_range: min_range = bad_range+1
 
+    return min_range, max_range, good
+
+def _auto_range_bad_range(currentData,bad_range_km):
+    if bad_range_km is None:
+        return None
+    return np.max(np.where(currentData.fov['slantRCenter'] < bad_range_km)[1])
+
+def auto_range_batch(dataObj_day,windows,bad_range_km=500,load_windows=None):
+    """
+    auto_range() gate limits for many (sTime, eTime) windows of a radar-day
+    from load_music_day() at once. Returns a list with a (min_range,
+    max_range) tuple for each window, or None for a window without data or
+    one that slice_music_obj() cannot cut out. dataObj_day is not changed.
+
+    load_windows: The period create_music_obj() loads for each window,
+        (sTime, eTime) with the FIR filter padding. An event sliced from the
+        day only keeps the beams and gates with data in this period, which
+        changes its histogram, so these are used to get the same limits
+        auto_range() finds for the sliced event. Defaults to windows.
+
+    Like auto_range(), this uses DS000_originalFit, so it does not matter
+    whether the boxcar filter is applied. The windows with the same number
+    of gates are histogrammed together with auto_range_hist().
+    """
+    if load_windows is None:
+        load_windows = windows
+    if not hasattr(dataObj_day,'DS000_originalFit'):
+        return [None]*len(windows)
+
+    currentData = dataObj_day.DS000_originalFit
+    gate_limits = [None]*len(windows)
+    groups      = {}
+    for win_inx,((sTime,eTime),(load_sTime,load_eTime)) in enumerate(zip(windows,load_windows)):
+        extent  = get_slice_extent(dataObj_day,load_sTime,load_eTime)
+        if extent is None or extent[2] == 0:
+            continue
+        prm_inxs, time_tf, nrBeams, nrGates = extent
+
+        timeInx = np.where(np.logical_and(currentData.time >= sTime,currentData.time <= eTime))[0]
+        timeInx = timeInx[time_tf[timeInx]]
+        dist    = np.nansum(np.nansum(currentData.data[timeInx,:nrBeams,:nrGates],axis=0),axis=0)
+        groups.setdefault((nrBeams,nrGates),[]).append((win_inx,dist))
+
+    for (nrBeams,nrGates),items in groups.items():
+        bins        = currentData.fov['gates'][:nrGates]
+        hists       = auto_range_hist([dist for win_inx,dist in items],bins)
+        bad_range   = None
+        if bad_range_km is not None:
+            slantRCenter    = currentData.fov['slantRCenter'][:nrBeams,:nrGates]
+            bad_gates       = np.where(slantRCenter < bad_range_km)[1]
+            if bad_gates.size == 0:
+                # auto_range() fails for these windows; leave them to it.
+                continue
+            bad_range       = np.max(bad_gates)
+        for (win_inx,dist),hist in zip(items,hists):
+            min_range, max_range, good = _auto_range_limits(hist,bins,bad_range)
+            gate_limits[win_inx] = (min_range,max_range)
+    return gate_limits
+
+def auto_range_events(dataObj_day,prms):
+    """
+    auto_range_batch() gate limits for events of a radar-day, given as
+    run_music() parameter dictionaries (see read_init_param_file()).
+    Returns a list with the gate limits of each event, or None for an event
+    that does not use auto_range() or is not sliced from dataObj_day.
+    """
+    gate_limits = [None]*len(prms)
+    groups      = {}
+    for prm_inx,prm in enumerate(prms):
+        if not prm.get('auto_range_on',True) or not needs_raw_data(prm):
+            continue
+        groups.setdefault(prm.get('bad_range_km'),[]).append(prm_inx)
+
+    for bad_range_km,prm_inxs in groups.items():
+        windows         = []
+        load_windows    = []
+        for prm_inx in prm_inxs:
+            prm     = prms[prm_inx]
+            sTime   = prm['sTime']
+            eTime   = prm['eTime']
+            windows.append((sTime,eTime))
+            # The period create_music_obj() loads for the event.
+            interp_resolution   = prm.get('interp_resolution',60.)
+            filterNumtaps       = prm.get('filter_numtaps',101.)
+            if interp_resolution != None and filterNumtaps != None:
+                load_windows.append(pyDARNmusic.filterTimes(sTime,eTime,interp_resolution,filterNumtaps))
+            else:
+                load_windows.append((sTime,eTime))
+
+        limits = auto_range_batch(dataObj_day,windows,bad_range_km=bad_range_km,load_windows=load_windows)
+        for prm_inx,lim in zip(prm_inxs,limits):
+            gate_limits[prm_inx] = lim
+    return gate_limits
+
+def auto_range(radar,sTime,eTime,dataObj,bad_range_km=500,
+        figsize = (20,7),output_dir='output',plot=False):
+    """
+    Automatically determine the range gates used in analysis.
+
+    bad_range_km: The minimum acceptable range away from the radar
+    (after the range mapping has been applied). 500 km for ground scatter
+    gets you past FOV distortion.
+    """
+
+    # Auto-ranging code ############################################################
+    currentData = dataObj.DS000_originalFit
+    timeInx = np.where(np.logical_and(currentData.time >= sTime,currentData.time <= eTime))[0]
+
+    bins    = currentData.fov['gates']
+    # Integrate over time and beams to give a distribution as a funtion of range
+    dist    = np.nansum(np.nansum(currentData.data[timeInx,:,:],axis=0),axis=0)
+
+    hist    = auto_range_hist(dist,bins)[0]
+    bad_range   = _auto_range_bad_range(currentData,bad_range_km)
+    min_range, max_range, good = _auto_range_limits(hist,bins,bad_range)
+
     dataObj.DS000_originalFit.metadata['gateLimits'] = (min_range,max_range)
 
     if plot:
@@ -420,119 +708,996 @@ def auto_range(radar,sTime,eTime,dataObj,bad_range_km=500,
 
     return (min_range,max_range)
 
-def zeropad_data(dataObj):
-    time_delt   = np.max(dataObj.active.time) - np.min(dataObj.active.time)
-    samp_per    = datetime.timedelta(seconds=dataObj.active.samplePeriod())
-    new_time = np.array(
-    (dataObj.active.time - time_delt - samp_per).tolist() + \
-    (dataObj.active.time).tolist() + \
-    (dataObj.active.time + time_delt + samp_per).tolist()
-    )
+def get_zeropad_nfft(nrTimes,zeropad=True):
+    """
+    Transform length of the zero padded time series: the signal with one
+    signal length of zeros on either side.
+    """
+    if zeropad:
+        return 3*nrTimes
+    return nrTimes
+
+def _zeropad_fft(data,nfft,axis=0,workers=None):
+    """
+    FFT of data along axis, zero padded to nfft samples with the samples
+    centered in the padded series. Returns the
+    normalized, fftshifted complex64 spectrum and the number of zeros
+    before the samples.
+    """
+    nrTimes     = data.shape[axis]
+    pad_before  = (nfft - nrTimes)//2
+
+    # scipy.fft pads at the end; shift the samples to the center of the series.
+    spec    = sp.fft.fft(data,n=nfft,axis=axis,workers=workers)
+    if pad_before > 0:
+        shape       = [1]*data.ndim
+        shape[axis] = nfft
+        shift   = np.exp(-2j*np.pi*((np.arange(nfft)*pad_before) % nfft)/nfft)
+        spec   *= shift.reshape(shape)
+    spec    = sp.fft.fftshift(spec,axes=axis)
+    spec   /= nfft
+
+    #Use complex64, not complex128, as calculateFFT() does.
+    return spec.astype(np.complex64), pad_before
+
+def _set_spectrum(currentData,spectrum,nfft,pad_before):
+    """
+    Store a spectrum from _zeropad_fft() in a musicDataObj with the frequency
+    vector and dominant frequency that pyDARNmusic.calculateFFT() sets.
+    """
+    #Determine frequency axis.
+    nyq     = currentData.nyquistFrequency()
+    freq_ax = np.arange(nfft,dtype='f8')
+    freq_ax = (freq_ax / max(freq_ax)) - 0.5
+    freq_ax = freq_ax * 2. * nyq
+
+    currentData.freqVec   = freq_ax
+    currentData.spectrum  = spectrum
+    currentData.setMetadata(fft_nfft=int(nfft))
+    currentData.setMetadata(fft_pad_before=int(pad_before))
+
+    # Calculate the dominant frequency #############################################
+    posFreqInx  = np.where(currentData.freqVec >= 0)[0]
+    posFreqVec  = currentData.freqVec[posFreqInx]
+    avg_psd     = np.mean(np.abs(currentData.spectrum[posFreqInx,:,:]),axis=(1,2))
+    currentData.dominantFreq = posFreqVec[np.argmax(avg_psd)]
+    currentData.appendHistory('Calculated FFT (nfft={:d})'.format(nfft))
+
+def calculate_fft(dataObj,dataSet='active',nfft=None,workers=None):
+    """
+    Calculate the spectrum of a data set like pyDARNmusic.calculateFFT(), but
+    zero pad the time series to nfft samples inside the transform instead of
+    building a zero padded data set.
+
+    The samples are centered in the nfft-long series, so the spectrum
+    matches calculateFFT() of a data set padded with zeros on both sides
+    (see get_zeropad_nfft()). nfft=None
+    does not pad. The padded time vector is not stored; get_fft_time()
+    derives it if it is needed. workers is passed to scipy.fft.
+    """
+    currentData = pyDARNmusic.getDataSet(dataObj,dataSet)
+    currentData = currentData.applyLimits()
+
+    if nfft is None:
+        nfft = currentData.data.shape[0]
+    spectrum, pad_before = _zeropad_fft(currentData.data,nfft,workers=workers)
+    _set_spectrum(currentData,spectrum,nfft,pad_before)
 
-    size     = dataObj.active.data.shape[0]
-    new_data = np.pad(dataObj.active.data,((size,size),(0,0),(0,0)),'constant')
+def batch_calculate_fft(dataObjs,dataSet='active',nfft=None,workers=-1):
+    """
+    calculate_fft() for many musicArrays at once. Data sets with the same
+    shape and nfft are stacked into one array and transformed with a single
+    multi-threaded scipy.fft call, and the spectra are then stored in each
+    data set.
+
+    nfft:       None, a transform length for every event, or a list with
+                    one per dataObj.
+    workers:    Number of scipy.fft threads; -1 uses all CPUs.
+    """
+    dataObjs    = list(dataObjs)
+    if nfft is None or np.isscalar(nfft):
+        nfft    = [nfft]*len(dataObjs)
+
+    groups  = collections.OrderedDict()
+    for dataObj,this_nfft in zip(dataObjs,nfft):
+        currentData = pyDARNmusic.getDataSet(dataObj,dataSet)
+        currentData = currentData.applyLimits()
+        if this_nfft is None:
+            this_nfft = currentData.data.shape[0]
+        key = (currentData.data.shape,int(this_nfft))
+        groups.setdefault(key,[]).append(currentData)
+
+    for (shape,this_nfft),currentDatas in groups.items():
+        stack   = np.stack([currentData.data for currentData in currentDatas])
+        spectra, pad_before = _zeropad_fft(stack,this_nfft,axis=1,workers=workers)
+        del stack
+        for currentData,spectrum in zip(currentDatas,spectra):
+            _set_spectrum(currentData,spectrum,this_nfft,pad_before)
+
+class FFTBatchError(RuntimeError):
+    """
+    Raised by FFTBatch.flush() when events of the batch failed. failed is
+    the list of their names (see FFTBatch.add()).
+    """
+    def __init__(self,failed):
+        RuntimeError.__init__(self,list(failed))
+        self.failed = list(failed)
 
-    new_sig      = dataObj.active.copy('zeropad','Zero Padded Signal')
-    new_sig.time = new_time
-    new_sig.data = new_data
+    def __str__(self):
+        return 'Batched FFT failed for: {!s}'.format(self.failed)
 
-    new_sig.setMetadata(sTime=new_time.min())
-    new_sig.setMetadata(eTime=new_time.max())
+class FFTBatch(object):
+    """
+    Collects the events that run_music(fft_batch=...) has processed up to the
+    FFT and calculates their spectra together with batch_calculate_fft().
+    The rest of each run (saving the HDF5 file, marking the process level and
+    updating MongoDB) is done when the batch is flushed.
+
+    The batch flushes itself when it holds max_events events, unless
+    auto_flush is False; then the caller flushes it when is_full(), e.g.
+    outside of the log file of the event that filled it. Call flush() after
+    the last event, or use it as a context manager. The pending events are
+    kept in memory, so run_music(retain_data_sets='lean') is recommended.
+    """
+    def __init__(self,max_events=32,workers=-1,auto_flush=True):
+        self.max_events = max_events
+        self.workers    = workers
+        self.auto_flush = auto_flush
+        self.pending    = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,tb):
+        if exc_type is None:
+            self.flush()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def is_full(self):
+        return self.max_events is not None and len(self.pending) >= self.max_events
+
+    def add(self,dataObj,nfft,finish,name=None,log_path=None):
+        """
+        Add an event. finish() is called after its spectrum is calculated.
+        name identifies the event in an FFTBatchError, e.g. its
+        initialization file. With log_path, the warnings logged by finish()
+        are appended to that file, as during the rest of the run.
+        """
+        if name is None:
+            name = 'batched event {:d}'.format(len(self.pending))
+        self.pending.append((dataObj,nfft,finish,name,log_path))
+        if self.auto_flush and self.is_full():
+            self.flush()
+
+    def flush(self):
+        """
+        Calculate the spectra of the pending events and finish their runs. A
+        failure in one event does not stop the rest; an FFTBatchError naming
+        the failed events is raised at the end.
+        """
+        pending         = self.pending
+        self.pending    = []
+        if len(pending) == 0:
+            return
 
-    new_sig.setActive()
+        print('{!s} Batched FFT of {:d} events'.format(datetime.datetime.now(),len(pending)))
+        try:
+            batch_calculate_fft([x[0] for x in pending],nfft=[x[1] for x in pending],workers=self.workers)
+        except Exception:
+            print(traceback.format_exc())
+            raise FFTBatchError([x[3] for x in pending])
+
+        failed  = []
+        for dataObj,nfft,finish,name,log_path in pending:
+            try:
+                if log_path is None:
+                    finish()
+                else:
+                    with log_to_file(log_path):
+                        finish()
+            except Exception:
+                print(traceback.format_exc())
+                failed.append(name)
+        del pending
 
-def window_beam_gate(dataObj,dataSet='active',window='hann'):
-    
+        if len(failed) > 0:
+            raise FFTBatchError(failed)
+
+def get_fft_time(currentData):
+    """
+    Returns the time vector of the zero padded series that calculate_fft()
+    transformed. Pass it to calculate_terminator() for the terminator of the
+    padded series.
+    """
+    time        = np.array(currentData.time)
+    nfft        = currentData.metadata.get('fft_nfft')
+    if nfft is None or nfft == len(time):
+        return time
+
+    pad_before  = currentData.metadata.get('fft_pad_before',0)
+    samp_per    = datetime.timedelta(seconds=currentData.samplePeriod())
+    fft_time    = [time[0] + (inx-pad_before)*samp_per for inx in range(nfft)]
+    return np.array(fft_time)
+
+# MUSIC implementations that run_music(music_engine=...) can use.
+MUSIC_ENGINES = ['pyDARNmusic','mstid']
+
+def calculate_dlm(dataObj,dataSet='active'):
+    """
+    Calculate the cross-spectral matrix Dlm and llLookupTable of a data set
+    like pyDARNmusic.calculateDlm(), as one matrix product of the positive
+    frequency spectra of all cells. The FFT must already be calculated.
+    """
     currentData = pyDARNmusic.getDataSet(dataObj,dataSet)
-    currentData = currentData.applyLimits()
 
     nrTimes, nrBeams, nrGates = np.shape(currentData.data)
+    nCells      = nrBeams * nrGates
+
+    # Cells are numbered gate by gate: ll = gate*nrBeams + beam.
+    beam_inx, gate_inx = np.meshgrid(np.arange(nrBeams),np.arange(nrGates))
+    beam_inx    = beam_inx.ravel()
+    gate_inx    = gate_inx.ravel()
+
+    llLookupTable       = np.zeros([5,nCells])
+    llLookupTable[0,:]  = np.arange(nCells)
+    llLookupTable[1,:]  = np.asarray(currentData.fov['beams'])[beam_inx]
+    llLookupTable[2,:]  = np.asarray(currentData.fov['gates'])[gate_inx]
+    llLookupTable[3,:]  = currentData.fov['relative_y'][beam_inx,gate_inx]
+    llLookupTable[4,:]  = currentData.fov['relative_x'][beam_inx,gate_inx]
+    currentData.llLookupTable = llLookupTable
+
+    #Only use positive frequencies...
+    posInx      = np.where(currentData.freqVec > 0)[0]
+    spect       = currentData.spectrum[posInx,:,:].transpose(2,1,0).reshape(nCells,len(posInx))
+    spect       = spect.astype(np.complex128)
+
+    # Dlm[l,m] = sum over frequency of spect[l] * conj(spect[m])
+    currentData.Dlm = np.dot(spect,spect.conj().T)
+    currentData.appendHistory('Calculated Cross-Spectral Matrix Dlm')
+
+def calculate_karr(dataObj,dataSet='active',kxMax=0.05,kyMax=0.05,dkx=0.001,dky=0.001,
+        threshold=0.15,block_mb=64.):
+    """
+    Calculate the horizontal wavenumber array karr like
+    pyDARNmusic.calculateKarr(). Dlm must already be calculated.
+
+    Dlm is Hermitian, so its eigenvectors are found with eigh() and are
+    orthonormal. (calculateKarr() uses eig(), whose eigenvectors for the
+    repeated noise eigenvalues are not, so its karr depends on the basis
+    eig() happens to return.) This happens whenever Dlm is rank deficient,
+    i.e. there are fewer positive frequencies than range-beam cells, and
+    there karr differs from calculateKarr() by ~10% and the peaks can move
+    by one dkx/dky step. With a full-rank Dlm the two agree. The noise subspace norm of each steering
+    vector u is |u|^2 minus its signal subspace norm, so u is projected onto
+    whichever subspace is smaller. The steering vectors of the whole kx/ky grid are
+    exp(i kx x) * exp(i ky y), which turns the projection into one matrix
+    product per block of eigenvectors. block_mb limits the memory used.
+    """
+    currentData = pyDARNmusic.getDataSet(dataObj,dataSet)
 
-    win = sp.signal.get_window(window,nrGates,fftbins=False)
-    win.shape = (1,1,nrGates)
+    #Calculate eigenvalues, eigenvectors
+    eVals,eVecs = sp.linalg.eigh(np.transpose(currentData.Dlm),driver='evr')
 
-    new_sig      = dataObj.active.copy('windowed_gate','Windowed Gate Dimension')
-    new_sig.data = win*dataObj.active.data
-    new_sig.setActive()
-    
-    win = sp.signal.get_window(window,nrBeams,fftbins=False)
-    win.shape = (1,nrBeams,1)
+    nkx     = np.ceil(2*kxMax/dkx)
+    if (nkx % 2) == 0: nkx = nkx+1
+    kxVec   = kxMax * (2*np.arange(nkx)/(nkx-1) - 1)
+
+    nky     = np.ceil(2*kyMax/dky)
+    if (nky % 2) == 0: nky = nky+1
+    kyVec   = kyMax * (2*np.arange(nky)/(nky-1) - 1)
+
+    nkx     = int(nkx)
+    nky     = int(nky)
+
+    xm      = currentData.llLookupTable[4,:] #x is in the E-W direction.
+    ym      = currentData.llLookupTable[3,:] #y is in the N-S direction.
+    nCells  = len(xm)
+
+    maxEval     = np.max(np.abs(eVals))
+    noise       = eVals <= threshold*maxEval
+    cnt         = np.count_nonzero(noise)
+    if cnt < 3:
+        print('Not enough small eigenvalues!')
+
+    if cnt <= nCells - cnt:
+        vecs    = eVecs[:,noise]
+    else:
+        vecs    = eVecs[:,~noise]
+
+    # Steering vector factors for each kx and ky.
+    ax      = np.exp(1j*np.multiply.outer(kxVec,xm))
+    ay      = np.exp(1j*np.multiply.outer(kyVec,ym))
+
+    # |v^H u|^2 summed over the eigenvectors v, for every (kx,ky) at once.
+    power   = np.zeros((nkx,nky))
+    n_block = max(1,int(block_mb*1024.**2 / (16.*nkx*nCells)))
+    for inx in range(0,vecs.shape[1],n_block):
+        vv      = vecs[:,inx:inx+n_block]
+        wx      = ax[:,None,:] * np.conj(vv.T)[None,:,:]
+        proj    = np.dot(wx.reshape(-1,nCells),ay.T).reshape(nkx,vv.shape[1],nky)
+        power  += np.sum(np.abs(proj)**2,axis=1)
+
+    if cnt > nCells - cnt:
+        power   = nCells - power
+
+    currentData.karr  = (1. / power).astype(np.complex64)
+    currentData.kxVec = kxVec
+    currentData.kyVec = kyVec
+    currentData.appendHistory('Calculated kArr')
+
+def scale_karrs(karrs):
+    """
+    pyDARNmusic.scale_karr() of each image of an (n, nkx, nky) stack of karr
+    arrays.
+    """
+    data    = np.abs(karrs)
+    data    = data - np.min(data,axis=(1,2),keepdims=True)
+    scMax   = np.nanmean(data,axis=(1,2),keepdims=True) + 6.5*np.nanstd(data,axis=(1,2),keepdims=True)
+    return data / scMax
+
+def label_karr_signals(data,threshold=0.35,neighborhood=(10,10)):
+    """
+    Segment an (n, nkx, nky) stack of scaled karr images into signal regions
+    the way pyDARNmusic.detectSignals() does. The distance transform, peak
+    search and labelling operate on the whole stack at once, with filters
+    and connectivity acting only within an image.
+
+    Cells above threshold are masked, the local maxima (within
+    neighborhood) of their distance to the edge of the mask are found with a
+    scipy.ndimage maximum filter and labelled as markers, and the mask is
+    split between the markers by a watershed of the negative distance.
+
+    Returns the mask, the labels numbered across the whole stack, and the
+    number of markers in each image.
+    """
+    mask        = data > threshold
+
+    # Large spacing between images so that distances stay within an image.
+    sampling    = (10.*np.sum(data.shape[1:]),1.,1.)
+    distance    = ndimage.distance_transform_edt(mask,sampling=sampling)
+
+    # Markers: maxima of the distance, away from the edges of the image, as
+    # peak_local_max() finds them.
+    footprint   = np.ones((1,)+tuple(neighborhood),dtype=bool)
+    peaks       = distance == ndimage.maximum_filter(distance,footprint=footprint,mode='nearest')
+    peaks      &= distance > 0
+    peaks[:,[0,-1],:]   = False
+    peaks[:,:,[0,-1]]   = False
+
+    conn_4      = np.zeros((3,3,3),dtype=bool)
+    conn_4[1]   = ndimage.generate_binary_structure(2,1)
+    markers, nb = ndimage.label(peaks,structure=conn_4)
+    nr_markers  = np.array([len(np.unique(x[x > 0])) for x in markers])
+
+    # Watershed of -distance over the mask, as in detectSignals(). It is run
+    # per image: skimage breaks ties between equal distances differently in
+    # a 3D stack, which would move region boundaries.
+    from skimage.segmentation import watershed
+    labels      = np.zeros_like(markers)
+    for inx in range(data.shape[0]):
+        labels[inx] = watershed(-distance[inx],markers[inx],mask=mask[inx])
+
+    return mask, labels, nr_markers
+
+def batch_detect_signals(dataObjs,dataSet='active',threshold=0.35,neighborhood=(10,10)):
+    """
+    pyDARNmusic.detectSignals() for many musicArrays. The karr arrays with
+    the same shape are segmented together with label_karr_signals(), and
+    the regions of all of them are measured in one pass. The results are
+    stored as a SigDetect in each data set's sigDetect, as detectSignals()
+    does.
+    """
+    groups  = collections.OrderedDict()
+    for dataObj in dataObjs:
+        currentData = pyDARNmusic.getDataSet(dataObj,dataSet)
+        groups.setdefault(currentData.karr.shape,[]).append(currentData)
+
+    for shape,currentDatas in groups.items():
+        data    = scale_karrs(np.array([currentData.karr for currentData in currentDatas]))
+        mask, labels, nr_markers = label_karr_signals(data,threshold,neighborhood)
+
+        inx     = np.arange(1,labels.max()+1)
+        areas   = ndimage.sum(mask,labels,inx)
+        maxima  = ndimage.maximum(data,labels,inx)
+        maxpos  = ndimage.maximum_position(data,labels,inx)
+
+        # Each marker labels one region, and the labels of each image follow
+        # on from those of the image before it.
+        offset  = 0
+        for img_inx,currentData in enumerate(currentDatas):
+            nr_labels   = nr_markers[img_inx]
+            img_labels  = np.where(labels[img_inx] > 0,labels[img_inx]-offset,0)
+            order       = np.argsort(maxima[offset:offset+nr_labels])[::-1] + 1
+
+            sigDetect = music.SigDetect()
+            sigDetect.mask    = mask[img_inx]
+            sigDetect.labels  = img_labels
+            sigDetect.nrSigs  = nr_markers[img_inx]
+            sigDetect.info    = []
+            for x in range(nr_labels):
+                info = {}
+                info['labelInx']    = x+1
+                info['order']       = order[x]
+                info['area']        = areas[offset+x]
+                info['max']         = maxima[offset+x]
+                info['maxpos']      = maxpos[offset+x][1:]
+                info['kx']          = currentData.kxVec[int(info['maxpos'][0])]
+                info['ky']          = currentData.kyVec[int(info['maxpos'][1])]
+                info['k']           = np.sqrt( info['kx']**2 + info['ky']**2 )      # Horizontal Wavenumber [1/(2*pi*km)]
+                info['lambda_x']    = 2*np.pi / info['kx']                          # North-South Wavelength in km
+                info['lambda_y']    = 2*np.pi / info['ky']                          # East-West Wavelenth in km
+                info['lambda']      = 2*np.pi / info['k']                           # Horizonal Wavelength in km
+                info['azm']         = np.degrees(np.arctan2(info['kx'],info['ky'])) # Propagation azimuth [degrees clockwise from North]
+                info['freq']        = currentData.dominantFreq                      # Frequency in Hz
+                info['period']      = 1./currentData.dominantFreq                   # Period in seconds
+                info['vel']         = (2.*np.pi/info['k']) * info['freq'] * 1000.   # MSTID Velocity in m/s
+                sigDetect.info.append(info)
+
+            currentData.appendHistory('Detected KArr Signals')
+            currentData.sigDetect = sigDetect
+            offset += nr_labels
+
+def detect_signals(dataObj,dataSet='active',threshold=0.35,neighborhood=(10,10)):
+    """
+    pyDARNmusic.detectSignals() with the scipy.ndimage segmentation of
+    label_karr_signals(). Returns the data set.
+    """
+    batch_detect_signals([dataObj],dataSet=dataSet,threshold=threshold,neighborhood=neighborhood)
+    return pyDARNmusic.getDataSet(dataObj,dataSet)
+
+# Implementations of the boxcar filter, beam interpolation and time
+# interpolation that run_music(rti_engine=...) can use.
+RTI_ENGINES = ['pyDARNmusic','mstid']
+
+def boxcar_filter_data(dataObj,dataSet='active',newDataSetName='boxcarFiltered',
+        comment='Boxcar Filter',min_good=5):
+    """
+    3x3x3 (time, beam, gate) boxcar filter of a data set. Each cell becomes
+    the mean of the valid (finite) cells in the box around it, or NaN if the
+    box has fewer than min_good valid cells. The box is cut off at the
+    edges of the array.
+
+    The valid cell counts and sums are two scipy.ndimage convolutions of
+    the whole array.
+    """
+    currentData = pyDARNmusic.getDataSet(dataObj,dataSet)
+    data        = currentData.data
+
+    good        = np.isfinite(data)
+    box         = np.ones((3,3,3))
+    counts      = ndimage.convolve(good.astype(float),box,mode='constant',cval=0.)
+    sums        = ndimage.convolve(np.where(good,data,0.),box,mode='constant',cval=0.)
+
+    with np.errstate(invalid='ignore',divide='ignore'):
+        filteredData = sums / counts
+    filteredData[counts < min_good] = np.nan
+
+    newDataSet = currentData.copy(newDataSetName,comment)
+    newDataSet.data = filteredData
+    newDataSet.setActive()
+
+def _valid_neighbors(good,axis):
+    """
+    For each position along axis, the index of the nearest valid cell at or
+    before it (-1 if none) and at or after it (the axis length if none).
+    """
+    n       = good.shape[axis]
+    shape   = [1]*good.ndim
+    shape[axis] = n
+    inx     = np.arange(n).reshape(shape)
+
+    left    = np.maximum.accumulate(np.where(good,inx,-1),axis=axis)
+    right   = np.where(good,inx,n)
+    right   = np.flip(np.minimum.accumulate(np.flip(right,axis=axis),axis=axis),axis=axis)
+    return left, right
+
+def _interp_valid(x,y,x_new,left,right,fill_value):
+    """
+    Linear interpolation of y (sampled at x) at x_new between the valid
+    samples left and right of it, as scipy.interpolate.interp1d() computes
+    it. Positions without a valid sample on both sides get fill_value.
+    """
+    n       = y.shape[0]
+    inside  = np.logical_and(left >= 0,right < n)
+    l_inx   = np.clip(left,0,n-1)
+    r_inx   = np.clip(right,0,n-1)
+
+    y_lo    = np.take_along_axis(y,l_inx,axis=0)
+    y_hi    = np.take_along_axis(y,r_inx,axis=0)
+    x_lo    = x[l_inx]
+    x_hi    = x[r_inx]
+
+    with np.errstate(invalid='ignore',divide='ignore'):
+        slope   = (y_hi - y_lo) / (x_hi - x_lo)
+        y_new   = slope*(x_new - x_lo) + y_lo
+    y_new   = np.where(l_inx == r_inx,y_lo,y_new)
+    return np.where(inside,y_new,fill_value)
+
+def beam_interpolation(dataObj,dataSet='active',newDataSetName='beamInterpolated',
+        comment='Beam Linear Interpolation'):
+    """
+    pyDARNmusic.beamInterpolation() for all times and beams at once: each
+    (time, beam) profile is linearly interpolated along range over the
+    valid cells within metadata['gateLimits'], and is 0 outside of them.
+
+    Falls back to pyDARNmusic.beamInterpolation() if a beam's ranges are
+    not increasing or not finite within the gate limits.
+    """
+    currentData = pyDARNmusic.getDataSet(dataObj,dataSet)
+    data        = currentData.data
+    gates       = np.asarray(currentData.fov['gates'])
+    ranges      = np.asarray(currentData.fov['slantRCenter'],dtype=float)
+
+    in_limits   = np.ones(gates.shape,dtype=bool)
+    if 'gateLimits' in currentData.metadata:
+        limits      = currentData.metadata['gateLimits']
+        in_limits   = np.logical_and(gates >= limits[0],gates <= limits[1])
+
+    # The interpolation is done between neighboring valid gates, which is
+    # only the same as interpolating in range if range increases with gate.
+    monotonic   = np.all(np.isfinite(ranges[:,in_limits]))
+    for beam_ranges in ranges:
+        finite  = np.where(np.isfinite(beam_ranges))[0]
+        monotonic &= np.all(np.diff(finite) == 1) and np.all(np.diff(beam_ranges[finite]) > 0)
+    if not monotonic:
+        pyDARNmusic.beamInterpolation(dataObj,dataSet=dataSet,newDataSetName=newDataSetName,comment=comment)
+        return
+
+    # Interpolate along the first axis: (gate, time, beam).
+    y           = np.moveaxis(data,2,0)
+    good        = np.logical_and(np.isfinite(y),in_limits[:,None,None])
+    left, right = _valid_neighbors(good,axis=0)
+
+    interpArr   = np.zeros(y.shape)
+    for beam in range(y.shape[2]):
+        x           = ranges[beam,:]
+        interpArr[:,:,beam] = _interp_valid(x,y[:,:,beam],x[:,None],
+                left[:,:,beam],right[:,:,beam],0.)
+        # A range that is not finite is not in any interval.
+        interpArr[~np.isfinite(x),:,beam] = np.nan
+
+    # Profiles with fewer than 2 valid cells are left at 0.
+    nr_good     = np.sum(good,axis=0)
+    interpArr[:,nr_good < 2] = 0.
+    if np.sum(in_limits) < 2:
+        interpArr[:] = 0.
+
+    newDataSet = currentData.copy(newDataSetName,comment)
+    newDataSet.data = np.ascontiguousarray(np.moveaxis(interpArr,0,2))
+    newDataSet.setActive()
+
+def time_interpolation(dataObj,dataSet='active',newDataSetName='timeInterpolated',
+        comment='Time Linear Interpolation',timeRes=10,newTimeVec=None):
+    """
+    pyDARNmusic.timeInterpolation() for all cells at once: each cell is
+    linearly interpolated in time over its valid samples onto a regular
+    time vector (timeRes seconds, starting at the minute of the first
+    sample), and is NaN outside of them. Cells with fewer than 2 valid
+    samples are 0.
+    """
+    from pyDARNmusic.utils import timeUtils
+
+    currentData = pyDARNmusic.getDataSet(dataObj,dataSet)
+
+    sTime = currentData.time[0]
+    sTime = datetime.datetime(sTime.year,sTime.month,sTime.day,sTime.hour,sTime.minute) #Make start time a round time.
+    fTime = currentData.time[-1]
+
+    #Create new time vector.
+    if newTimeVec is None:
+        newTimeVec = [sTime]
+        while newTimeVec[-1] < fTime:
+            newTimeVec.append(newTimeVec[-1] + datetime.timedelta(seconds=timeRes))
+
+    #Ensure that the new time vector is within the bounds of the actual data set.
+    newTimeVec  = np.array(newTimeVec)
+    good        = np.where(np.logical_and(newTimeVec > min(currentData.time),newTimeVec < max(currentData.time)))
+    newTimeVec  = newTimeVec[good]
+    newEpochVec = np.array(timeUtils.datetimeToEpoch(newTimeVec),dtype=float)
+    epochVec    = np.array(timeUtils.datetimeToEpoch(currentData.time),dtype=float)
+
+    if np.any(np.diff(epochVec) <= 0):
+        pyDARNmusic.timeInterpolation(dataObj,dataSet=dataSet,newDataSetName=newDataSetName,
+                comment=comment,timeRes=timeRes,newTimeVec=newTimeVec)
+        return
+
+    data        = currentData.data
+    good        = np.isfinite(data)
+    left, right = _valid_neighbors(good,axis=0)
+
+    # Nearest sample at or before and at or after each new time.
+    inx_lo      = np.searchsorted(epochVec,newEpochVec,side='right') - 1
+    inx_hi      = np.searchsorted(epochVec,newEpochVec,side='left')
+    left        = left[np.clip(inx_lo,0,None)]
+    right       = right[np.clip(inx_hi,None,len(epochVec)-1)]
+
+    interpArr   = _interp_valid(epochVec,data,newEpochVec[:,None,None],left,right,np.nan)
+    interpArr[:,np.sum(good,axis=0) < 2] = 0.
+
+    newDataSet = currentData.copy(newDataSetName,comment)
+    newDataSet.time = newTimeVec
+    newDataSet.data = interpArr
+    newDataSet.setActive()
+
+# Methods FIRFilter.filter() can apply the filter with.
+FILTER_METHODS = ['fft','direct']
+
+class FIRFilter(music.filter):
+    """
+    The FIR filter of pyDARNmusic's music.filter, designed from the sample
+    rate, number of taps and cutoffs alone so that one design can be applied
+    to many events. Use get_fir_filter() to get a cached design, or
+    fir_filter() to filter a data set with one.
+
+    The plotting methods are music.filter's. save_plot() renders each
+    figure once and copies the file for later events.
+    """
+    def __init__(self,nyq,numtaps,cutoff_low=None,cutoff_high=None,window='blackman'):
+        if cutoff_high is None and cutoff_low is None:
+            raise ValueError('You must define cutoff frequencies!')
+
+        numtaps = int(numtaps)
+        ntb2    = numtaps//2
+        if cutoff_high is not None:     #Low pass
+            lp  = signal.firwin(numtaps=numtaps,cutoff=cutoff_high,window=window,fs=2*nyq)
+            d   = lp
+
+        if cutoff_low is not None:      #High pass
+            hp          = -signal.firwin(numtaps=numtaps,cutoff=cutoff_low,window=window,fs=2*nyq)
+            hp[ntb2]    = hp[ntb2] + 1
+            d = hp
+
+        if cutoff_high is not None and cutoff_low is not None:
+            d           = -(lp+hp)
+            d[ntb2]     = d[ntb2] + 1
+            d           = -1.*d #Needed to correct 180 deg phase shift.
+
+        self.comment = ' '.join(['Filter:',window+',','Nyquist:',str(nyq),'Hz,','Cuttoff:','['+str(cutoff_low)+', '+str(cutoff_high)+']','Hz,','Numtaps:',str(numtaps)])
+        self.cutoff_low     = cutoff_low
+        self.cutoff_high    = cutoff_high
+        self.nyq            = nyq
+        self.ir             = d
+        self.ir.flags.writeable = False
+        self.plot_files     = {}
+
+    def filter(self,dataObj,dataSet='active',newDataSetName='filtered',method='fft'):
+        """
+        Filter a data set along time into a new active data set, as
+        music.filter.filter() does, but on the whole (time, beam, gate)
+        array at once.
+
+        method: 'fft' for overlap-add FFT convolution (scipy.signal.oaconvolve)
+            or 'direct' for scipy.signal.lfilter(). Data with NaNs is always
+            filtered directly, since the FFT would spread them through the
+            whole time series.
+        """
+        if method not in FILTER_METHODS:
+            raise ValueError('Unknown filter method: {!s}'.format(method))
+
+        sigobj  = getattr(dataObj,dataSet)
+        nrTimes = sigobj.data.shape[0]
+
+        # Shift the output back by half the filter length, as music.filter
+        # does; the last half filter length is not valid.
+        shift   = -int(len(self.ir)//2)
+        tinx0   = abs(shift)
+        tinx1   = shift % nrTimes
+
+        if method == 'fft' and np.isfinite(sigobj.data).all():
+            ir      = self.ir.reshape((-1,)+(1,)*(sigobj.data.ndim-1))
+            filteredData = signal.oaconvolve(sigobj.data,ir,mode='full',axes=0)[:nrTimes]
+        else:
+            filteredData = signal.lfilter(self.ir,[1.0],sigobj.data,axis=0)
+        filteredData = np.roll(filteredData,shift,axis=0)
+
+        newsigobj       = sigobj.copy(newDataSetName,self.comment)
+        newsigobj.data  = filteredData
+        newsigobj.time  = copy.copy(sigobj.time)
+
+        for key in ['ymin','ymax','ylim']:
+            newsigobj.metadata.pop(key,None)
+
+        newsigobj.metadata['timeLimits'] = (sigobj.time[tinx0],sigobj.time[tinx1])
+
+        key = 'title'
+        if key in newsigobj.metadata:
+            newsigobj.metadata[key] = ' '.join(['Filtered',newsigobj.metadata[key]])
+        else:
+            newsigobj.metadata[key] = 'Filtered'
+
+        newsigobj.metadata['fir_filter'] = (self.cutoff_low,self.cutoff_high)
+        newsigobj.setActive()
+
+    def save_plot(self,plot_type,fileName,figsize=(20,10)):
+        """
+        Save the 'impulseResponse' or 'transferFunction' figure of the
+        filter to fileName. The figure is only rendered the first time;
+        after that the first file is copied.
+        """
+        src = self.plot_files.get(plot_type)
+        if src is not None and os.path.exists(src):
+            if os.path.abspath(src) != os.path.abspath(fileName):
+                shutil.copyfile(src,fileName)
+            return
+
+        fig = plt.figure(figsize=figsize)
+        if plot_type == 'impulseResponse':
+            self.plotImpulseResponse(fig=fig)
+        elif plot_type == 'transferFunction':
+            self.plotTransferFunction(fig=fig,xmax=0.004)
+        else:
+            plt.close(fig)
+            raise ValueError('Unknown filter plot: {!s}'.format(plot_type))
+        fig.savefig(fileName,bbox_inches='tight')
+        plt.close(fig)
+        self.plot_files[plot_type] = fileName
+
+# FIR filter designs, so that a season of events with the same sample
+# period, taps and cutoffs designs the filter and makes its plots once.
+_filter_cache       = collections.OrderedDict()
+_filter_cache_size  = 8
+
+def get_fir_filter(samplePeriod,numtaps,cutoff_low=None,cutoff_high=None,window='blackman'):
+    """
+    Returns the cached FIRFilter for a sample period [s], number of taps and
+    cutoffs [Hz].
+    """
+    key     = (float(samplePeriod),int(numtaps),cutoff_low,cutoff_high,window)
+    filt    = _filter_cache.get(key)
+    if filt is None:
+        filt    = FIRFilter(1./(2*float(samplePeriod)),numtaps,cutoff_low,cutoff_high,window)
+
+    _filter_cache[key] = filt
+    _filter_cache.move_to_end(key)
+    while len(_filter_cache) > _filter_cache_size:
+        _filter_cache.popitem(last=False)
+    return filt
+
+def fir_filter(dataObj,dataSet='active',numtaps=None,cutoff_low=None,cutoff_high=None,
+        window='blackman',method='fft'):
+    """
+    Drop-in for music.filter(): filter a data set with the cached design
+    from get_fir_filter(). Taps and cutoffs that are None are taken from
+    the data set metadata, as music.filter() does. Returns the FIRFilter.
+    """
+    sigObj  = getattr(dataObj,dataSet)
+    md      = sigObj.metadata
+    if cutoff_high is None:
+        cutoff_high = md.get('filter_cutoff_high')
+    if cutoff_low is None:
+        cutoff_low  = md.get('filter_cutoff_low')
+    if numtaps is None:
+        numtaps     = md.get('filter_numtaps')
+    if numtaps is None:
+        raise ValueError('You must provide numtaps.')
+
+    filt    = get_fir_filter(sigObj.samplePeriod(),numtaps,cutoff_low,cutoff_high,window)
+    filt.filter(dataObj,dataSet=dataSet,method=method)
+    return filt
+
+# Taper windows for each data shape, so that a season of events with the
+# same grid computes them once.
+_taper_cache        = collections.OrderedDict()
+_taper_cache_size   = 8
+
+def get_taper_windows(shape,window='hann',time=True,space=True):
+    """
+    Returns the (time window, beam x gate window) of taper_data() for a
+    (nrTimes, nrBeams, nrGates) data shape, shaped to broadcast against the
+    data. Either is None if that taper is off. The arrays are cached and
+    read-only.
+    """
+    key     = (tuple(shape),window,bool(time),bool(space))
+    wins    = _taper_cache.get(key)
+    if wins is None:
+        nrTimes, nrBeams, nrGates = shape
+        win_time    = None
+        win_space   = None
+        if time:
+            win_time    = signal.get_window(window,nrTimes,fftbins=False)
+            win_time.shape = (nrTimes,1,1)
+            win_time.flags.writeable = False
+        if space:
+            win_beam    = signal.get_window(window,nrBeams,fftbins=False)
+            win_gate    = signal.get_window(window,nrGates,fftbins=False)
+            win_space   = np.outer(win_beam,win_gate)
+            win_space.shape = (1,nrBeams,nrGates)
+            win_space.flags.writeable = False
+        wins = (win_time,win_space)
+
+    _taper_cache[key] = wins
+    _taper_cache.move_to_end(key)
+    while len(_taper_cache) > _taper_cache_size:
+        _taper_cache.popitem(last=False)
+    return wins
+
+def taper_data(dataObj,dataSet='active',time=True,space=True,window='hann'):
+    """
+    Apply the time window of pyDARNmusic.windowData() and the beam and gate
+    windows as one separable taper. Only one new data
+    set ('windowed') is made, and the windows are applied to it in place.
+    """
+    if not time and not space:
+        return
 
-    new_sig      = dataObj.active.copy('windowed_beam','Windowed Beam Dimension')
-    new_sig.data = win*dataObj.active.data
+    currentData = pyDARNmusic.getDataSet(dataObj,dataSet)
+    currentData = currentData.applyLimits()
+    win_time, win_space = get_taper_windows(currentData.data.shape,window,time,space)
+
+    dims    = []
+    if time:
+        dims.append('Time')
+    if space:
+        dims += ['Beam','Gate']
+    comment = '{!s} window applied ({!s})'.format(window.capitalize(),', '.join(dims))
+
+    new_sig = currentData.copy('windowed',comment)
+    if win_time is not None:
+        new_sig.data   *= win_time
+    if win_space is not None:
+        new_sig.data   *= win_space
     new_sig.setActive()
 
-def run_music_init_param_file(filename):
-    init_params = read_init_param_file(filename)
-    run_music(**init_params)
+def _restore_hdf5_value(val):
+    if isinstance(val,bytes):
+        val = val.decode('utf-8')
+    if isinstance(val,str):
+        if val == 'None':
+            return None
+        try:
+            return datetime.datetime.fromisoformat(val)
+        except ValueError:
+            pass
+    return val
 
-def mark_process_level(level,radar,sTime,eTime,data_path='music_data/music',
-    filename='processing_level_completed.txt',**kwargs):
+def _restore_hdf5_data_set(currentData):
+    """
+    Undo the string conversion hdf5_api applies to metadata scalars, FOV
+    labels and history keys so that a loaded data set can be processed
+    further.
+    """
+    for key,val in currentData.metadata.items():
+        currentData.metadata[key] = _restore_hdf5_value(val)
 
-    music_path  = get_output_path(radar,sTime,eTime,data_path=data_path)
-    filepath    = os.path.join(music_path,filename)
+    for key,val in currentData.fov.items():
+        if isinstance(val,(bytes,str)):
+            currentData.fov[key] = _restore_hdf5_value(val)
 
-    with open(filepath,'w') as fl:
-        fl.write(level)
-    return
+    history = {}
+    for key,val in currentData.history.items():
+        history[_restore_hdf5_value(key)] = _restore_hdf5_value(val)
+    currentData.history = history
+    return currentData
 
-def get_process_level(radar,sTime,eTime,data_path='music_data/music',
-    filename='processing_level_completed.txt',**kwargs):
+def get_resume_dataObj(radar,sTime,eTime,data_path='music_data/music',param_hash=None):
+    """
+    Load the saved musicArray of an event so that run_music() can continue
+    from the last completed ProcessLevel.
 
-    music_path  = get_output_path(radar,sTime,eTime,data_path=data_path)
-    filepath    = os.path.join(music_path,filename)
+    Returns (dataObj, run_params, completed_process_level), or None if the
+    event cannot be resumed: nothing usable has been saved (the event must
+    have reached at least rti_interp), or the saved run parameters do not
+    match param_hash.
+    """
+    completed   = get_resume_level(radar,sTime,eTime,data_path=data_path,param_hash=param_hash)
+    if completed == ProcessLevel('None'):
+        return None
 
-    if not os.path.exists(filepath):
-        return ProcessLevel(None)
+    hdf5_path   = get_hdf5_name(radar,sTime,eTime,data_path=data_path,getPath=True)
+    run_params  = read_runfile(hdf5_path)
+    dataObj     = load_saved_dataObj(hdf5_path)
+    if dataObj is None:
+        return None
 
-    with open(filepath,'r') as fl:
-        completed_process_level = fl.readline()
+    return dataObj, run_params, completed
 
-    return ProcessLevel(completed_process_level)
+def get_resume_level(radar,sTime,eTime,data_path='music_data/music',param_hash=None):
+    """
+    The ProcessLevel get_resume_dataObj() would resume an event from, or
+    ProcessLevel('None') if it cannot be resumed. Only the level and run
+    files are read, not the saved data.
+    """
+    completed   = get_process_level(radar,sTime,eTime,data_path=data_path)
+    if completed < ProcessLevel('rti_interp'):
+        return ProcessLevel('None')
 
-def run_music(radar,sTime,eTime,
-    process_level           = 'music',
-    make_plots              = True,
-    data_path               = 'music_data/music',
-    fovModel                = 'GS',
-    gscat                   = 1,
-    boxcar_filter           = True,
-    auto_range_on           = True,
-    bad_range_km            = None,
-    beam_limits             = (None, None),
-    gate_limits             = (0,80),
-    interp_resolution       = 60.,
-    filter_numtaps          = 101.,
-    filter_cutoff_low       = 0.0003,
-    filter_cutoff_high      = 0.0012,
-    detrend                 = True,
-    hanning_window_space    = True,
-    hanning_window_time     = True,
-    zeropad                 = True,
-    kx_max                  = 0.05,
-    ky_max                  = 0.05,
-    autodetect_threshold    = 0.35,
-    neighborhood            = (10,10),
-    mstid_list              = None,
-    db_name                 = 'mstid',
-    mongo_port              = 27017,
-    srcPath                 = None,
-    fitacf_dir              = '/sd-data',
-    **kwargs):
+    hdf5_path   = get_hdf5_name(radar,sTime,eTime,data_path=data_path,getPath=True)
+    json_path   = hdf5_path[:-2] + 'runfile.json'
+    if not os.path.exists(hdf5_path) or not os.path.exists(json_path):
+        return ProcessLevel('None')
+
+    run_params = read_runfile(hdf5_path)
+    if param_hash is not None and run_params.get('param_hash') != param_hash:
+        print('Run parameters changed; not resuming {!s}'.format(hdf5_path))
+        return ProcessLevel('None')
 
+    return completed
+
+def needs_raw_data(params):
     """
-    bad_range_km: Reject ranges less than this in GS Mapped Range
-        For MSTID Index Calculation, set to None.
-        For MUSIC Calculation, set to 500 km to get past FOV distortion.
+    True if run_music(**params) will read the fitacf data for its event,
+    i.e. unless params has resume set and the event can be resumed from its
+    saved HDF5 file (see get_resume_level()).
     """
-    
-    print(datetime.datetime.now(), 'Processing: ', radar, sTime)
+    if not params.get('resume',False):
+        return True
+    level   = get_resume_level(params['radar'],params['sTime'],params['eTime'],
+                data_path=params.get('data_path','music_data/music'),
+                param_hash=get_param_hash(params))
+    return level == ProcessLevel('None')
+
+def load_saved_dataObj(hdf5_path):
+    """
+    Load a musicArray saved by run_music() so that it can be processed or
+    plotted further. Returns None if the file does not exist.
+    """
+    if not os.path.exists(hdf5_path):
+        return None
 
-    process_level   = ProcessLevel(str(process_level))
-    music_path  = get_output_path(radar, sTime, eTime,data_path=data_path,create=True)
-    hdf5_path = get_hdf5_name(radar,sTime,eTime,data_path=data_path,getPath=True)
+    dataObj = loadMusicArrayFromHDF5(hdf5_path)
+    if dataObj is None:
+        return None
+
+    # The saved 'active' group is a copy; point active back at the last data set.
+    data_sets = dataObj.get_data_sets()
+    for data_set in data_sets:
+        _restore_hdf5_data_set(getattr(dataObj,data_set))
+    getattr(dataObj,data_sets[-1]).setActive()
+
+    return dataObj
+
+def read_runfile(hdf5_path):
+    """
+    Read the runfile.json written next to a run_music() HDF5 file and return
+    the run parameters with sTime and eTime as datetimes.
+    """
+    json_path   = hdf5_path[:-2] + 'runfile.json'
+    with open(json_path,'r') as fl:
+        run_params = json.load(fl)
 
+    for key in ['sTime','eTime']:
+        run_params[key] = datetime.datetime.fromisoformat(run_params[key])
+    return run_params
+
+def run_music_init_param_file(filename,dataObj_day=None,fft_batch=None,auto_gate_limits=None,log_path=None):
+    init_params = read_init_param_file(filename)
+    run_music(dataObj_day=dataObj_day,fft_batch=fft_batch,auto_gate_limits=auto_gate_limits,
+            init_file=filename,log_path=log_path,**init_params)
+
+def load_event_dataObj(radar,sTime,eTime,music_path,timer,
+        data_path           = 'music_data/music',
+        fovModel            = 'GS',
+        gscat               = 1,
+        boxcar_filter       = True,
+        auto_range_on       = True,
+        bad_range_km        = None,
+        beam_limits         = (None, None),
+        gate_limits         = (0,80),
+        interp_resolution   = 60.,
+        filter_numtaps      = 101.,
+        db_name             = 'mstid',
+        mongo_port          = 27017,
+        srcPath             = None,
+        fitacf_dir          = '/sd-data',
+        dataObj_day         = None,
+        fov_cache_dir       = fov_cache.FOV_CACHE_DIR,
+        rti_engine          = 'pyDARNmusic',
+        auto_gate_limits    = None):
+    """
+    Start a run_music() run that is not resumed: clear the event directory,
+    load the data and run the basic quality checks, the boxcar filter and
+    auto_range(). The arguments are those of run_music().
+
+    Returns (dataObj, gate_limits, good, reject_messages).
+    """
     prepare_output_dirs({0:music_path},clear_output_dirs=True)
+    # The old output is gone; so is any record of it having been processed.
+    if db_name is not None:
+        mongo_tools.clear_process_state(radar,sTime,eTime,data_path=data_path,
+                db_name=db_name,mongo_port=mongo_port)
+    timer.start('load')
 
     good            = True
     reject_messages = []
@@ -547,6 +1712,8 @@ def run_music(radar,sTime,eTime,
             ,fovModel                   = fovModel
             ,gscat                      = gscat
             ,fitacf_dir                 = fitacf_dir
+            ,dataObj_day                = dataObj_day
+            ,fov_cache_dir              = fov_cache_dir
             )
 #    except:
 #        dataObj = None
@@ -554,6 +1721,7 @@ def run_music(radar,sTime,eTime,
 #        good    = False
 
     # Basic Data Quality Check #####################################################
+    timer.start('quality_check')
     if good:
         if hasattr(dataObj,'messages'):
             messages            = '\n'.join([music_path]+dataObj.messages)
@@ -586,12 +1754,21 @@ def run_music(radar,sTime,eTime,
             good = False
 
     if boxcar_filter and good:
-        pyDARNmusic.boxcarFilter(dataObj)
+        timer.start('boxcarFilter')
+        if rti_engine == 'mstid':
+            boxcar_filter_data(dataObj)
+        else:
+            pyDARNmusic.boxcarFilter(dataObj)
 
     # Determine auto-range if called for. ########################################## 
     if auto_range_on and good:
+        timer.start('auto_range')
         try:
-            gate_limits = auto_range(radar,sTime,eTime,dataObj,bad_range_km=bad_range_km)
+            if auto_gate_limits is not None:
+                gate_limits = tuple(auto_gate_limits)
+                dataObj.DS000_originalFit.metadata['gateLimits'] = gate_limits
+            else:
+                gate_limits = auto_range(radar,sTime,eTime,dataObj,bad_range_km=bad_range_km)
             pyDARNmusic.defineLimits(dataObj,gateLimits=gate_limits)
         except:
             reject_messages.append('auto_range() computation error.')
@@ -618,8 +1795,294 @@ def run_music(radar,sTime,eTime,
 #            reject_messages.append('auto_range() failed! There may not be enough good gates in this period.')
 #            good = False
 
+    return dataObj, gate_limits, good, reject_messages
+
+# run_music() arguments that change the processing results.
+PARAM_HASH_KEYS = ['fovModel','gscat','boxcar_filter','auto_range_on','bad_range_km',
+    'beam_limits','gate_limits','interp_resolution','filter_numtaps',
+    'filter_cutoff_low','filter_cutoff_high','detrend','hanning_window_space',
+    'hanning_window_time','zeropad','kx_max','ky_max','autodetect_threshold',
+    'neighborhood','srcPath','fitacf_dir']
+
+def get_param_hash(params):
+    """
+    Return an md5 hash of the run_music() parameters in PARAM_HASH_KEYS.
+    Parameters missing from params take the run_music() default, so an
+    initialization file and the equivalent run_music() call hash the same.
+    """
+    def normalize(val):
+        if isinstance(val,(list,tuple,np.ndarray)):
+            return [normalize(x) for x in val]
+        if isinstance(val,(int,float,np.integer,np.floating)) and not isinstance(val,(bool,np.bool_)):
+            return float(val)
+        return val
+
+    defaults    = inspect.signature(run_music).parameters
+    hash_dict   = {}
+    for key in PARAM_HASH_KEYS:
+        val = params[key] if key in params else defaults[key].default
+        hash_dict[key] = normalize(val)
+
+    txt = json.dumps(hash_dict,sort_keys=True,cls=NumpyEncoder)
+    return hashlib.md5(txt.encode('utf-8')).hexdigest()
+
+def get_radar_size(radar):
+    """
+    Returns (number of beams, number of range gates) of a radar from the
+    pyDARN hardware files.
+    """
+    import pydarn
+    for rad in pydarn.utils.superdarn_radars.SuperDARNRadars.radars.values():
+        if rad.hardware_info.abbrev == radar.lower():
+            return rad.hardware_info.beams, rad.hardware_info.gates
+    return 24, 110
+
+def estimate_event_mem_mb(radar,sTime,eTime,process_level='music',
+        interp_resolution=60.,filter_numtaps=101.,gate_limits=(0,80),
+        zeropad=True,retain_data_sets='all',make_plots=True,plot_types=None,
+        day_hours=0.,base_mb=400.,**kwargs):
+    """
+    Rough estimate of the peak memory (MB) run_music() needs for an event:
+    base_mb plus beams x gates x time samples x retained data sets, at 8
+    bytes per float and 16 per complex value. At the music level the
+    (beams*gates)^2 cross spectral matrix is added.
+
+    retain_data_sets, make_plots, plot_types: As in run_music(). Intermediate
+                    data sets that are not retained (see get_retain_list())
+                    only count while the next stage uses them.
+    day_hours:  Length of the radar-day loaded by load_music_day() that is
+                    held in memory next to the event, if batching by day.
+    """
+    process_level   = ProcessLevel(str(process_level))
+    n_beams, n_gates_hdw = get_radar_size(radar)
+
+    n_gates = n_gates_hdw
+    if gate_limits is not None and gate_limits[1] is not None:
+        n_gates = min(n_gates_hdw,gate_limits[1] - (gate_limits[0] or 0) + 1)
+
+    if interp_resolution is None:
+        interp_resolution = 60.
+    if filter_numtaps is None:
+        filter_numtaps = 0.
+    window_s    = (eTime - sTime).total_seconds()
+    n_window    = window_s / interp_resolution
+    n_padded    = n_window + filter_numtaps
+
+    cells_hdw   = n_beams * n_gates_hdw
+    cells       = n_beams * n_gates
+
+    # originalFit plus the day it was sliced from.
+    n_values    = cells_hdw * (n_padded + day_hours*3600./interp_resolution)
+
+    # Intermediate data sets, in the order they are made.
+    data_sets   = []
+    if process_level >= ProcessLevel('rti_interp'):
+        for name in ['limitsApplied','beamInterpolated','timeInterpolated','nan_to_num']:
+            data_sets.append((name,cells * n_padded))
+    if process_level >= ProcessLevel('fft'):
+        for name in ['filtered','limitsApplied','detrended','windowed']:
+            data_sets.append((name,cells * n_window))
+
+    retain      = get_retain_list(retain_data_sets,make_plots,plot_types)
+    if retain is None:
+        n_values   += sum([size for name,size in data_sets])
+    elif len(data_sets) > 0:
+        # The last data set is the active one and is always kept. A dropped
+        # data set lives until the next one has been made from it.
+        kept        = [size for name,size in data_sets[:-1] if any([name.endswith(x) for x in retain])]
+        dropped     = [size for name,size in data_sets[:-1] if not any([name.endswith(x) for x in retain])]
+        n_values   += sum(kept) + data_sets[-1][1] + sum(sorted(dropped)[-2:])
+
+    if process_level >= ProcessLevel('fft'):
+        # Complex spectrum, zero padded inside the transform.
+        n_fft       = get_zeropad_nfft(n_window,zeropad)
+        n_values   += 2 * cells * n_fft
+    if process_level >= ProcessLevel('music'):
+        # Complex Dlm matrix and its eigenvectors.
+        n_values   += 2 * 2 * cells**2
+
+    return base_mb + n_values * 8. / 1024.**2
+
+def mark_process_level(level,radar,sTime,eTime,data_path='music_data/music',
+    filename='processing_level_completed.txt',db_name=None,mongo_port=27017,
+    param_hash=None,**kwargs):
+    """
+    Record the completed processing level of an event in its output
+    directory and, if db_name is given, in the processing_state collection
+    used by mongo_tools.events_from_mongo().
+    """
+
+    music_path  = get_output_path(radar,sTime,eTime,data_path=data_path)
+    filepath    = os.path.join(music_path,filename)
+
+    with open(filepath,'w') as fl:
+        fl.write(level)
+
+    if db_name is not None:
+        mongo_tools.update_process_state(level,radar,sTime,eTime,data_path=data_path,
+                param_hash=param_hash,db_name=db_name,mongo_port=mongo_port)
+    return
+
+def get_process_level(radar,sTime,eTime,data_path='music_data/music',
+    filename='processing_level_completed.txt',**kwargs):
+
+    music_path  = get_output_path(radar,sTime,eTime,data_path=data_path)
+    filepath    = os.path.join(music_path,filename)
+
+    if not os.path.exists(filepath):
+        return ProcessLevel(None)
+
+    with open(filepath,'r') as fl:
+        completed_process_level = fl.readline()
+
+    return ProcessLevel(completed_process_level)
+
+def run_music(radar,sTime,eTime,
+    process_level           = 'music',
+    make_plots              = True,
+    data_path               = 'music_data/music',
+    fovModel                = 'GS',
+    gscat                   = 1,
+    boxcar_filter           = True,
+    auto_range_on           = True,
+    bad_range_km            = None,
+    beam_limits             = (None, None),
+    gate_limits             = (0,80),
+    interp_resolution       = 60.,
+    filter_numtaps          = 101.,
+    filter_cutoff_low       = 0.0003,
+    filter_cutoff_high      = 0.0012,
+    detrend                 = True,
+    hanning_window_space    = True,
+    hanning_window_time     = True,
+    zeropad                 = True,
+    kx_max                  = 0.05,
+    ky_max                  = 0.05,
+    autodetect_threshold    = 0.35,
+    neighborhood            = (10,10),
+    mstid_list              = None,
+    db_name                 = 'mstid',
+    mongo_port              = 27017,
+    srcPath                 = None,
+    fitacf_dir              = '/sd-data',
+    dataObj_day             = None,
+    resume                  = False,
+    plot_types              = None,
+    instrument              = False,
+    trace_memory            = False,
+    retain_data_sets        = 'all',
+    fft_batch               = None,
+    music_engine            = 'pyDARNmusic',
+    filter_method           = 'fft',
+    fov_cache_dir           = fov_cache.FOV_CACHE_DIR,
+    rti_engine              = 'pyDARNmusic',
+    hdf5_storage            = 'none',
+    auto_gate_limits        = None,
+    init_file               = None,
+    log_path                = None,
+    **kwargs):
+
+    """
+    bad_range_km: Reject ranges less than this in GS Mapped Range
+        For MSTID Index Calculation, set to None.
+        For MUSIC Calculation, set to 500 km to get past FOV distortion.
+    dataObj_day: Optional musicArray from load_music_day() covering this
+        event. Used to avoid re-reading fitacf files for every window.
+    auto_gate_limits: Gate limits auto_range_batch() found for this event
+        in dataObj_day, used instead of running auto_range() on the event.
+    resume: If True and the event has already been processed to a lower
+        ProcessLevel with the same run parameters, load the saved HDF5 file
+        and only run the remaining stages (see get_resume_dataObj()).
+    make_plots: True to make the figures at the end of the run, False for no
+        figures, or 'deferred' to leave them to mstid.render_queue, which
+        makes them later from the saved HDF5 file.
+    plot_types: List of figures to make; see MUSIC_PLOT_TYPES. The filter
+        figures are 'impulseResponse' and 'transferFunction'. None makes all.
+    instrument: Record the wall time, CPU time and memory of each processing
+        stage (see mstid.stage_timer). 'file' (or True) writes them to
+        stage_timing.json in the event directory, 'mongo' to the event's
+        MongoDB document, and 'both' to both.
+    trace_memory: With instrument, also record the peak Python allocation
+        of each stage with tracemalloc.
+    retain_data_sets: Which intermediate data sets (limitsApplied,
+        beamInterpolated, ..., windowed) to keep in memory and in the HDF5
+        file. 'all' keeps every one. 'lean' keeps only DS000_originalFit
+        and the active data set, which holds the spectrum and MUSIC
+        results, and drops each intermediate data set as soon as the next
+        stage has used it. A list of data set names (e.g.
+        ['beamInterpolated']) keeps those as well. Data sets needed by
+        inline plots are always kept; see MUSIC_PLOT_DATA_SETS.
+    fft_batch: An FFTBatch. At the fft process level the event is added to
+        it after the taper, and its spectrum is calculated and the run
+        finished when the batch is flushed. Not used at the music level.
+    init_file, log_path: The initialization file of the run and its log
+        file. fft_batch reports a failed event by init_file (or its output
+        path) and logs the deferred end of the run to log_path.
+    music_engine: 'pyDARNmusic' to calculate Dlm and karr with
+        pyDARNmusic.calculateDlm(), calculateKarr() and detectSignals(), or
+        'mstid' for the vectorized calculate_dlm(), calculate_karr() and
+        detect_signals(). When an event has fewer positive frequencies than
+        range-beam cells the engines' karr differ by ~10% and the signal
+        peaks can move by one kx/ky grid step; see calculate_karr().
+    filter_method: How the FIR filter is applied; see FIRFilter.filter().
+        The filter is designed once for each sample period, number of taps
+        and cutoffs (see get_fir_filter()), and its figures are only
+        rendered for the first event that uses the design.
+    fov_cache_dir: Directory of the FOV geometry cache used when loading
+        fitacf files (see mstid.fov_cache). None turns the cache off.
+    rti_engine: 'pyDARNmusic' for pyDARNmusic.boxcarFilter(),
+        beamInterpolation() and timeInterpolation(), or 'mstid' for the
+        array-at-once boxcar_filter_data(), beam_interpolation() and
+        time_interpolation().
+    hdf5_storage: Storage profile of the large arrays in the saved HDF5
+        file: 'none', 'lzf' or 'gzip' (see hdf5_api.STORAGE_PROFILES).
+    """
+    if music_engine not in MUSIC_ENGINES:
+        raise ValueError('Unknown music_engine: {!s}'.format(music_engine))
+    if filter_method not in FILTER_METHODS:
+        raise ValueError('Unknown filter_method: {!s}'.format(filter_method))
+    if rti_engine not in RTI_ENGINES:
+        raise ValueError('Unknown rti_engine: {!s}'.format(rti_engine))
+    if hdf5_storage not in STORAGE_PROFILES:
+        raise ValueError('Unknown hdf5_storage: {!s}'.format(hdf5_storage))
+
+    param_hash  = get_param_hash(locals())
+    timer       = StageTimer(enabled=bool(instrument),trace_memory=trace_memory)
+    retain      = get_retain_list(retain_data_sets,make_plots,plot_types)
+    
+    print(datetime.datetime.now(), 'Processing: ', radar, sTime)
+
+    process_level   = ProcessLevel(str(process_level))
+    music_path  = get_output_path(radar, sTime, eTime,data_path=data_path,create=True)
+    hdf5_path = get_hdf5_name(radar,sTime,eTime,data_path=data_path,getPath=True)
+
+    # Pick up from the saved data if possible. #####################################
+    resume_from = ProcessLevel('None')
+    if resume:
+        timer.start('resume_load')
+        resume_state = get_resume_dataObj(radar,sTime,eTime,data_path=data_path,param_hash=param_hash)
+        if resume_state is not None:
+            dataObj, resume_params, resume_from = resume_state
+            if resume_from >= process_level:
+                print('Already processed to {!s}: {!s}'.format(resume_from,music_path))
+                return
+            gate_limits = resume_params['gate_limits']
+            print('Resuming from {!s}: {!s}'.format(resume_from,music_path))
+            prune_data_sets(dataObj,retain)
+
+    good            = True
+    reject_messages = []
+    if resume_from == ProcessLevel('None'):
+        dataObj, gate_limits, good, reject_messages = load_event_dataObj(radar,sTime,eTime,music_path,timer,
+                data_path=data_path,fovModel=fovModel,gscat=gscat,boxcar_filter=boxcar_filter,
+                auto_range_on=auto_range_on,bad_range_km=bad_range_km,beam_limits=beam_limits,
+                gate_limits=gate_limits,interp_resolution=interp_resolution,
+                filter_numtaps=filter_numtaps,db_name=db_name,mongo_port=mongo_port,
+                srcPath=srcPath,fitacf_dir=fitacf_dir,dataObj_day=dataObj_day,
+                fov_cache_dir=fov_cache_dir,rti_engine=rti_engine,auto_gate_limits=auto_gate_limits)
 
     # Create a run file. ###########################################################
+    timer.start('runfile')
     run_params = {}
     run_params['radar']                 = radar.lower()
     run_params['sTime']                 = sTime
@@ -641,97 +2104,226 @@ def run_music(radar,sTime,eTime,
     run_params['ky_max']                = ky_max
     run_params['autodetect_threshold']  = autodetect_threshold
     run_params['neighborhood']          = neighborhood
+    run_params['param_hash']            = param_hash
+    run_params['retain_data_sets']      = retain_data_sets
+    run_params['music_engine']          = music_engine
+    run_params['filter_method']         = filter_method
+    run_params['rti_engine']            = rti_engine
+    run_params['hdf5_storage']          = hdf5_storage
     runfile = Runfile(radar.lower(), sTime, eTime, run_params,data_path=data_path)
 
     completed_process_level = 'rti'
+    if resume_from > ProcessLevel('None'):
+        completed_process_level = str(resume_from)
 
     # If basic data quality check fails, save what we have and return. ############# 
     if not good:
         print('\n'.join(reject_messages))
         if db_name is not None:
+            timer.start('mongo_update')
             mongo_tools.dataObj_update_mongoDb(radar,sTime,eTime,dataObj,
                     mstid_list,db_name,mongo_port)
-        saveMusicArrayToHDF5(dataObj, hdf5_path)
+        timer.start('save_hdf5')
+        saveMusicArrayToHDF5(dataObj, hdf5_path, storage=hdf5_storage)
         # Mark processing at MUSIC level to prevent trying to process again.
-        mark_process_level('music',**run_params)
+        mark_process_level('music',db_name=db_name,mongo_port=mongo_port,**run_params)
+        save_stage_timing(timer,instrument,run_params,mstid_list,db_name,mongo_port)
         return
 
     # Now do the processing. #######################################################
-    if process_level >= ProcessLevel('rti_interp'):
+    defer_fft   = False
+    if process_level >= ProcessLevel('rti_interp') and resume_from < ProcessLevel('rti_interp'):
+        timer.start('applyLimits')
         dataObj.active.applyLimits()
 
-        pyDARNmusic.beamInterpolation(dataObj,dataSet='limitsApplied')
+        timer.start('beamInterpolation')
+        if rti_engine == 'mstid':
+            beam_interpolation(dataObj,dataSet='limitsApplied')
+        else:
+            pyDARNmusic.beamInterpolation(dataObj,dataSet='limitsApplied')
+        prune_data_sets(dataObj,retain)
+        timer.start('determineRelativePosition')
         pyDARNmusic.determineRelativePosition(dataObj)
 
-        pyDARNmusic.timeInterpolation(dataObj,timeRes=interp_resolution)
+        timer.start('timeInterpolation')
+        if rti_engine == 'mstid':
+            time_interpolation(dataObj,timeRes=interp_resolution)
+        else:
+            pyDARNmusic.timeInterpolation(dataObj,timeRes=interp_resolution)
+        prune_data_sets(dataObj,retain)
+        timer.start('nan_to_num')
         pyDARNmusic.nan_to_num(dataObj)
+        prune_data_sets(dataObj,retain)
 
+        timer.start('terminator')
         calculate_terminator_for_dataSet(dataObj)
 
         completed_process_level = 'rti_interp'
 
-    if process_level >= ProcessLevel('fft'):
+    if process_level >= ProcessLevel('fft') and resume_from < ProcessLevel('fft'):
         if not filter_numtaps is None:
-            filt = music.filter(dataObj, dataSet='active', numtaps=filter_numtaps, cutoff_low=filter_cutoff_low, cutoff_high=filter_cutoff_high)
-
-            if make_plots:
-                figsize    = (20,10)
-                plotSerial = 999
-                fig = plt.figure(figsize=figsize)
-                filt.plotImpulseResponse(fig=fig)
-                fileName = os.path.join(music_path,'%03i_impulseResponse.png' % plotSerial)
-                fig.savefig(fileName,bbox_inches='tight')
-                plt.close(fig)
-
-                fig = plt.figure(figsize=figsize)
-                filt.plotTransferFunction(fig=fig,xmax=0.004)
-                fileName = os.path.join(music_path,'%03i_transferFunction.png' % plotSerial)
-                fig.savefig(fileName,bbox_inches='tight')
-                plt.close(fig)
+            timer.start('filter')
+            filt = fir_filter(dataObj, dataSet='active', numtaps=filter_numtaps, cutoff_low=filter_cutoff_low, cutoff_high=filter_cutoff_high, method=filter_method)
+            prune_data_sets(dataObj,retain)
+
+            # The filter object is not saved, so these can only be made inline.
+            plotSerial = 999
+            for plot_type in ['impulseResponse','transferFunction']:
+                if make_plots is True and (plot_types is None or plot_type in plot_types):
+                    fileName = os.path.join(music_path,'%03i_%s.png' % (plotSerial,plot_type))
+                    filt.save_plot(plot_type,fileName)
 
         if detrend:
+            timer.start('detrend')
             pyDARNmusic.detrend(dataObj, dataSet='active')
+            prune_data_sets(dataObj,retain)
 
         # Recalculate terminator because time vector changed.
+        timer.start('terminator')
         calculate_terminator_for_dataSet(dataObj)
 
-        if hanning_window_time:
-            pyDARNmusic.windowData(dataObj, dataSet='active')
-
-        if hanning_window_space:
-            window_beam_gate(dataObj)
-
-        if zeropad:
-            zeropad_data(dataObj)
-
-        # Recalculate terminator because time vector changed.
-        calculate_terminator_for_dataSet(dataObj)
-        pyDARNmusic.calculateFFT(dataObj)
+        if hanning_window_time or hanning_window_space:
+            timer.start('taper')
+            taper_data(dataObj,time=hanning_window_time,space=hanning_window_space)
+            prune_data_sets(dataObj,retain)
+
+        # Zero padding is done inside the transform, so the time vector and
+        # terminator of the active data set stay as they are.
+        nfft    = get_zeropad_nfft(dataObj.active.data.shape[0],zeropad)
+        if fft_batch is not None and process_level == ProcessLevel('fft'):
+            defer_fft = True
+            timer.stop()
+        else:
+            timer.start('calculateFFT')
+            calculate_fft(dataObj,nfft=nfft)
 
         completed_process_level = 'fft'
 
-    if process_level >= ProcessLevel('music'):
-        pyDARNmusic.calculateDlm(dataObj)
-        pyDARNmusic.calculateKarr(dataObj,kxMax=kx_max,kyMax=ky_max)
-        pyDARNmusic.detectSignals(dataObj,threshold=autodetect_threshold,neighborhood=neighborhood)
+    if process_level >= ProcessLevel('music') and resume_from < ProcessLevel('music'):
+        if music_engine == 'mstid':
+            timer.start('calculateDlm')
+            calculate_dlm(dataObj)
+            timer.start('calculateKarr')
+            calculate_karr(dataObj,kxMax=kx_max,kyMax=ky_max)
+        else:
+            timer.start('calculateDlm')
+            pyDARNmusic.calculateDlm(dataObj)
+            timer.start('calculateKarr')
+            pyDARNmusic.calculateKarr(dataObj,kxMax=kx_max,kyMax=ky_max)
+        timer.start('detectSignals')
+        if music_engine == 'mstid':
+            detect_signals(dataObj,threshold=autodetect_threshold,neighborhood=neighborhood)
+        else:
+            pyDARNmusic.detectSignals(dataObj,threshold=autodetect_threshold,neighborhood=neighborhood)
         sigs_to_txt(dataObj,music_path)
         completed_process_level = 'music'
 
-    # Save the data file. ##########################################################  
-    saveMusicArrayToHDF5(dataObj, hdf5_path)
+    def finish_run():
+        # Save the data file. ##########################################################  
+        timer.start('save_hdf5')
+        saveMusicArrayToHDF5(dataObj, hdf5_path, storage=hdf5_storage)
 
-    mark_process_level(completed_process_level,**run_params)
+        timer.start('mark_process_level')
+        mark_process_level(completed_process_level,db_name=db_name,mongo_port=mongo_port,**run_params)
 
-    # Update mongoDb. ############################################################## 
-    if db_name is not None:
-        mongo_tools.dataObj_update_mongoDb(radar,sTime,eTime,dataObj,
-                mstid_list,db_name,mongo_port)
+        # Update mongoDb. ############################################################## 
+        if db_name is not None:
+            timer.start('mongo_update')
+            mongo_tools.dataObj_update_mongoDb(radar,sTime,eTime,dataObj,
+                    mstid_list,db_name,mongo_port)
+
+        # Run MUSIC and Plotting Code ##################################################
+        if make_plots is True:
+            timer.start('plots')
+            music_plot_all(run_params,dataObj,process_level=process_level,plot_types=plot_types)
+
+        save_stage_timing(timer,instrument,run_params,mstid_list,db_name,mongo_port)
+
+    if defer_fft:
+        # The spectrum is calculated with the rest of the batch, which then
+        # calls finish_run().
+        fft_batch.add(dataObj,nfft,finish_run,
+                name=init_file if init_file is not None else music_path,log_path=log_path)
+        return
+    finish_run()
+
+def save_stage_timing(timer,instrument,run_params,mstid_list=None,db_name=None,mongo_port=27017):
+    """
+    Write the records of a run_music() StageTimer where the instrument
+    option asks for them.
+    """
+    if not instrument:
+        return
+    timer.stop()
+
+    if instrument in [True,'file','both']:
+        timer.write_json(os.path.join(run_params['music_path'],STAGE_TIMING_FILE))
+
+    if instrument in ['mongo','both'] and db_name is not None:
+        mongo_tools.update_stage_timing(run_params['radar'],run_params['sTime'],
+                run_params['eTime'],timer.records,mstid_list,db_name,mongo_port)
+
+def get_retain_list(retain_data_sets='all',make_plots=False,plot_types=None):
+    """
+    Convert the retain_data_sets option of run_music() into the list of
+    data set names for prune_data_sets(), or None to keep everything. Data
+    sets needed by inline plots are added to the list.
+    """
+    if retain_data_sets == 'all':
+        return None
+
+    if retain_data_sets == 'lean':
+        retain = []
+    else:
+        retain = list(retain_data_sets)
+
+    if make_plots is True:
+        for plot_type,data_sets in MUSIC_PLOT_DATA_SETS.items():
+            if plot_types is None or plot_type in plot_types:
+                retain += data_sets
+    return retain
+
+def prune_data_sets(dataObj,retain=None):
+    """
+    Delete the data sets of a musicArray except DS000_originalFit, the
+    active data set, and data sets whose names end with a name in retain.
+    retain=None keeps everything.
+    """
+    if retain is None:
+        return dataObj
+
+    active = getattr(dataObj,'active',None)
+    for data_set in dataObj.get_data_sets():
+        if data_set == 'DS000_originalFit' or getattr(dataObj,data_set) is active:
+            continue
+        if any([data_set.endswith(name) for name in retain]):
+            continue
+        delattr(dataObj,data_set)
+    return dataObj
 
-    # Run MUSIC and Plotting Code ##################################################
-    if make_plots:
-        music_plot_all(run_params,dataObj,process_level=process_level)
+# Plots made by music_plot_all(), in the order they are numbered. The names
+# match the end of the figure file names, e.g. 013_finalDataRTI.png.
+MUSIC_PLOT_TYPES = ['originalFit_RTI','beamInterp_fan','ranges','beamInterp',
+    'timeInterp','filtered','detrendedData','windowedData','spectrum','magnitude',
+    'phase','finalDataFan','finalDataRTI','fullSpectrum','dlm_abs','karr','karrDetected']
+
+# Intermediate data sets used by the plots, which are skipped if
+# run_music(retain_data_sets=...) did not keep them.
+MUSIC_PLOT_DATA_SETS = {}
+MUSIC_PLOT_DATA_SETS['beamInterp_fan']  = ['beamInterpolated']
+MUSIC_PLOT_DATA_SETS['ranges']          = ['beamInterpolated']
+MUSIC_PLOT_DATA_SETS['beamInterp']      = ['beamInterpolated','limitsApplied']
+MUSIC_PLOT_DATA_SETS['timeInterp']      = ['timeInterpolated','beamInterpolated']
+MUSIC_PLOT_DATA_SETS['filtered']        = ['filtered']
+
+def music_plot_all(run_params,dataObj,process_level='music',plot_types=None):
+    """
+    Make the standard set of figures for a MUSIC event.
 
-def music_plot_all(run_params,dataObj,process_level='music'):
+    plot_types: List of names from MUSIC_PLOT_TYPES to make. None makes all
+        of them. Figures keep the same file number whether or not the
+        figures before them are made.
+    """
     output_dir  = run_params['music_path']
     sTime       = run_params['sTime']
     eTime       = run_params['eTime']
@@ -739,23 +2331,33 @@ def music_plot_all(run_params,dataObj,process_level='music'):
 
     process_level   = ProcessLevel(str(process_level))
 
+    data_sets   = dataObj.get_data_sets()
+    def want(plot_type):
+        if plot_types is not None and plot_type not in plot_types:
+            return False
+        for name in MUSIC_PLOT_DATA_SETS.get(plot_type,[]):
+            if not any([data_set.endswith(name) for data_set in data_sets]):
+                return False
+        return True
+
     figsize     = (20,10)
     plotSerial  = 0
 
-    rti_xlim    = get_default_rti_times(run_params,dataObj)
-    rti_ylim    = get_default_gate_range(run_params,dataObj)
-    rti_beams   = get_default_beams(run_params,dataObj)
-
-    dataObj.DS000_originalFit.metadata['timeLimits'] = [sTime,eTime]
-    fileName = os.path.join(output_dir,'%03i_originalFit_RTI.png' % plotSerial)
-    plot_music_rti(dataObj,
-            fileName    = fileName,
-            dataSet     = "originalFit",
-            beam        = rti_beams,
-            xlim        = rti_xlim,
-            ylim        = rti_ylim)
-
-    dataObj.DS000_originalFit.metadata.pop('timeLimits',None)
+    if want('originalFit_RTI'):
+        rti_xlim    = get_default_rti_times(run_params,dataObj)
+        rti_ylim    = get_default_gate_range(run_params,dataObj)
+        rti_beams   = get_default_beams(run_params,dataObj)
+
+        dataObj.DS000_originalFit.metadata['timeLimits'] = [sTime,eTime]
+        fileName = os.path.join(output_dir,'%03i_originalFit_RTI.png' % plotSerial)
+        plot_music_rti(dataObj,
+                fileName    = fileName,
+                dataSet     = "originalFit",
+                beam        = rti_beams,
+                xlim        = rti_xlim,
+                ylim        = rti_ylim)
+
+        dataObj.DS000_originalFit.metadata.pop('timeLimits',None)
     plotSerial = plotSerial + 1
 
     if process_level == ProcessLevel('rti'):
@@ -765,125 +2367,141 @@ def music_plot_all(run_params,dataObj,process_level='music'):
         if not dataObj.active.metadata['good_period']:
             return
 
-    fig = plt.figure(figsize=figsize)
-    pyDARNmusic.plotting.musicPlot.musicFan(dataObj,plotZeros=True,dataSet='originalFit',time=time,fig=fig,subplot_tuple=(1,2,1))
-    pyDARNmusic.plotting.musicPlot.musicFan(dataObj,plotZeros=True,dataSet='beamInterpolated',time=time,fig=fig,subplot_tuple=(1,2,2))
-    fileName = os.path.join(output_dir,'%03i_beamInterp_fan.png' % plotSerial)
-    fig.savefig(fileName,bbox_inches='tight')
-    plt.close(fig)
+    if want('beamInterp_fan'):
+        fig = plt.figure(figsize=figsize)
+        pyDARNmusic.plotting.musicPlot.musicFan(dataObj,plotZeros=True,dataSet='originalFit',time=time,fig=fig,subplot_tuple=(1,2,1))
+        pyDARNmusic.plotting.musicPlot.musicFan(dataObj,plotZeros=True,dataSet='beamInterpolated',time=time,fig=fig,subplot_tuple=(1,2,2))
+        fileName = os.path.join(output_dir,'%03i_beamInterp_fan.png' % plotSerial)
+        fig.savefig(fileName,bbox_inches='tight')
+        plt.close(fig)
     plotSerial = plotSerial + 1
 
-    fig = plt.figure(figsize=figsize)
-    pyDARNmusic.plotting.musicPlot.plotRelativeRanges(dataObj,time=time,fig=fig,dataSet='beamInterpolated')
-    fileName = os.path.join(output_dir,'%03i_ranges.png' % plotSerial)
-    fig.savefig(fileName,bbox_inches='tight')
-    plt.close(fig)
+    if want('ranges'):
+        fig = plt.figure(figsize=figsize)
+        pyDARNmusic.plotting.musicPlot.plotRelativeRanges(dataObj,time=time,fig=fig,dataSet='beamInterpolated')
+        fileName = os.path.join(output_dir,'%03i_ranges.png' % plotSerial)
+        fig.savefig(fileName,bbox_inches='tight')
+        plt.close(fig)
     plotSerial = plotSerial + 1
 
-    fig = plt.figure(figsize=figsize)
-    pyDARNmusic.plotting.musicPlot.timeSeriesMultiPlot(dataObj,dataSet="DS002_beamInterpolated",dataSet2='DS001_limitsApplied',fig=fig)
-    fileName = os.path.join(output_dir,'%03i_beamInterp.png' % plotSerial)
-    fig.savefig(fileName,bbox_inches='tight')
-    plt.close(fig)
+    if want('beamInterp'):
+        fig = plt.figure(figsize=figsize)
+        pyDARNmusic.plotting.musicPlot.timeSeriesMultiPlot(dataObj,dataSet="DS002_beamInterpolated",dataSet2='DS001_limitsApplied',fig=fig)
+        fileName = os.path.join(output_dir,'%03i_beamInterp.png' % plotSerial)
+        fig.savefig(fileName,bbox_inches='tight')
+        plt.close(fig)
     plotSerial = plotSerial + 1
 
-    fig = plt.figure(figsize=figsize)
-    pyDARNmusic.plotting.musicPlot.timeSeriesMultiPlot(dataObj,dataSet='timeInterpolated',dataSet2='beamInterpolated',fig=fig)
-    fileName = os.path.join(output_dir,'%03i_timeInterp.png' % plotSerial)
-    fig.savefig(fileName,bbox_inches='tight')
-    plt.close(fig)
+    if want('timeInterp'):
+        fig = plt.figure(figsize=figsize)
+        pyDARNmusic.plotting.musicPlot.timeSeriesMultiPlot(dataObj,dataSet='timeInterpolated',dataSet2='beamInterpolated',fig=fig)
+        fileName = os.path.join(output_dir,'%03i_timeInterp.png' % plotSerial)
+        fig.savefig(fileName,bbox_inches='tight')
+        plt.close(fig)
     plotSerial = plotSerial + 1
 
     if process_level == ProcessLevel('rti_interp'):
         return
 
-    fig = plt.figure(figsize=figsize)
-    pyDARNmusic.plotting.musicPlot.timeSeriesMultiPlot(dataObj,fig=fig,dataSet="DS005_filtered")
-    fileName = os.path.join(output_dir,'%03i_filtered.png' % plotSerial)
-    fig.savefig(fileName,bbox_inches='tight')
-    plt.close(fig)
-    plotSerial = plotSerial + 1
-
-    fig = plt.figure(figsize=figsize)
-    pyDARNmusic.plotting.musicPlot.timeSeriesMultiPlot(dataObj,fig=fig)
-    fileName = os.path.join(output_dir,'%03i_detrendedData.png' % plotSerial)
-    fig.savefig(fileName,bbox_inches='tight')
-    plt.close(fig)
+    if want('filtered'):
+        fig = plt.figure(figsize=figsize)
+        pyDARNmusic.plotting.musicPlot.timeSeriesMultiPlot(dataObj,fig=fig,dataSet="DS005_filtered")
+        fileName = os.path.join(output_dir,'%03i_filtered.png' % plotSerial)
+        fig.savefig(fileName,bbox_inches='tight')
+        plt.close(fig)
     plotSerial = plotSerial + 1
 
-    if run_params.get('window_data'):
+    if want('detrendedData'):
         fig = plt.figure(figsize=figsize)
         pyDARNmusic.plotting.musicPlot.timeSeriesMultiPlot(dataObj,fig=fig)
-        fileName = os.path.join(output_dir,'%03i_windowedData.png' % plotSerial)
+        fileName = os.path.join(output_dir,'%03i_detrendedData.png' % plotSerial)
         fig.savefig(fileName,bbox_inches='tight')
         plt.close(fig)
+    plotSerial = plotSerial + 1
+
+    if run_params.get('window_data'):
+        if want('windowedData'):
+            fig = plt.figure(figsize=figsize)
+            pyDARNmusic.plotting.musicPlot.timeSeriesMultiPlot(dataObj,fig=fig)
+            fileName = os.path.join(output_dir,'%03i_windowedData.png' % plotSerial)
+            fig.savefig(fileName,bbox_inches='tight')
+            plt.close(fig)
         plotSerial = plotSerial + 1
 
-    fig = plt.figure(figsize=figsize)
-    pyDARNmusic.plotting.musicPlot.spectrumMultiPlot(dataObj,fig=fig,xlim=(-0.0025,0.0025))
-    fileName = os.path.join(output_dir,'%03i_spectrum.png' % plotSerial)
-    fig.savefig(fileName,bbox_inches='tight')
-    plt.close(fig)
+    if want('spectrum'):
+        fig = plt.figure(figsize=figsize)
+        pyDARNmusic.plotting.musicPlot.spectrumMultiPlot(dataObj,fig=fig,xlim=(-0.0025,0.0025))
+        fileName = os.path.join(output_dir,'%03i_spectrum.png' % plotSerial)
+        fig.savefig(fileName,bbox_inches='tight')
+        plt.close(fig)
     plotSerial = plotSerial + 1
 
-    fig = plt.figure(figsize=figsize)
-    pyDARNmusic.plotting.musicPlot.spectrumMultiPlot(dataObj,fig=fig,plotType='magnitude',xlim=(0,0.0025))
-    fileName = os.path.join(output_dir,'%03i_magnitude.png' % plotSerial)
-    fig.savefig(fileName,bbox_inches='tight')
-    plt.close(fig)
+    if want('magnitude'):
+        fig = plt.figure(figsize=figsize)
+        pyDARNmusic.plotting.musicPlot.spectrumMultiPlot(dataObj,fig=fig,plotType='magnitude',xlim=(0,0.0025))
+        fileName = os.path.join(output_dir,'%03i_magnitude.png' % plotSerial)
+        fig.savefig(fileName,bbox_inches='tight')
+        plt.close(fig)
     plotSerial = plotSerial + 1
 
-    fig = plt.figure(figsize=figsize)
-    pyDARNmusic.plotting.musicPlot.spectrumMultiPlot(dataObj,fig=fig,plotType='phase',xlim=(0,0.0025))
-    fileName = os.path.join(output_dir,'%03i_phase.png' % plotSerial)
-    fig.savefig(fileName,bbox_inches='tight')
-    plt.close(fig)
+    if want('phase'):
+        fig = plt.figure(figsize=figsize)
+        pyDARNmusic.plotting.musicPlot.spectrumMultiPlot(dataObj,fig=fig,plotType='phase',xlim=(0,0.0025))
+        fileName = os.path.join(output_dir,'%03i_phase.png' % plotSerial)
+        fig.savefig(fileName,bbox_inches='tight')
+        plt.close(fig)
     plotSerial = plotSerial + 1
 
-    fig = plt.figure(figsize=figsize)
-    pyDARNmusic.plotting.musicPlot.musicFan(dataObj,plotZeros=True,autoScale=True,time=time,fig=fig,subplot_tuple=(1,1,1))
-    fileName = os.path.join(output_dir,'%03i_finalDataFan.png' % plotSerial)
-    fig.savefig(fileName,bbox_inches='tight')
-    plt.close(fig)
+    if want('finalDataFan'):
+        fig = plt.figure(figsize=figsize)
+        pyDARNmusic.plotting.musicPlot.musicFan(dataObj,plotZeros=True,autoScale=True,time=time,fig=fig,subplot_tuple=(1,1,1))
+        fileName = os.path.join(output_dir,'%03i_finalDataFan.png' % plotSerial)
+        fig.savefig(fileName,bbox_inches='tight')
+        plt.close(fig)
     plotSerial = plotSerial + 1
 
-    fig = plt.figure(figsize=figsize)
-    ax  = fig.add_subplot(111)
-    pyDARNmusic.plotting.rtp.musicRTP(dataObj,plotZeros=True,axis=ax,autoScale=True)
-    fileName = os.path.join(output_dir,'%03i_finalDataRTI.png' % plotSerial)
-    fig.savefig(fileName,bbox_inches='tight')
-    plt.close(fig)
+    if want('finalDataRTI'):
+        fig = plt.figure(figsize=figsize)
+        ax  = fig.add_subplot(111)
+        pyDARNmusic.plotting.rtp.musicRTP(dataObj,plotZeros=True,axis=ax,autoScale=True)
+        fileName = os.path.join(output_dir,'%03i_finalDataRTI.png' % plotSerial)
+        fig.savefig(fileName,bbox_inches='tight')
+        plt.close(fig)
     plotSerial = plotSerial + 1
 
-    fig = plt.figure(figsize=figsize)
-    pyDARNmusic.plotting.musicPlot.plotFullSpectrum(dataObj,fig=fig,xlim=(0,0.0015))
-    fileName = os.path.join(output_dir,'%03i_fullSpectrum.png' % plotSerial)
-    fig.savefig(fileName,bbox_inches='tight')
-    plt.close(fig)
+    if want('fullSpectrum'):
+        fig = plt.figure(figsize=figsize)
+        pyDARNmusic.plotting.musicPlot.plotFullSpectrum(dataObj,fig=fig,xlim=(0,0.0015))
+        fileName = os.path.join(output_dir,'%03i_fullSpectrum.png' % plotSerial)
+        fig.savefig(fileName,bbox_inches='tight')
+        plt.close(fig)
     plotSerial = plotSerial + 1
 
     if process_level == ProcessLevel('fft'):
         return
 
-    fig = plt.figure(figsize=figsize)
-    pyDARNmusic.plotting.musicPlot.plotDlm(dataObj,fig=fig)
-    fileName = os.path.join(output_dir,'%03i_dlm_abs.png' % plotSerial)
-    fig.savefig(fileName,bbox_inches='tight')
-    plt.close(fig)
+    if want('dlm_abs'):
+        fig = plt.figure(figsize=figsize)
+        pyDARNmusic.plotting.musicPlot.plotDlm(dataObj,fig=fig)
+        fileName = os.path.join(output_dir,'%03i_dlm_abs.png' % plotSerial)
+        fig.savefig(fileName,bbox_inches='tight')
+        plt.close(fig)
     plotSerial = plotSerial + 1
 
-    fig = plt.figure(figsize=(10,10))
-    pyDARNmusic.plotting.musicPlot.plotKarr(dataObj,fig=fig,maxSignals=25,cmap='viridis')
-    fileName = os.path.join(output_dir,'%03i_karr.png' % plotSerial)
-    fig.savefig(fileName,bbox_inches='tight')
-    plt.close(fig)
+    if want('karr'):
+        fig = plt.figure(figsize=(10,10))
+        pyDARNmusic.plotting.musicPlot.plotKarr(dataObj,fig=fig,maxSignals=25,cmap='viridis')
+        fileName = os.path.join(output_dir,'%03i_karr.png' % plotSerial)
+        fig.savefig(fileName,bbox_inches='tight')
+        plt.close(fig)
     plotSerial = plotSerial + 1
     
-    fig = plt.figure(figsize=(10,10))
-    pyDARNmusic.plotting.musicPlot.plotKarrDetected(dataObj,fig=fig)
-    fileName = os.path.join(output_dir,'%03i_karrDetected.png' % plotSerial)
-    fig.savefig(fileName,bbox_inches='tight')
-    plt.close(fig)
+    if want('karrDetected'):
+        fig = plt.figure(figsize=(10,10))
+        pyDARNmusic.plotting.musicPlot.plotKarrDetected(dataObj,fig=fig)
+        fileName = os.path.join(output_dir,'%03i_karrDetected.png' % plotSerial)
+        fig.savefig(fileName,bbox_inches='tight')
+        plt.close(fig)
     plotSerial = plotSerial + 1
 
 def plot_music_rti(dataObj
@@ -977,36 +2595,95 @@ def get_default_beams(musicParams,dataObj=None,beams=[4,7,13]):
         new_beam_list = beams
     return new_beam_list
 
-def calculate_terminator(lats,lons,dates):
-    lats    = np.array(lats)
-    lons    = np.array(lons)
-    dates   = np.array(dates)
-
-    if lats.shape == (): lats.shape = (1,)
-    if lons.shape == (): lons.shape = (1,)
-
-    shape       = (len(dates),lats.shape[0],lats.shape[1])
-
-    term_lats   = np.zeros(shape,dtype=float)
-    term_tau    = np.zeros(shape,dtype=float)
-    term_dec    = np.zeros(shape,dtype=float)
+def solar_gha_dec(dates):
+    """
+    Greenwich hour angle and solar declination [deg] for an array of UTC
+    dates. This is pyDARNmusic.utils.timeUtils.epem() computed for all of
+    the dates at once.
+    """
+    dg2rad  = np.pi/180.
+    rad2dg  = 1./dg2rad
+
+    dates   = np.array(dates,dtype='datetime64[us]')
+    j2000   = np.datetime64('2000-01-01T12:00:00','us')
+    jday    = (dates - j2000) / np.timedelta64(1,'D') + 2451545.0
+    jd      = np.floor(jday)
+
+    # utc hour, ignoring fractional seconds as epem() does.
+    sec     = (dates - dates.astype('datetime64[D]')) // np.timedelta64(1,'s')
+    ut      = (sec // 3600) + (sec % 3600 // 60)/60. + (sec % 60)/3600.
+
+    t       = (jd + (ut/24.) - 2451545.0) / 36525.
+    l       = (280.460 + 36000.770 * t) % 360
+    g       = 357.528 + 35999.050 * t
+    lm      = l + 1.915 * np.sin(g*dg2rad) + 0.020 * np.sin(2*g*dg2rad)
+    ep      = 23.4393 - 0.01300 * t
+    eqtime  = -1.915*np.sin(g*dg2rad) - 0.020*np.sin(2*g*dg2rad) \
+            + 2.466*np.sin(2*lm*dg2rad) - 0.053*np.sin(4*lm*dg2rad)
+    gha     = 15*ut - 180 + eqtime
+    dec     = np.arcsin(np.sin(ep*dg2rad) * np.sin(lm*dg2rad)) * rad2dg
+    return gha, dec
+
+def _calculate_terminator(lats,lons,dates):
+    """
+    Vectorized form of the pyDARNmusic.utils.timeUtils.daynight_terminator()
+    test. A cell is dark if it is poleward of the terminator latitude
+    arctan(-cos(lon+tau)/tan(dec)) in the winter hemisphere, which is the
+    same as tan(lat)*tan(dec) + cos(lon+tau) < 0 for either sign of dec.
+    Expanding cos(lon+tau) turns this into one matrix product of the
+    (time, 3) solar terms with the (3, cell) FOV terms.
+    """
+    dg2rad      = np.pi/180.
+    tau, dec    = solar_gha_dec(dates)
 
-    terminator  = np.ones(shape,dtype=bool)
+    solar       = np.stack([np.tan(dec*dg2rad),np.cos(tau*dg2rad),-np.sin(tau*dg2rad)],axis=1)
+    cells       = np.stack([np.tan(lats*dg2rad).ravel(),np.cos(lons*dg2rad).ravel(),
+                            np.sin(lons*dg2rad).ravel()],axis=0)
 
-    for inx,date in enumerate(dates):
-        term_tup = pyDARNmusic.utils.timeUtils.daynight_terminator(date, lons)
-        term_lats[inx,:,:]  = term_tup[0]
-        term_tau[inx,:,:]   = term_tup[1]
-        term_dec[inx,:,:]   = term_tup[2]
+    terminator  = (solar @ cells) < 0
+    terminator[dec == 0,:] = True
+    terminator.shape = (len(dec),) + lats.shape
+    return terminator
 
-    nh_summer = term_dec > 0
-    nh_winter = term_dec < 0
+# Last terminator computed for each FOV geometry, so that recalculating it
+# for a time axis that has only been extended (e.g. by zero padding) only
+# computes the new times.
+_terminator_cache       = collections.OrderedDict()
+_terminator_cache_size  = 4
 
-    tmp         = lats[:]
-    tmp.shape   = (1,tmp.shape[0],tmp.shape[1])
-    lats_arr    = np.repeat(tmp,len(dates),axis=0)
-    terminator[nh_summer] = lats_arr[nh_summer] < term_lats[nh_summer]
-    terminator[nh_winter] = lats_arr[nh_winter] > term_lats[nh_winter]
+def calculate_terminator(lats,lons,dates):
+    """
+    Returns a boolean (time, beam, gate) array that is True where the cell at
+    lats, lons is in darkness at each date.
+    """
+    lats    = np.array(lats,dtype=float)
+    lons    = np.array(lons,dtype=float)
+    if lats.shape == (): lats.shape = (1,1)
+    if lons.shape == (): lons.shape = (1,1)
+
+    times   = np.array(dates,dtype='datetime64[us]').astype(np.int64)
+    key     = (lats.shape,hashlib.sha1(lats.tobytes()).hexdigest(),hashlib.sha1(lons.tobytes()).hexdigest())
+
+    terminator  = np.ones((len(times),)+lats.shape,dtype=bool)
+    todo        = np.ones(len(times),dtype=bool)
+
+    cached      = _terminator_cache.get(key)
+    if cached is not None and len(cached[0]) > 0:
+        cached_times, cached_term = cached
+        inxs    = np.searchsorted(cached_times,times)
+        inxs    = np.clip(inxs,0,len(cached_times)-1)
+        found   = cached_times[inxs] == times
+        terminator[found]   = cached_term[inxs[found]]
+        todo    = ~found
+
+    if np.any(todo):
+        terminator[todo] = _calculate_terminator(lats,lons,np.array(dates)[todo])
+
+    order   = np.argsort(times)
+    _terminator_cache[key] = (times[order],terminator[order])
+    _terminator_cache.move_to_end(key)
+    while len(_terminator_cache) > _terminator_cache_size:
+        _terminator_cache.popitem(last=False)
 
     return terminator
 
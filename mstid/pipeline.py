@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+"""
+Dependency-aware scheduler for the MSTID index processing stages.
+
+Instead of running each stage for every radar list before starting the next
+one, each radar list (one dct from run_helper.create_music_run_list()) gets
+its own chain of stages:
+
+    rti_interp -> update_db -> classify_none -> fft -> classify
+
+and a final calendar stage runs once every chain is finished. As soon as one
+radar list has finished a stage, its next stage starts, even while other
+radar lists are still working on earlier stages. The event-level work of all
+chains is fed to one shared mstid.worker_pool.WorkerPool so the number of
+processes stays bounded.
+
+Stages that correspond to a MUSIC processing level use the same names as
+more_music.ProcessLevel ('rti_interp', 'fft', 'music').
+"""
+import datetime
+import threading
+import traceback
+import collections
+import concurrent.futures
+
+# Stages of the MSTID index chain, in order. 'rti_interp' and 'fft' are
+# ProcessLevel names and are passed straight through as the process_level.
+MSTID_INDEX_STAGES = ['rti_interp','update_db','classify_none','fft','classify']
+
+class PipelineNode(object):
+    def __init__(self,name,func,args=(),kwargs=None,deps=(),stage=None):
+        self.name       = name
+        self.func       = func
+        self.args       = args
+        self.kwargs     = {} if kwargs is None else kwargs
+        self.deps       = list(deps)
+        self.stage      = stage
+        self.status     = 'waiting'
+        self.error      = None
+        self.result     = None
+        self.start_time = None
+        self.end_time   = None
+
+class Pipeline(object):
+    def __init__(self,max_threads=None,stage_limits=None):
+        """
+        A directed acyclic graph of processing stages. Each node runs in a
+        thread of this process as soon as all of the nodes it depends on
+        have finished. Heavy work should be handed off to a WorkerPool from
+        inside the node.
+
+        max_threads:    Maximum number of nodes running at once.
+                            Defaults to the number of nodes.
+        stage_limits:   Dictionary of {stage: n} limiting how many nodes of
+                            a given stage may run at the same time, e.g.
+                            {'classify':5} for memory-hungry stages.
+        """
+        self.nodes          = collections.OrderedDict()
+        self.max_threads    = max_threads
+        self.stage_limits   = {} if stage_limits is None else stage_limits
+        self.semaphores     = {}
+        for stage,limit in self.stage_limits.items():
+            self.semaphores[stage] = threading.Semaphore(limit)
+
+    def add(self,name,func,args=(),kwargs=None,deps=(),stage=None):
+        """
+        Add a node to the graph. deps is a list of node names that must
+        finish successfully before this node runs.
+        """
+        if name in self.nodes:
+            raise ValueError('Pipeline node {!s} already exists.'.format(name))
+        for dep in deps:
+            if dep not in self.nodes:
+                raise ValueError('Pipeline node {!s} depends on unknown node {!s}.'.format(name,dep))
+
+        node = PipelineNode(name,func,args=args,kwargs=kwargs,deps=deps,stage=stage)
+        self.nodes[name] = node
+        return node
+
+    def _run_node(self,node):
+        semaphore = self.semaphores.get(node.stage)
+        if semaphore is not None:
+            semaphore.acquire()
+        try:
+            node.start_time = datetime.datetime.now()
+            print('{!s} Pipeline: starting {!s}'.format(node.start_time,node.name))
+            return node.func(*node.args,**node.kwargs)
+        finally:
+            node.end_time = datetime.datetime.now()
+            if semaphore is not None:
+                semaphore.release()
+
+    def run(self):
+        """
+        Run all nodes. If a node fails, the nodes that depend on it are
+        skipped but the rest of the graph keeps going. A RuntimeError listing
+        the failed nodes is raised at the end if anything failed.
+        """
+        max_threads = self.max_threads
+        if max_threads is None:
+            max_threads = max(len(self.nodes),1)
+
+        running = {}
+        with concurrent.futures.ThreadPoolExecutor(max_threads) as executor:
+            while True:
+                for node in self.nodes.values():
+                    if node.status != 'waiting':
+                        continue
+                    dep_status = [self.nodes[dep].status for dep in node.deps]
+                    if any([x in ['failed','skipped'] for x in dep_status]):
+                        node.status = 'skipped'
+                        print('Pipeline: skipping {!s} because a dependency failed.'.format(node.name))
+                    elif all([x == 'done' for x in dep_status]):
+                        node.status = 'running'
+                        future      = executor.submit(self._run_node,node)
+                        running[future] = node
+
+                if len(running) == 0:
+                    break
+
+                done, not_done = concurrent.futures.wait(running,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    node = running.pop(future)
+                    try:
+                        node.result = future.result()
+                        node.status = 'done'
+                        print('{!s} Pipeline: finished {!s} ({!s})'.format(
+                            node.end_time,node.name,node.end_time-node.start_time))
+                    except Exception:
+                        node.error  = traceback.format_exc()
+                        node.status = 'failed'
+                        print('Pipeline: {!s} failed:\n{!s}'.format(node.name,node.error))
+
+        failed = [name for name,node in self.nodes.items() if node.status == 'failed']
+        if len(failed) > 0:
+            raise RuntimeError('Pipeline nodes failed: {!s}'.format(failed))
+
+    def status(self):
+        """
+        Returns a dictionary of {node name: status}.
+        """
+        return collections.OrderedDict([(name,node.status) for name,node in self.nodes.items()])
+
+def node_name(stage,dct):
+    """
+    Name of a pipeline node for a stage of a radar list, e.g.
+    'fft:guc_bks_20140101_20141231'.
+    """
+    return '{!s}:{!s}'.format(stage,dct['mstid_list'])
+
+def _classify_none_and_rcgb(dct,classification_path):
+    from . import classify
+    classify.classify_none_events(**dct)
+    classify.rcgb(classification_path=classification_path,**dct)
+
+def _classify(dct,classification_path):
+    from . import classify
+    dct = dict(dct)
+    dct['classification_path'] = classification_path
+    classify.mstid_classification_dct(dct)
+
+def build_mstid_index_pipeline(dct_list,pool,
+        new_list=False,incremental=False,recompute=False,reupdate_db=True,
+        classification_path='classification',classify_nprocs=5,
+        calendar_output_dir=None,db_name='mstid',
+        batch_by_day=False,max_threads=None,render_pool=None,plot_types=None):
+    """
+    Build the Pipeline for the MSTID index calculation done in
+    run_DARNtids.py. Each dct in dct_list gets its own chain of
+    MSTID_INDEX_STAGES; the calendar plot runs after all chains finish.
+
+    pool:               Shared WorkerPool for the event-level work. It should
+                            be created with
+                            initializer=run_helper.init_event_worker and
+                            start_method='forkserver', since its workers
+                            are started while the stage threads run.
+    classify_nprocs:    Maximum number of classification stages at once.
+    calendar_output_dir: Where to put the calendar plot. If None, no
+                            calendar plot is made.
+    render_pool:        WorkerPool for rendering event figures (see
+                            mstid.render_queue). If given, a 'render' stage
+                            is added after 'classify' for each radar list so
+                            events processed with make_plots='deferred' get
+                            their figures. Events classified as 'None' are
+                            not rendered.
+    plot_types:         Figures to render; see more_music.MUSIC_PLOT_TYPES.
+    """
+    from . import run_helper
+    from . import mongo_tools
+
+    run_kw  = dict(multiproc=True,executor='pool',pool=pool,batch_by_day=batch_by_day)
+
+    pipe    = Pipeline(max_threads=max_threads,stage_limits={'classify':classify_nprocs})
+    final_nodes = []
+    for dct in dct_list:
+        prev = []
+        for stage in MSTID_INDEX_STAGES:
+            name = node_name(stage,dct)
+            if stage == 'rti_interp':
+                pipe.add(name,run_helper.get_events_and_run,args=([dct],),
+                    kwargs=dict(process_level=stage,
+                        new_list=new_list,incremental=incremental,
+                        recompute=recompute,**run_kw),
+                    deps=prev,stage=stage)
+            elif stage == 'update_db':
+                if not reupdate_db:
+                    continue
+                kwargs = dict(dct)
+                kwargs['pool'] = pool
+                pipe.add(name,mongo_tools.updateDb_mstid_list,kwargs=kwargs,
+                    deps=prev,stage=stage)
+            elif stage == 'classify_none':
+                pipe.add(name,_classify_none_and_rcgb,args=(dct,classification_path),
+                    deps=prev,stage=stage)
+            elif stage == 'fft':
+                pipe.add(name,run_helper.get_events_and_run,args=([dct],),
+                    kwargs=dict(process_level=stage,
+                        category='unclassified',**run_kw),
+                    deps=prev,stage=stage)
+            elif stage == 'classify':
+                pipe.add(name,_classify,args=(dct,classification_path),
+                    deps=prev,stage=stage)
+            prev = [name]
+
+        if render_pool is not None:
+            from . import render_queue
+            name    = node_name('render',dct)
+            kwargs  = dict(dct)
+            kwargs['pool']          = render_pool
+            kwargs['plot_types']    = plot_types
+            pipe.add(name,render_queue.render_mstid_list,kwargs=kwargs,
+                deps=prev,stage='render')
+            # Rendering is not needed for the calendar plot.
+        final_nodes += prev
+
+    if calendar_output_dir is not None:
+        from .calendar_plot import calendar_plot
+        pipe.add('calendar',calendar_plot,
+            kwargs=dict(dct_list=dct_list,db_name=db_name,output_dir=calendar_output_dir),
+            deps=final_nodes,stage='calendar')
+
+    return pipe
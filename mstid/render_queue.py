@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""
+Render the MUSIC event figures separately from the processing.
+
+run_music(make_plots='deferred') saves the HDF5 file but makes no figures.
+The functions here make them later from the saved files, either for a whole
+mstid_list using a pool of worker processes, or for a single event the first
+time it is viewed on the webserver.
+"""
+import os
+import glob
+
+import pymongo
+
+from . import more_music
+from .more_music import ProcessLevel
+
+def render_event_plots(hdf5_path,plot_types=None,process_level=None):
+    """
+    Make the music_plot_all() figures of one event from its saved HDF5 file.
+
+    process_level:  Level to plot up to. Defaults to the level the event has
+                        been processed to.
+    """
+    dataObj = more_music.load_saved_dataObj(hdf5_path)
+    if dataObj is None:
+        print('No saved data to plot: {!s}'.format(hdf5_path))
+        return
+
+    run_params  = more_music.read_runfile(hdf5_path)
+    if process_level is None:
+        process_level = more_music.get_process_level(run_params['radar'],
+                run_params['sTime'],run_params['eTime'],data_path=run_params['data_path'])
+
+    if process_level == ProcessLevel('None'):
+        return
+
+    more_music.music_plot_all(run_params,dataObj,process_level=process_level,plot_types=plot_types)
+
+def _render_task(task):
+    hdf5_path, plot_types = task
+    render_event_plots(hdf5_path,plot_types=plot_types)
+
+def has_plots(music_path):
+    return len(glob.glob(os.path.join(music_path,'*.png'))) > 0
+
+def ensure_event_plots(hdf5_path,plot_types=None):
+    """
+    Render an event's figures if it has none yet, e.g. the first time it is
+    requested from the webserver. Returns True if figures were made.
+    """
+    if has_plots(os.path.dirname(hdf5_path)):
+        return False
+
+    json_path   = hdf5_path[:-2] + 'runfile.json'
+    if not os.path.exists(hdf5_path) or not os.path.exists(json_path):
+        return False
+
+    render_event_plots(hdf5_path,plot_types=plot_types)
+    return True
+
+def render_mstid_list(mstid_list,db_name='mstid',mongo_port=27017,
+        data_path='music_data/music',plot_types=None,skip_categories=('None',),
+        overwrite=False,pool=None,nprocs=None,**kwargs):
+    """
+    Render the figures of every event of an mstid_list that has a saved HDF5
+    file. The events are sent to a worker_pool.WorkerPool.
+
+    skip_categories:    Events whose category_manu is in this list are not
+                            rendered. By default, events classified as
+                            'None' (bad or missing data) are skipped.
+    overwrite:          Render events that already have figures.
+    pool:               WorkerPool to use. If None, one with nprocs workers
+                            is created for this call.
+    """
+    from .worker_pool import WorkerPool
+    from .run_helper import init_event_worker
+
+    skip_categories = [str(cat).lower() for cat in skip_categories]
+
+    mongo   = pymongo.MongoClient(port=mongo_port)
+    db      = mongo[db_name]
+
+    tasks   = []
+    for item in db[mstid_list].find():
+        category = item.get('category_manu')
+        if category is not None and str(category).lower() in skip_categories:
+            continue
+
+        radar   = item['radar']
+        sTime   = item['sDatetime']
+        eTime   = item['fDatetime']
+        if not overwrite:
+            music_path  = more_music.get_output_path(radar,sTime,eTime,data_path=data_path)
+            if has_plots(music_path):
+                continue
+
+        hdf5_path   = more_music.get_hdf5_name(radar,sTime,eTime,data_path=data_path,getPath=True)
+        if not os.path.exists(hdf5_path):
+            continue
+        tasks.append((hdf5_path,plot_types))
+    mongo.close()
+
+    print('Rendering figures for {!s} events of {!s}.'.format(len(tasks),mstid_list))
+    if len(tasks) == 0:
+        return
+
+    if pool is None:
+        with WorkerPool(nprocs,initializer=init_event_worker) as this_pool:
+            this_pool.map(_render_task,tasks)
+    else:
+        pool.map(_render_task,tasks)
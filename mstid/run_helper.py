@@ -1,12 +1,23 @@
 #!/usr/bin/env python
 import datetime
 
-from .more_music import generate_initial_param_file,run_music_init_param_file
+from .more_music import generate_initial_param_file,run_music_init_param_file,needs_raw_data, \
+        read_init_param_file,load_music_day,auto_range_events,estimate_event_mem_mb,FFTBatch,FFTBatchError
 
 from .mongo_tools import generate_mongo_list, \
         generate_mongo_list_from_list,events_from_mongo
 
+from .worker_pool import WorkerPool
+from .general_lib import log_to_file
+from . import fov_cache
+from .work_queue import MongoWorkQueue, run_queue_worker
+
+import os
+import functools
 import itertools
+import collections
+import logging
+import traceback
 import numpy as np
 
 import multiprocessing
@@ -141,21 +152,208 @@ def get_all_default_mstid_lists(**kwargs):
 
     return mstid_lists
 
+class LogFilter(logging.Filter):
+    def __init__(self,message):
+        self.message = message
+    def filter(self, record):
+        return not record.getMessage().startswith(self.message)
+
+def init_event_worker():
+    """
+    Configure a process to run MUSIC events: non-interactive matplotlib
+    backend, warning-level logging, and suppression of the noisy
+    pyDARNmusic defineLimits() message.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+
+    logger = logging.getLogger()
+    logger.addFilter(LogFilter('An error occured while defining limits.  No limits set.  Check your input values.'))
+    logger.setLevel(logging.WARN)
+
+def run_init_file_logged(init_file,log_dir='log',dataObj_day=None,fft_batch=None,auto_gate_limits=None):
+    """
+    Run the MUSIC processing for a single initialization file in the current
+    process, sending any log messages to log/<init_file>.log. The log file
+    is deleted if nothing was logged.
+    """
+    print(init_file)
+
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+    log_path = os.path.join(log_dir,os.path.basename(init_file)+'.log')
+    with open(log_path,'w') as fl:
+        fl.write('{!s}: Processing {!s}\n'.format(datetime.datetime.now(),init_file))
+
+    with log_to_file(log_path):
+        run_music_init_param_file(init_file,dataObj_day=dataObj_day,fft_batch=fft_batch,
+                auto_gate_limits=auto_gate_limits,log_path=log_path)
+
+    # Delete log file if no real messages.
+    with open(log_path,'r') as fl:
+        log = fl.readlines()
+    if len(log) == 1:
+        os.remove(log_path)
+
+def group_init_files_by_day(init_files):
+    """
+    Group initialization files into batches that share a radar-day and the
+    data loading parameters, so that the fitacf data for each batch only has
+    to be read once. Events that resume from their saved HDF5 file (see
+    more_music.needs_raw_data()) are batched separately from those that
+    read the fitacf data. Returns a list of lists of initialization files.
+    """
+    groups = collections.OrderedDict()
+    for init_file in init_files:
+        prm = read_init_param_file(init_file)
+        key = (prm.get('radar'),prm['sTime'].date(),prm.get('fitacf_dir','/sd-data'),
+               prm.get('fovModel','GS'),prm.get('gscat',1),
+               prm.get('interp_resolution',60.),prm.get('filter_numtaps',101.),
+               prm.get('srcPath'),needs_raw_data(prm))
+        groups.setdefault(key,[]).append(init_file)
+    return list(groups.values())
+
+def run_init_file_batch_logged(init_files,log_dir='log',fft_batch_size=None,fft_workers=-1):
+    """
+    Run a batch of initialization files for the same radar-day (see
+    group_init_files_by_day()) in the current process. If more than one
+    event of the batch reads fitacf data (i.e. does not resume from its
+    saved HDF5 file), the data for those events is loaded once and each
+    event is sliced out of it. Their auto_range() gate limits are then
+    found together with more_music.auto_range_batch().
+    With fft_batch_size, the spectra of up to that many events are
+    calculated together at the fft level (see more_music.FFTBatch). The
+    batch is flushed between events, and the end of each batched run is
+    logged to the event's own log file.
+
+    A failure in one event does not stop the rest of the batch; an exception
+    is raised at the end if any event failed.
+    """
+    init_files  = list(init_files)
+    prms        = [read_init_param_file(init_file) for init_file in init_files]
+
+    dataObj_day = None
+    prm         = prms[0]
+    raw_prms    = [x for x in prms if needs_raw_data(x)]
+    if prm.get('srcPath') is None and len(raw_prms) > 1:
+        dataObj_day = load_music_day(prm['radar'].lower(),
+                min([x['sTime'] for x in raw_prms]),max([x['eTime'] for x in raw_prms]),
+                interp_resolution   = prm.get('interp_resolution',60.),
+                filterNumtaps       = prm.get('filter_numtaps',101.),
+                fitacf_dir          = prm.get('fitacf_dir','/sd-data'),
+                fovModel            = prm.get('fovModel','GS'),
+                gscat               = prm.get('gscat',1),
+                fov_cache_dir       = prm.get('fov_cache_dir',fov_cache.FOV_CACHE_DIR))
+
+    gate_limits = [None]*len(prms)
+    if dataObj_day is not None:
+        try:
+            gate_limits = auto_range_events(dataObj_day,prms)
+        except Exception:
+            # Each event runs auto_range() on its own instead.
+            print(traceback.format_exc())
+
+    fft_batch   = None
+    if fft_batch_size is not None:
+        fft_batch   = FFTBatch(fft_batch_size,workers=fft_workers,auto_flush=False)
+
+    def flush_fft_batch():
+        try:
+            fft_batch.flush()
+        except FFTBatchError as err:
+            print(err)
+            failed.extend(err.failed)
+
+    failed = []
+    for init_file,auto_gate_limits in zip(init_files,gate_limits):
+        try:
+            run_init_file_logged(init_file,log_dir=log_dir,dataObj_day=dataObj_day,fft_batch=fft_batch,
+                    auto_gate_limits=auto_gate_limits)
+        except Exception:
+            print(traceback.format_exc())
+            failed.append(init_file)
+        if fft_batch is not None and fft_batch.is_full():
+            flush_fft_batch()
+
+    if fft_batch is not None:
+        flush_fft_batch()
+
+    if len(failed) > 0:
+        raise RuntimeError('MUSIC processing failed for: {!s}'.format(failed))
+
+def estimate_task_mem_mb(task):
+    """
+    Estimated peak memory (MB) of running an initialization file, or a
+    radar-day batch of them (see group_init_files_by_day()).
+    """
+    if isinstance(task,str):
+        return estimate_event_mem_mb(**read_init_param_file(task))
+
+    prms        = [read_init_param_file(init_file) for init_file in task]
+    raw_prms    = [x for x in prms if needs_raw_data(x)]
+    day_hours   = 0.
+    if len(raw_prms) > 1:
+        day_hours = (max([x['eTime'] for x in raw_prms]) - min([x['sTime'] for x in raw_prms])).total_seconds()/3600.
+    return max([estimate_event_mem_mb(day_hours=day_hours,**prm) for prm in prms])
+
 def run_init_file(init_file):
     """
     Launches the MUSIC script as its own process to isolate its
-    memory management.
+    memory management. init_file may also be a list of initialization
+    files for the same radar-day, which are then run as one batch.
     """
-    cmd = ['./run_single_event.py',init_file]
+    if isinstance(init_file,str):
+        cmd = ['./run_single_event.py',init_file]
+    else:
+        cmd = ['./run_single_event.py'] + list(init_file)
     print(' '.join(cmd))
     subprocess.check_call(cmd)
 
 def get_events_and_run(dct_list,process_level=None,new_list=False,
-        category=None,recompute=False,multiproc=True,nprocs=None,**dct):
+        category=None,recompute=False,multiproc=True,nprocs=None,
+        executor='subprocess',max_events_per_worker=None,max_rss_mb=None,
+        pool=None,batch_by_day=False,incremental=False,work_queue=None,
+        mem_budget_mb=None,fft_batch_size=None,fft_workers=-1,**dct):
     """
     Launch the MUSIC scripts for multiple events given a list of dictionaries
     describing which radars to use, the start and end dates of the run,
     and MUSIC script options.
+
+    executor:   'subprocess' launches ./run_single_event.py once per event.
+                'pool' runs events in persistent worker processes
+                    (see mstid.worker_pool.WorkerPool) that are recycled after
+                    max_events_per_worker events or when their memory use
+                    exceeds max_rss_mb megabytes.
+                'queue' puts the events on a lease-based work queue (see
+                    mstid.work_queue) and works on them with a pool on this
+                    host. Other hosts can help by running
+                    ./run_queue_worker.py on the same lists. batch_by_day is
+                    not used with the queue.
+    work_queue: Queue to use with executor='queue'. If None, a
+                    MongoWorkQueue on the event lists is used.
+    mem_budget_mb: With executor='pool' or 'queue', only start events while
+                    the sum of their estimated peak memory (see
+                    more_music.estimate_event_mem_mb()) fits in this many MB.
+                    nprocs is then the maximum number of processes. A shared
+                    pool uses its own mem_budget_mb.
+    pool:       An existing WorkerPool to use with executor='pool'. If None,
+                    a pool is created for this call and closed afterwards.
+    batch_by_day: Load the fitacf data once per radar-day and slice every
+                    window of that day out of it, instead of loading the
+                    (filter-padded, overlapping) data for each window.
+                    With executor='pool' each radar-day counts as one task
+                    toward max_events_per_worker. With resume, events that
+                    can continue from their saved HDF5 file are batched
+                    apart and never load the radar-day.
+    incremental: With new_list, add only the missing event windows to the
+                    MongoDB lists instead of dropping and rebuilding them, so
+                    already computed events are kept.
+    fft_batch_size: At the fft process level, stack up to this many events
+                    and calculate their spectra in one scipy.fft call with
+                    fft_workers threads (see more_music.FFTBatch). Events are
+                    batched within each radar-day with batch_by_day, and
+                    across the whole list when run serially (multiproc=False).
+                    Not used with executor='subprocess' or 'queue'.
     """
 
     events      = []
@@ -171,34 +369,77 @@ def get_events_and_run(dct_list,process_level=None,new_list=False,
         # Generate Clean Mongo MSTID List
         if new_list:
             if input_mstid_list is None:
-                generate_mongo_list(**dct)
+                generate_mongo_list(incremental=incremental,**dct)
             else:
                 generate_mongo_list_from_list(mstid_list,db_name,mongo_port,
                         input_mstid_list,input_db_name,input_mongo_port,
-                        category=category)
+                        category=category,incremental=incremental)
 
         if process_level:
             dct['process_level']    = process_level
 
         # Figure out which events need to be computed.
         these_events    = events_from_mongo(category=category,recompute=recompute,**dct)
+        if recompute:
+            # Recomputing means starting over from the raw data.
+            for event in these_events:
+                event['resume'] = False
         events += these_events
 
+    # Share the events with other hosts through a work queue. #####################
+    if executor == 'queue':
+        if work_queue is None:
+            work_queue = MongoWorkQueue([dct['mstid_list'] for dct in dct_list],
+                    db_name=dct_list[0].get('db_name','mstid'),
+                    mongo_port=dct_list[0].get('mongo_port',27017))
+        work_queue.enqueue(events)
+        run_queue_worker(work_queue,nprocs=nprocs,max_events_per_worker=max_events_per_worker,
+                max_rss_mb=max_rss_mb,mem_budget_mb=mem_budget_mb)
+        return
+
     # Prepare initial_param.json files #############################################
     init_files  = [generate_initial_param_file(event) for event in events]
 
+    if batch_by_day:
+        tasks       = group_init_files_by_day(init_files)
+        run_logged  = run_init_file_batch_logged
+        if fft_batch_size is not None:
+            run_logged  = functools.partial(run_init_file_batch_logged,
+                    fft_batch_size=fft_batch_size,fft_workers=fft_workers)
+    else:
+        tasks       = init_files
+        run_logged  = run_init_file_logged
+
     # Send events off to MUSIC for rti_interp level processing. ####################
-    if multiproc:
-        if len(init_files) > 0:
+    if multiproc and executor == 'pool':
+        if len(tasks) > 0:
+            mem_mb = [estimate_task_mem_mb(task) for task in tasks]
+            if pool is None:
+                with WorkerPool(nprocs,max_events_per_worker=max_events_per_worker,
+                        max_rss_mb=max_rss_mb,initializer=init_event_worker,
+                        mem_budget_mb=mem_budget_mb) as this_pool:
+                    this_pool.map(run_logged,tasks,mem_mb=mem_mb)
+            else:
+                pool.map(run_logged,tasks,mem_mb=mem_mb)
+    elif multiproc:
+        if len(tasks) > 0:
             pool = multiprocessing.Pool(nprocs)
-            pool.map(run_init_file,init_files)
+            pool.map(run_init_file,tasks)
             pool.close()
             pool.join()
+    elif batch_by_day:
+        for task in tasks:
+            run_logged(task)
     else:
+        fft_batch   = None
+        if fft_batch_size is not None:
+            fft_batch   = FFTBatch(fft_batch_size,workers=fft_workers)
         for init_file in init_files:
             cmd = ['./run_single_event.py',init_file]
             print(' '.join(cmd))
-            run_music_init_param_file(init_file)
+            run_music_init_param_file(init_file,fft_batch=fft_batch)
+        if fft_batch is not None:
+            fft_batch.flush()
 
 def get_seDates_from_groups(radar_groups,date_fmt='%d %b %Y',sep='_'):
     dates = []
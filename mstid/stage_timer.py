@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+"""
+Opt-in timing and memory instrumentation for the stages of run_music().
+
+A StageTimer records, for each stage, the wall time, CPU time, resident
+memory after the stage, and optionally the peak Python allocation measured
+with tracemalloc. Stages are marked in order:
+
+    timer = StageTimer()
+    timer.start('load')
+    ...
+    timer.start('beamInterpolation')    # Ends 'load'.
+    ...
+    timer.stop()
+
+run_music(instrument=...) writes the records to a stage_timing.json file in
+the event's output directory and/or to the stage_timing field of the event's
+MongoDB document. stage_report() collects them for a whole run and prints
+per-stage percentiles.
+"""
+import os
+import glob
+import json
+import time
+import datetime
+import tracemalloc
+
+import numpy as np
+
+from .general_lib import get_rss_mb
+
+STAGE_TIMING_FILE = 'stage_timing.json'
+
+class StageTimer(object):
+    def __init__(self,enabled=True,trace_memory=False):
+        """
+        enabled:        If False, start() and stop() do nothing.
+        trace_memory:   Also record the peak memory allocated by Python in
+                            each stage using tracemalloc. This slows the
+                            processing down noticeably.
+        """
+        self.enabled        = enabled
+        self.trace_memory   = trace_memory
+        self.records        = []
+        self.current        = None
+
+        if self.enabled and self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def start(self,name):
+        """
+        Start timing stage name, ending the stage currently being timed.
+        """
+        if not self.enabled:
+            return
+        self.stop()
+
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+
+        self.current = {'stage':name,
+                        'start':datetime.datetime.utcnow(),
+                        '_wall':time.perf_counter(),
+                        '_cpu':time.process_time(),
+                        'rss_start_mb':get_rss_mb()}
+
+    def stop(self):
+        """
+        End the stage currently being timed.
+        """
+        if not self.enabled or self.current is None:
+            return
+        rec                 = self.current
+        rec['wall_s']       = time.perf_counter() - rec.pop('_wall')
+        rec['cpu_s']        = time.process_time() - rec.pop('_cpu')
+        rec['rss_end_mb']   = get_rss_mb()
+        if self.trace_memory:
+            rec['tracemalloc_peak_mb'] = tracemalloc.get_traced_memory()[1] / 1024.**2
+        self.records.append(rec)
+        self.current        = None
+
+    def write_json(self,path):
+        self.stop()
+        with open(path,'w') as fl:
+            json.dump(self.records,fl,indent=4,default=str)
+
+def load_stage_timing(data_path='music_data/music'):
+    """
+    Read all stage_timing.json files written under data_path. Returns a
+    list of records with the event directory added as 'event'.
+    """
+    records = []
+    paths   = glob.glob(os.path.join(data_path,'*','*',STAGE_TIMING_FILE))
+    for path in sorted(paths):
+        with open(path,'r') as fl:
+            recs = json.load(fl)
+        event = os.path.dirname(path)
+        for rec in recs:
+            rec['event'] = event
+            records.append(rec)
+    return records
+
+def load_stage_timing_mongo(mstid_list,db_name='mstid',mongo_port=27017):
+    """
+    Read the stage_timing records saved in the documents of an mstid_list.
+    """
+    import pymongo
+    mongo   = pymongo.MongoClient(port=mongo_port)
+    db      = mongo[db_name]
+
+    records = []
+    crsr    = db[mstid_list].find({'stage_timing':{'$exists':True}},
+                {'radar':1,'sDatetime':1,'stage_timing':1})
+    for item in crsr:
+        for rec in item['stage_timing']:
+            rec['event'] = '{!s} {!s}'.format(item['radar'],item['sDatetime'])
+            records.append(rec)
+    mongo.close()
+    return records
+
+def stage_report(records,percentiles=(50,90,99),keys=('wall_s','cpu_s','rss_end_mb'),
+        output_file=None):
+    """
+    Print a table of per-stage percentiles of the given stage timing records
+    and return it as a dictionary of {stage: {key: {percentile: value}}}.
+    Stages are listed in the order they first appear. The total wall time
+    of each stage across all events is also reported.
+    """
+    stages  = []
+    values  = {}
+    for rec in records:
+        stage = rec['stage']
+        if stage not in values:
+            stages.append(stage)
+            values[stage] = {key:[] for key in keys}
+        for key in keys:
+            if rec.get(key) is not None:
+                values[stage][key].append(rec[key])
+
+    report  = {}
+    total   = sum([np.sum(values[stage].get('wall_s',[])) for stage in stages])
+
+    txt     = []
+    hdr     = ['{:26s}'.format('stage'),'{:>6s}'.format('n'),'{:>7s}'.format('%wall')]
+    for key in keys:
+        hdr += ['{:>12s}'.format('{!s} p{!s}'.format(key,pct)) for pct in percentiles]
+    txt.append(' '.join(hdr))
+
+    for stage in stages:
+        report[stage] = {}
+        n_recs  = max([len(x) for x in values[stage].values()])
+        wall    = np.sum(values[stage].get('wall_s',[]))
+        line    = ['{:26s}'.format(stage),'{:6d}'.format(n_recs),
+                   '{:7.1f}'.format(100.*wall/total if total > 0 else 0.)]
+        for key in keys:
+            vals = values[stage][key]
+            report[stage][key] = {}
+            for pct in percentiles:
+                val = np.percentile(vals,pct) if len(vals) > 0 else np.nan
+                report[stage][key][pct] = val
+                line.append('{:12.2f}'.format(val))
+        txt.append(' '.join(line))
+
+    txt = '\n'.join(txt)
+    print(txt)
+    if output_file is not None:
+        with open(output_file,'w') as fl:
+            fl.write(txt+'\n')
+
+    return report
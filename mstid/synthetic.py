@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+"""
+Synthetic SuperDARN data for testing and benchmarking the MUSIC processing
+without fitacf archives.
+
+make_synthetic_music_obj() returns a musicArray laid out exactly as
+pyDARNmusic.music.musicArray() lays out data loaded from fitacf files. It
+has the real FOV of the radar and ground scatter power that is modulated by
+MSTID plane waves with known wavelength, azimuth and period, plus noise,
+ionospheric scatter and data gaps.
+
+Save a synthetic musicArray with save_synthetic_music_obj() and pass the
+file to run_music() as srcPath. Each event window is then cut out of it as
+if it had been loaded from the fitacf files.
+"""
+import datetime
+
+import numpy as np
+
+from pydarn import SuperDARNRadars, Re
+from pyDARNmusic import music
+from pyDARNmusic.utils.geoPack import greatCircleDist, greatCircleAzm
+from hdf5_api import saveMusicArrayToHDF5
+
+from . import fov_cache
+
+# A typical medium-scale TID.
+DEFAULT_WAVES = [{'wavelength_km':300.,'azimuth_deg':135.,'period_min':40.,'amplitude_db':6.}]
+
+def get_rad_enum(radar):
+    for rad_enum, rad in SuperDARNRadars.radars.items():
+        if rad.hardware_info.abbrev == radar.lower():
+            return rad_enum
+    raise ValueError('Unknown radar: {!s}'.format(radar))
+
+def get_synthetic_fov(radar,n_beams,n_gates,rsep=45,frang=180,date=None,fovModel='GS',
+        fov_cache_dir=None):
+    """
+    Compute the FOV dictionary of a radar the same way musicArray() does.
+    The corners come from the FOV geometry cache (see mstid.fov_cache);
+    with fov_cache_dir None it is only kept in memory.
+    """
+    rad_enum    = get_rad_enum(radar)
+    hdw         = SuperDARNRadars.radars[rad_enum].hardware_info
+
+    ranges  = [0, n_gates]
+    latFull, lonFull = fov_cache.get_fov_corners(rad_enum,rsep,frang,n_gates,fovModel,
+            cache_dir=fov_cache_dir)
+    latFull = latFull.copy()
+    lonFull = lonFull.copy()
+
+    # The ground scatter mapped range is undefined at close range and pyDARN
+    # truncates the FOV there; pad it back out with NaNs as musicArray() does.
+    if latFull.shape[0] != (ranges[1]+1):
+        full_shape  = (ranges[1]+1, latFull.shape[1])
+        sInx        = (ranges[1]+1) - latFull.shape[0]
+
+        tmp         = np.zeros(full_shape)*np.nan
+        tmp[sInx:,:] = latFull
+        latFull     = tmp
+
+        tmp         = np.zeros(full_shape)*np.nan
+        tmp[sInx:,:] = lonFull
+        lonFull     = tmp
+
+    radar_lat   = hdw.geographic.lat
+    radar_lon   = hdw.geographic.lon
+    slantRFull  = greatCircleDist(radar_lat,radar_lon,latFull,lonFull) * Re
+
+    # musicArray() places the cell centers at the near-left corners.
+    fov = {}
+    fov['latFull']      = latFull.T[:n_beams+1,:]
+    fov['lonFull']      = lonFull.T[:n_beams+1,:]
+    fov['slantRFull']   = slantRFull.T[:n_beams+1,:]
+    fov['latCenter']    = fov['latFull'][:n_beams,:n_gates].copy()
+    fov['lonCenter']    = fov['lonFull'][:n_beams,:n_gates].copy()
+    fov['slantRCenter'] = fov['slantRFull'][:n_beams,:n_gates].copy()
+    fov['azmRCenter']   = greatCircleAzm(radar_lat,radar_lon,latFull,lonFull)[:n_gates,:n_beams]
+    fov['nr_beams']     = latFull.shape[1]-1
+    fov['nr_gates']     = latFull.shape[0]-1
+    fov['beams']        = np.arange(n_beams)
+    fov['gates']        = np.arange(n_gates)
+    fov['coords']       = 'geo'
+    return fov
+
+def make_synthetic_music_obj(radar='bks',sTime=datetime.datetime(2017,11,3,12),
+        eTime=datetime.datetime(2017,11,3,18),n_beams=None,n_gates=75,scan_s=60.,
+        rsep=45,frang=180,waves=DEFAULT_WAVES,background_db=20.,noise_db=2.,
+        gs_fraction=0.8,missing_fraction=0.,gaps=None,gscat=1,fovModel='GS',
+        cp=153,seed=0):
+    """
+    Returns a synthetic musicArray.
+
+    n_beams:            Beams per scan. Defaults to the radar's number of beams.
+    n_gates:            Number of range gates.
+    scan_s:             Scan period in seconds. Beams within a scan are
+                            sounded evenly across the scan period.
+    waves:              List of dictionaries describing plane waves, each with
+                            wavelength_km, azimuth_deg (direction of
+                            propagation, clockwise from north), period_min,
+                            amplitude_db, and optionally phase_deg.
+    gs_fraction:        Probability that a cell is flagged as ground scatter
+                            in each scan; the rest is ionospheric scatter.
+    missing_fraction:   Probability that a cell has no backscatter at all.
+    gaps:               List of (start, end) datetimes with no scans, e.g. to
+                            simulate the radar being off.
+    gscat:              Scatter kept, as in musicArray(): 0 all, 1 ground
+                            scatter only, 2 ionospheric scatter only.
+    seed:               Seed of the random number generator.
+    """
+    rng         = np.random.default_rng(seed)
+    rad_enum    = get_rad_enum(radar)
+    hdw         = SuperDARNRadars.radars[rad_enum].hardware_info
+    if n_beams is None:
+        n_beams = hdw.beams
+    if gaps is None:
+        gaps = []
+    if waves is None:
+        waves = []
+
+    fov     = get_synthetic_fov(radar,n_beams,n_gates,rsep=rsep,frang=frang,date=sTime,fovModel=fovModel)
+
+    times   = []
+    scan_time   = sTime
+    while scan_time < eTime:
+        in_gap  = any([gap[0] <= scan_time < gap[1] for gap in gaps])
+        if not in_gap:
+            times.append(scan_time)
+        scan_time += datetime.timedelta(seconds=scan_s)
+    times   = np.array(times)
+    n_times = len(times)
+
+    # Cell positions in km east and north of the radar.
+    lat0    = np.radians(hdw.geographic.lat)
+    x_km    = Re * np.cos(lat0) * np.radians(fov['lonCenter'] - hdw.geographic.lon)
+    y_km    = Re * np.radians(fov['latCenter'] - hdw.geographic.lat)
+
+    t_s     = np.array([(tm - sTime).total_seconds() for tm in times])
+    t_s     = t_s[:,None,None] + (np.arange(n_beams) * scan_s/n_beams)[None,:,None]
+
+    data    = background_db + noise_db*rng.standard_normal((n_times,n_beams,n_gates))
+    for wave in waves:
+        k       = 2.*np.pi / wave['wavelength_km']
+        kx      = k * np.sin(np.radians(wave['azimuth_deg']))
+        ky      = k * np.cos(np.radians(wave['azimuth_deg']))
+        omega   = 2.*np.pi / (wave['period_min']*60.)
+        phase   = np.radians(wave.get('phase_deg',0.))
+        data   += wave['amplitude_db'] * np.cos(kx*x_km + ky*y_km - omega*t_s + phase)
+
+    gflg    = rng.random(data.shape) < gs_fraction
+    if gscat == 1:
+        data[~gflg] = np.nan
+    elif gscat == 2:
+        data[gflg]  = np.nan
+    data[rng.random(data.shape) < missing_fraction] = np.nan
+
+    # Scan and beam times for the radar operational parameters.
+    prm = {'time':[],'scan':[],'rsep':[],'frang':[],'nrang':[],'bmazm':[]}
+    for tm in times:
+        for beam in range(n_beams):
+            prm['time'].append(tm + datetime.timedelta(seconds=beam*scan_s/n_beams))
+            prm['scan'].append(1 if beam == 0 else 0)
+            prm['rsep'].append(rsep)
+            prm['frang'].append(frang)
+            prm['nrang'].append(n_gates)
+            prm['bmazm'].append(hdw.boresight.physical + (beam - (n_beams-1)/2.)*hdw.beam_separation)
+
+    dataObj = music.musicArray(None)
+    dataObj.messages = []
+    if n_times == 0:
+        dataObj.messages.append('No data for this time period.')
+        return dataObj
+
+    metadata = {}
+    metadata['dType']     = 'dmap'
+    metadata['stid']      = hdw.stid
+    metadata['name']      = ' ' + SuperDARNRadars.radars[rad_enum].name
+    metadata['code']      = ' ' + hdw.abbrev
+    metadata['fType']     = 'fitacf'
+    metadata['cp']        = cp
+    metadata['channel']   = 'all'
+    metadata['sTime']     = sTime
+    metadata['eTime']     = eTime
+    metadata['param']     = 'p_l'
+    metadata['gscat']     = gscat
+    metadata['elevation'] = None
+    metadata['model']     = fovModel
+    metadata['coords']    = 'geo'
+    metadata['synthetic'] = True
+    dataSet = 'DS000_originalFit'
+    metadata['dataSetName'] = dataSet
+    metadata['serial']      = 0
+    comment = '['+dataSet+'] '+ 'Original Fit Data'
+
+    newSigObj = music.musicDataObj(times,data,fov=fov,parent=dataObj,comment=comment)
+    newSigObj.metadata = metadata
+    setattr(dataObj,dataSet,newSigObj)
+    newSigObj.setActive()
+
+    dataObj.prm = prm
+    return dataObj
+
+def save_synthetic_music_obj(hdf5_path,*args,**kwargs):
+    """
+    Save a make_synthetic_music_obj() musicArray to hdf5_path so that it can
+    be used as the srcPath of run_music(). Returns the musicArray.
+    """
+    dataObj = make_synthetic_music_obj(*args,**kwargs)
+    saveMusicArrayToHDF5(dataObj,hdf5_path)
+    return dataObj
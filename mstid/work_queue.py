@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+"""
+Lease-based work queue so that several hosts can share one MUSIC run.
+
+Events are put on the queue by get_events_and_run(executor='queue'). Any host
+that mounts the same data_path can then run run_queue_worker() (or the
+./run_queue_worker.py script) to pull events off the queue.
+
+A worker claims an event by taking a lease on it. While the event is running
+the worker renews the lease with a heartbeat. If a worker crashes, its lease
+expires and the event is claimed again by another worker, up to max_attempts
+times.
+
+Two queue backends share the same interface:
+    MongoWorkQueue: Leases are stored in the lease_* fields of the event
+                        records in the MongoDB mstid_list collections.
+    FileWorkQueue:  Leases are stored in JSON files in a directory, for use
+                        without MongoDB. The directory must be on a file
+                        system that supports fcntl locks.
+
+Lease fields of each item:
+    lease_state:        'queued', 'claimed', 'done', or 'failed'
+    lease_event:        Event dictionary passed to run_music()
+    lease_owner:        '<hostname>:<pid>' of the worker holding the lease
+    lease_claimed:      Time the lease was taken
+    lease_heartbeat:    Time the lease was last renewed
+    lease_expires:      Time after which the lease may be claimed again
+    lease_attempts:     Number of times the item has been claimed
+    lease_error:        Traceback of the last failure
+"""
+import os
+import glob
+import json
+import time
+import fcntl
+import socket
+import datetime
+import threading
+import traceback
+import concurrent.futures
+
+import pymongo
+
+from .more_music import get_hdf5_name
+
+def get_owner_id():
+    return '{!s}:{!s}'.format(socket.gethostname(),os.getpid())
+
+def _event_to_doc(event):
+    """
+    Convert an event dictionary from events_from_mongo() into something that
+    can be stored in MongoDB or JSON.
+    """
+    doc = dict(event)
+    doc['process_level'] = str(doc.get('process_level'))
+    return doc
+
+class MongoWorkQueue(object):
+    def __init__(self,mstid_lists,db_name='mstid',mongo_port=27017,
+            lease_seconds=900,max_attempts=3,owner=None):
+        """
+        Work queue whose leases are stored in the event records of the given
+        mstid_list collections.
+
+        lease_seconds:  How long a lease lasts without a heartbeat.
+        max_attempts:   Give up on an event after it has been claimed this
+                            many times, e.g. because it keeps crashing its
+                            worker.
+        """
+        if isinstance(mstid_lists,str):
+            mstid_lists = [mstid_lists]
+        self.mstid_lists    = list(mstid_lists)
+        self.db_name        = db_name
+        self.mongo_port     = mongo_port
+        self.lease_seconds  = lease_seconds
+        self.max_attempts   = max_attempts
+        self.owner          = get_owner_id() if owner is None else owner
+
+        self.mongo          = pymongo.MongoClient(port=mongo_port)
+        self.db             = self.mongo[db_name]
+
+    def enqueue(self,events):
+        """
+        Queue events from events_from_mongo(). Events currently leased by a
+        live worker are left alone.
+        """
+        now         = datetime.datetime.utcnow()
+        requests    = {}
+        for event in events:
+            mstid_list  = event['mstid_list']
+            if mstid_list not in self.mstid_lists:
+                self.mstid_lists.append(mstid_list)
+
+            query   = {'radar':event['radar'],'sDatetime':event['sTime'],'fDatetime':event['eTime'],
+                       '$or':[{'lease_state':{'$ne':'claimed'}},{'lease_expires':{'$lt':now}}]}
+            update  = {'$set':{'lease_state':'queued','lease_event':_event_to_doc(event),
+                       'lease_owner':None,'lease_expires':None,'lease_attempts':0,
+                       'lease_error':None}}
+            requests.setdefault(mstid_list,[]).append(pymongo.UpdateOne(query,update))
+
+        for mstid_list,reqs in requests.items():
+            self.db[mstid_list].bulk_write(reqs,ordered=False)
+
+    def claim(self):
+        """
+        Lease the next available event. Returns a work item dictionary, or
+        None if nothing can be claimed right now.
+        """
+        for mstid_list in self.mstid_lists:
+            while True:
+                now     = datetime.datetime.utcnow()
+                query   = {'$or':[{'lease_state':'queued'},
+                                  {'lease_state':'claimed','lease_expires':{'$lt':now}}]}
+                update  = {'$set':{'lease_state':'claimed','lease_owner':self.owner,
+                            'lease_claimed':now,'lease_heartbeat':now,
+                            'lease_expires':now+datetime.timedelta(seconds=self.lease_seconds)},
+                           '$inc':{'lease_attempts':1}}
+                rec     = self.db[mstid_list].find_one_and_update(query,update,
+                            sort=[('sDatetime',1)],return_document=pymongo.ReturnDocument.AFTER)
+                if rec is None:
+                    break
+
+                item = {'mstid_list':mstid_list,'_id':rec['_id'],'event':rec['lease_event'],
+                        'attempts':rec['lease_attempts']}
+                if item['attempts'] > self.max_attempts:
+                    self.fail(item,'Lease expired {!s} times.'.format(self.max_attempts))
+                    continue
+                return item
+
+    def _update_lease(self,item,update):
+        result = self.db[item['mstid_list']].update_one(
+                {'_id':item['_id'],'lease_owner':self.owner},update)
+        return result.modified_count == 1
+
+    def heartbeat(self,item):
+        """
+        Renew the lease of an item. Returns False if the lease has been lost.
+        """
+        now = datetime.datetime.utcnow()
+        return self._update_lease(item,{'$set':{'lease_heartbeat':now,
+                'lease_expires':now+datetime.timedelta(seconds=self.lease_seconds)}})
+
+    def complete(self,item):
+        return self._update_lease(item,{'$set':{'lease_state':'done','lease_expires':None}})
+
+    def fail(self,item,error=None):
+        return self._update_lease(item,{'$set':{'lease_state':'failed','lease_expires':None,
+                'lease_error':error}})
+
+    def counts(self):
+        """
+        Returns a dictionary of {lease_state: number of items}.
+        """
+        counts = {}
+        for mstid_list in self.mstid_lists:
+            crsr = self.db[mstid_list].aggregate([
+                {'$match':{'lease_state':{'$exists':True}}},
+                {'$group':{'_id':'$lease_state','count':{'$sum':1}}}])
+            for rec in crsr:
+                counts[rec['_id']] = counts.get(rec['_id'],0) + rec['count']
+        return counts
+
+class FileWorkQueue(object):
+    def __init__(self,queue_dir='work_queue',lease_seconds=900,max_attempts=3,owner=None):
+        """
+        Work queue stored as one JSON file per event in queue_dir. All
+        changes are made while holding an fcntl lock on queue_dir/lock.
+        """
+        self.queue_dir      = queue_dir
+        self.lease_seconds  = lease_seconds
+        self.max_attempts   = max_attempts
+        self.owner          = get_owner_id() if owner is None else owner
+
+        if not os.path.exists(queue_dir):
+            os.makedirs(queue_dir)
+        self.lock_path      = os.path.join(queue_dir,'lock')
+
+    def _lock(self):
+        fl = open(self.lock_path,'a')
+        fcntl.flock(fl,fcntl.LOCK_EX)
+        return fl
+
+    def _read(self,path):
+        with open(path,'r') as fl:
+            doc = json.load(fl)
+        for key in ['lease_expires','lease_claimed','lease_heartbeat']:
+            if doc.get(key) is not None:
+                doc[key] = datetime.datetime.fromisoformat(doc[key])
+        event = doc['lease_event']
+        for key in ['sTime','eTime']:
+            event[key] = datetime.datetime.fromisoformat(event[key])
+        return doc
+
+    def _write(self,path,doc):
+        tmp_path = path + '.tmp'
+        with open(tmp_path,'w') as fl:
+            json.dump(doc,fl,indent=4,sort_keys=True,default=str)
+        os.replace(tmp_path,path)
+
+    def _item_path(self,event):
+        fname   = get_hdf5_name(event['radar'],event['sTime'],event['eTime'])[:-3]
+        fname   = '{!s}-{!s}.json'.format(event.get('mstid_list'),fname)
+        return os.path.join(self.queue_dir,fname)
+
+    def _item_paths(self):
+        return sorted(glob.glob(os.path.join(self.queue_dir,'*.json')))
+
+    def enqueue(self,events):
+        now = datetime.datetime.utcnow()
+        lock = self._lock()
+        try:
+            for event in events:
+                path = self._item_path(event)
+                if os.path.exists(path):
+                    doc = self._read(path)
+                    if doc['lease_state'] == 'claimed' and doc['lease_expires'] >= now:
+                        continue
+                doc = {'lease_state':'queued','lease_event':_event_to_doc(event),
+                       'lease_owner':None,'lease_expires':None,'lease_attempts':0,
+                       'lease_error':None}
+                self._write(path,doc)
+        finally:
+            lock.close()
+
+    def claim(self):
+        lock = self._lock()
+        try:
+            for path in self._item_paths():
+                now = datetime.datetime.utcnow()
+                doc = self._read(path)
+                if doc['lease_state'] == 'queued':
+                    pass
+                elif doc['lease_state'] == 'claimed' and doc['lease_expires'] < now:
+                    pass
+                else:
+                    continue
+
+                doc['lease_state']      = 'claimed'
+                doc['lease_owner']      = self.owner
+                doc['lease_claimed']    = now
+                doc['lease_heartbeat']  = now
+                doc['lease_expires']    = now+datetime.timedelta(seconds=self.lease_seconds)
+                doc['lease_attempts']   = doc.get('lease_attempts',0) + 1
+                if doc['lease_attempts'] > self.max_attempts:
+                    doc['lease_state']  = 'failed'
+                    doc['lease_error']  = 'Lease expired {!s} times.'.format(self.max_attempts)
+                    self._write(path,doc)
+                    continue
+                self._write(path,doc)
+
+                return {'path':path,'event':doc['lease_event'],'attempts':doc['lease_attempts']}
+        finally:
+            lock.close()
+
+    def _update_lease(self,item,update):
+        lock = self._lock()
+        try:
+            doc = self._read(item['path'])
+            if doc['lease_owner'] != self.owner:
+                return False
+            doc.update(update)
+            self._write(item['path'],doc)
+            return True
+        finally:
+            lock.close()
+
+    def heartbeat(self,item):
+        now = datetime.datetime.utcnow()
+        return self._update_lease(item,{'lease_heartbeat':now,
+                'lease_expires':now+datetime.timedelta(seconds=self.lease_seconds)})
+
+    def complete(self,item):
+        return self._update_lease(item,{'lease_state':'done','lease_expires':None})
+
+    def fail(self,item,error=None):
+        return self._update_lease(item,{'lease_state':'failed','lease_expires':None,
+                'lease_error':error})
+
+    def counts(self):
+        counts = {}
+        for path in self._item_paths():
+            with open(path,'r') as fl:
+                state = json.load(fl)['lease_state']
+            counts[state] = counts.get(state,0) + 1
+        return counts
+
+def run_queue_worker(work_queue,nprocs=None,max_events_per_worker=None,max_rss_mb=None,
+        poll_seconds=30.,mem_budget_mb=None):
+    """
+    Pull events off work_queue and run them on this host with a
+    worker_pool.WorkerPool until the queue has no queued or claimed items
+    left. Leases of running events are renewed every lease_seconds/3.
+
+    While other hosts still hold leases, this keeps polling so that it can
+    pick up their events if their leases expire.
+
+    mem_budget_mb: Only claim another event while the estimated peak memory
+        of the events running on this host fits in this many MB (see
+        more_music.estimate_event_mem_mb()).
+    """
+    import multiprocessing
+    from .worker_pool import WorkerPool
+    from .more_music import generate_initial_param_file, estimate_event_mem_mb
+    from .run_helper import init_event_worker, run_init_file_logged
+
+    if nprocs is None:
+        nprocs = multiprocessing.cpu_count()
+
+    running = {}
+    mem_mb  = {}
+    lock    = threading.Lock()
+    stop    = threading.Event()
+
+    def beat():
+        while not stop.wait(work_queue.lease_seconds/3.):
+            with lock:
+                items = list(running.values())
+            for item in items:
+                if not work_queue.heartbeat(item):
+                    print('Lost lease on {!s}'.format(item['event']))
+
+    heart           = threading.Thread(target=beat)
+    heart.daemon    = True
+    heart.start()
+
+    n_done      = 0
+    n_failed    = 0
+    try:
+        with WorkerPool(nprocs,max_events_per_worker=max_events_per_worker,
+                max_rss_mb=max_rss_mb,initializer=init_event_worker,
+                mem_budget_mb=mem_budget_mb) as pool:
+            while True:
+                while len(running) < nprocs:
+                    if mem_budget_mb is not None and len(running) > 0:
+                        # Leave room for an event at least as large as the
+                        # largest one running.
+                        if sum(mem_mb.values()) + max(mem_mb.values()) > mem_budget_mb:
+                            break
+                    item = work_queue.claim()
+                    if item is None:
+                        break
+                    init_file   = generate_initial_param_file(item['event'])
+                    this_mem_mb = estimate_event_mem_mb(**item['event'])
+                    future      = pool.submit(run_init_file_logged,init_file,this_mem_mb)
+                    mem_mb[future] = this_mem_mb
+                    with lock:
+                        running[future] = item
+
+                if len(running) == 0:
+                    counts = work_queue.counts()
+                    if counts.get('queued',0) == 0 and counts.get('claimed',0) == 0:
+                        break
+                    time.sleep(poll_seconds)
+                    continue
+
+                done, not_done = concurrent.futures.wait(list(running.keys()),timeout=poll_seconds,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    with lock:
+                        item = running.pop(future)
+                    mem_mb.pop(future)
+                    error = future.exception()
+                    if error is None:
+                        work_queue.complete(item)
+                        n_done += 1
+                    else:
+                        print('Work queue: {!s} failed:\n{!s}'.format(item['event'],error))
+                        work_queue.fail(item,str(error))
+                        n_failed += 1
+    finally:
+        stop.set()
+
+    print('Work queue: {!s} events done, {!s} failed on {!s}.'.format(n_done,n_failed,get_owner_id()))
+    return n_done, n_failed
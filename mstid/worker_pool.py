@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+"""
+Persistent worker pool for running many MUSIC events without paying the
+interpreter and import start-up cost for every event.
+
+Each worker is a long-lived multiprocessing.Process that pulls events from a
+shared task queue. To keep the memory-leak isolation that launching one
+process per event used to give us, a worker retires after it has processed
+max_events_per_worker events or once its resident memory grows past
+max_rss_mb. Retired (or crashed) workers are replaced automatically while
+there is still work in the queue.
+
+Tasks may be submitted from several threads at once (see mstid.pipeline),
+so one pool can be shared by all stages of a run.
+
+If mem_budget_mb is given, each task may carry an estimate of its peak
+memory (e.g. from more_music.estimate_event_mem_mb()). Tasks are only handed
+to the workers while the estimates of the running tasks fit in the budget,
+so nprocs becomes an upper limit rather than a fixed number of processes.
+"""
+import os
+import gc
+import queue
+import threading
+import collections
+import traceback
+import multiprocessing
+import concurrent.futures
+
+from .general_lib import get_rss_mb
+
+def _worker_loop(task_queue,result_queue,current_task,max_events_per_worker,
+        max_rss_mb,initializer,initargs):
+    """
+    Main loop run inside each worker process.
+
+    Messages sent back to the parent are tuples of
+    (status, pid, task_id, payload) where status is one of 'done', 'error',
+    or 'retired'. The id of the task being worked on is also written to the
+    shared current_task value so that the parent can tell which task was
+    lost if the worker dies without reporting back.
+    """
+    pid = os.getpid()
+    if initializer is not None:
+        initializer(*initargs)
+
+    n_events    = 0
+    reason      = 'shutdown'
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+
+        task_id, func, arg = task
+        current_task.value = task_id
+        try:
+            result  = func(arg)
+            result_queue.put(('done',pid,task_id,result))
+        except Exception:
+            result_queue.put(('error',pid,task_id,traceback.format_exc()))
+
+        gc.collect()
+        n_events += 1
+        if max_events_per_worker and n_events >= max_events_per_worker:
+            reason  = 'max_events'
+            break
+        if max_rss_mb and get_rss_mb() > max_rss_mb:
+            reason  = 'max_rss'
+            break
+
+    result_queue.put(('retired',pid,None,(reason,n_events)))
+
+class WorkerError(Exception):
+    """
+    Raised for a task that failed inside a worker. The message holds the
+    traceback from the worker process.
+    """
+    pass
+
+class WorkerPool(object):
+    def __init__(self,nprocs=None,max_events_per_worker=None,max_rss_mb=None,
+            initializer=None,initargs=(),mem_budget_mb=None,start_method=None):
+        """
+        Pool of persistent worker processes that are recycled after
+        max_events_per_worker events or when their RSS exceeds max_rss_mb.
+
+        nprocs:                 Number of simultaneous workers.
+                                    Defaults to multiprocessing.cpu_count().
+        max_events_per_worker:  Retire a worker after this many events.
+                                    None means never retire on event count.
+        max_rss_mb:             Retire a worker after an event if its resident
+                                    memory is larger than this (in MB).
+        initializer:            Function called once when each worker starts,
+                                    e.g. to configure matplotlib and logging.
+        mem_budget_mb:          Total estimated memory (in MB) of the tasks
+                                    allowed to run at once. A task larger
+                                    than the budget still runs, but alone.
+                                    None means only nprocs limits the number
+                                    of running tasks.
+        start_method:           multiprocessing start method of the workers
+                                    ('fork', 'spawn' or 'forkserver'). None
+                                    uses the platform default. Use
+                                    'forkserver' or 'spawn' when tasks are
+                                    submitted from several threads (see
+                                    mstid.pipeline): workers are started
+                                    while those threads run, and forking a
+                                    multithreaded process is unsafe.
+        """
+        if nprocs is None:
+            nprocs = multiprocessing.cpu_count()
+
+        self.nprocs                 = nprocs
+        self.max_events_per_worker  = max_events_per_worker
+        self.max_rss_mb             = max_rss_mb
+        self.initializer            = initializer
+        self.initargs               = initargs
+        self.mem_budget_mb          = mem_budget_mb
+        self.context                = multiprocessing.get_context(start_method)
+
+        self.task_queue             = self.context.Queue()
+        self.result_queue           = self.context.Queue()
+        self.workers                = {}
+        self.tasks                  = {}
+        self.pending                = collections.deque()
+        self.admitted               = {}
+        self.admitted_mb            = 0.
+        self.n_spawned              = 0
+        self.n_submitted            = 0
+        self.n_retired              = 0
+        self.closed                 = False
+
+        self.lock                   = threading.Lock()
+        self.manager                = None
+
+    def _spawn(self):
+        current_task    = self.context.Value('l',-1,lock=False)
+        args    = (self.task_queue,self.result_queue,current_task,
+                   self.max_events_per_worker,self.max_rss_mb,
+                   self.initializer,self.initargs)
+        proc    = self.context.Process(target=_worker_loop,args=args)
+        proc.daemon = True
+        proc.start()
+        self.workers[proc.pid]  = {'proc':proc,'current_task':current_task}
+        self.n_spawned         += 1
+        return proc
+
+    def _remove(self,pid):
+        worker = self.workers.pop(pid,None)
+        if worker is not None:
+            worker['proc'].join()
+            self.n_retired += 1
+        return worker
+
+    def _admit(self):
+        """
+        Move pending tasks to the task queue, in order, while there are free
+        processes and the memory budget allows. Must be called with the lock
+        held.
+        """
+        while len(self.pending) > 0 and len(self.admitted) < self.nprocs:
+            task_id, func, arg, mem_mb = self.pending[0]
+            if self.mem_budget_mb is not None and len(self.admitted) > 0:
+                if self.admitted_mb + mem_mb > self.mem_budget_mb:
+                    break
+            self.pending.popleft()
+            self.admitted[task_id]  = mem_mb
+            self.admitted_mb       += mem_mb
+            self.task_queue.put((task_id,func,arg))
+
+    def _finish(self,task_id,result=None,error=None):
+        with self.lock:
+            task = self.tasks.pop(task_id,None)
+            mem_mb = self.admitted.pop(task_id,None)
+            if mem_mb is not None:
+                self.admitted_mb -= mem_mb
+            self._admit()
+        if task is None:
+            return
+        future, item = task
+        if error is None:
+            future.set_result(result)
+        else:
+            future.set_exception(WorkerError(error))
+
+    def _manage(self):
+        """
+        Runs in a background thread: keeps the pool at full strength while
+        there are outstanding tasks and hands results back to the futures.
+        """
+        while True:
+            with self.lock:
+                n_tasks = len(self.tasks)
+                if self.closed and n_tasks == 0:
+                    break
+                self._admit()
+                n_needed = len(self.admitted) - len(self.workers)
+                for inx in range(n_needed):
+                    self._spawn()
+
+            try:
+                status, pid, task_id, payload = self.result_queue.get(timeout=1.)
+            except queue.Empty:
+                # No messages pending, so any dead worker has crashed
+                # (e.g. segfault or killed by the OOM killer).
+                with self.lock:
+                    dead = [pid for pid,worker in self.workers.items()
+                            if not worker['proc'].is_alive()]
+                    dead = [(pid,self._remove(pid)) for pid in dead]
+                for pid,worker in dead:
+                    exitcode    = worker['proc'].exitcode
+                    msg         = 'Worker {!s} died with exit code {!s}.'.format(pid,exitcode)
+                    self._finish(worker['current_task'].value,error=msg)
+                continue
+
+            if status == 'retired':
+                with self.lock:
+                    self._remove(pid)
+            elif status == 'done':
+                self._finish(task_id,result=payload)
+            elif status == 'error':
+                self._finish(task_id,error=payload)
+
+    def submit(self,func,arg,mem_mb=0.):
+        """
+        Queue func(arg) to run in a worker. Returns a
+        concurrent.futures.Future. This may be called from any thread.
+
+        mem_mb: Estimated peak memory of the task, used with mem_budget_mb.
+        """
+        future = concurrent.futures.Future()
+        with self.lock:
+            if self.closed:
+                raise ValueError('WorkerPool is closed.')
+            task_id             = self.n_submitted
+            self.n_submitted   += 1
+            self.tasks[task_id] = (future,arg)
+            self.pending.append((task_id,func,arg,mem_mb))
+            self._admit()
+
+            if self.manager is None:
+                self.manager        = threading.Thread(target=self._manage)
+                self.manager.daemon = True
+                self.manager.start()
+        return future
+
+    def map(self,func,iterable,mem_mb=None):
+        """
+        Apply func to every item of iterable using the pool workers and return
+        a list of results in input order. mem_mb is an optional list with the
+        estimated peak memory of each item.
+
+        As with multiprocessing.Pool.map(), an exception is raised if any item
+        fails. Unlike Pool.map(), all items are still attempted first so that
+        one bad event does not abort the rest of the run.
+        """
+        items   = list(iterable)
+        if mem_mb is None:
+            mem_mb  = [0.] * len(items)
+        futures = [self.submit(func,item,mem) for item,mem in zip(items,mem_mb)]
+        concurrent.futures.wait(futures)
+
+        results = []
+        failed  = []
+        for item,future in zip(items,futures):
+            error = future.exception()
+            if error is None:
+                results.append(future.result())
+            else:
+                print('WorkerPool: {!s} failed:\n{!s}'.format(item,error))
+                results.append(None)
+                failed.append(item)
+
+        if len(failed) > 0:
+            raise RuntimeError('{!s} of {!s} tasks failed: {!s}'.format(len(failed),len(items),failed))
+
+        return results
+
+    def close(self):
+        """
+        Wait for all submitted tasks to finish, then tell the workers to exit
+        and wait for them.
+        """
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+        if self.manager is not None:
+            self.manager.join()
+
+        with self.lock:
+            for pid in list(self.workers.keys()):
+                self.task_queue.put(None)
+            for pid in list(self.workers.keys()):
+                self.workers[pid]['proc'].join()
+                self.workers.pop(pid)
+
+    def terminate(self):
+        """
+        Kill all workers immediately. Outstanding tasks are cancelled.
+        """
+        with self.lock:
+            self.closed = True
+            for pid,worker in list(self.workers.items()):
+                worker['proc'].terminate()
+                worker['proc'].join()
+                self.workers.pop(pid)
+            tasks       = list(self.tasks.values())
+            self.tasks  = {}
+            self.pending.clear()
+            self.admitted.clear()
+            self.admitted_mb = 0.
+        for future,item in tasks:
+            future.cancel()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
@@ -25,7 +25,7 @@ import matplotlib.pyplot as plt
 import mstid
 from mstid import run_helper
 
-from hdf5_api import loadMusicArrayFromHDF5
+from hdf5_api import loadMusicArrayFromHDF5, closeMusicArrayHDF5
 
 plt.rcParams['font.size'] = 16
 # plt.rcParams['font.weight'] = 'bold'
@@ -226,33 +226,40 @@ for radar, radar_summary in summary.items():
                 print(f"  WARNING: HDF5 file {hdf_file} not found.")
                 continue
 
-            musicObj = loadMusicArrayFromHDF5(hdf_file)
+            # Only one beam of the original data is used; read it from the file on access.
+            musicObj = loadMusicArrayFromHDF5(hdf_file,datasets=['DS000_originalFit'],
+                                              fields=['time','fov','data'],lazy=True)
+            # The file stays open until closeMusicArrayHDF5(), so close it on every path out of this block.
             try:
-                ds       = musicObj.DS000_originalFit
-            except:
-                print(f"  WARNING: HDF5 file {hdf_file} has no DS000_originalFit.")
-                continue
+                try:
+                    ds       = musicObj.DS000_originalFit
+                except:
+                    print(f"  WARNING: HDF5 file {hdf_file} has no DS000_originalFit.")
+                    continue
 
-            time_tf  = np.logical_and(ds.time >= sTime, ds.time < eTime)
+                time_tf  = np.logical_and(ds.time >= sTime, ds.time < eTime)
 
-            # Get range of raw data.
-            my_range_km = ds.fov['slantRCenter'][beam]
-            range_tf    = np.isfinite(my_range_km)
-            my_range_km = my_range_km[range_tf]
+                # Get range of raw data.
+                my_range_km = ds.fov['slantRCenter'][beam]
+                range_tf    = np.isfinite(my_range_km)
+                my_range_km = my_range_km[range_tf]
 
-            # Get time vector of raw data in minutes relative to sTime.
-            my_time     = ds.time[time_tf]
-            my_time_mn  = my_time - sTime
-            my_time_mn  = np.array([x.total_seconds() for x in my_time_mn])/60.
-            
-            # Get data array of raw data.
-            try:
-                my_data     = ds.data[time_tf,beam,:]
-                my_data     = my_data[:,range_tf]
-                win_data    = (interpn((my_time_mn,my_range_km), my_data, (Tq, Rq), method='linear',bounds_error=False)).T  # shape (len(win_time_mn), len(win_rng_km))
-            except:
-                print(f"  WARNING: HDF5 file {hdf_file} appears to be an empty array.")
-                continue
+                # Get time vector of raw data in minutes relative to sTime.
+                my_time     = ds.time[time_tf]
+                my_time_mn  = my_time - sTime
+                my_time_mn  = np.array([x.total_seconds() for x in my_time_mn])/60.
+                
+                # Get data array of raw data.
+                try:
+                    my_data     = ds.readSlice('data',(slice(None),beam))[time_tf,:]
+                    my_data     = my_data[:,range_tf]
+                    win_data    = (interpn((my_time_mn,my_range_km), my_data, (Tq, Rq), method='linear',bounds_error=False)).T  # shape (len(win_time_mn), len(win_rng_km))
+                except:
+                    print(f"  WARNING: HDF5 file {hdf_file} appears to be an empty array.")
+                    continue
+            finally:
+                if musicObj is not None:
+                    closeMusicArrayHDF5(musicObj)
 
             # Get indices for this event's data in the summary array.
             dinx_0, dinx_1 = rtp_summary.get_date_inxs(sTime)
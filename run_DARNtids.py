@@ -72,107 +72,164 @@ base_dir                    = os.path.join('mstid_data',db_name)
 # Used for creating an SSH tunnel when running the MSTID database on a remote machine.
 #tunnel,mongo_port           = mstid.createTunnel() 
 
-for year in years:
-    dct                             = {}
-#    dct['fovModel']                 = 'HALF_SLANT'
-    dct['fovModel']                 = 'GS'
-    dct['radars']                   = radars
-#    dct['list_sDate']               = datetime.datetime(year,  11,1)
-#    dct['list_eDate']               = datetime.datetime(year+1, 5,1)
-#    dct['list_sDate']               = datetime.datetime(year,12,1)
-#    dct['list_eDate']               = datetime.datetime(year + 1,1,31)
-    dct['list_sDate']               = datetime.datetime(year,1,1)
-    dct['list_eDate']               = datetime.datetime(year,12,31)
-    dct['hanning_window_space']     = False # Set to False for MSTID Index Calculation
-    dct['bad_range_km']             = None  # Set to None for MSTID Index Calculation
-    #dct['mongo_port']              = mongo_port
-    dct['db_name']                  = db_name
-    dct['data_path']                = os.path.join(base_dir,'mstid_index')
-    dct['boxcar_filter']            = False
-    dct['fitacf_dir']               = '/data/sd-data_fitexfilter'
-    dct['slt_range']                     = None # Default is (6,18) # Range of local times sent to mongo_tools.generate_mongo_list()
-    dct['rti_fraction_threshold']        = 0.25 # Default is 0.675 was used in Frissel et al. [2016]; 0.25 used in Frissel et al. [2025]
-    dct['terminator_fraction_threshold'] = 1.0. # Default is 0.0
-
-    # Takes dct and explodes it into run_helper function
-    dct_list                        = run_helper.create_music_run_list(**dct)
-    #import ipdb; ipdb.set_trace()
-
-    mstid_index         = True
-    new_list            = True      # Create a completely fresh list of events in MongoDB. Delete an old list if it exists.
-    recompute           = False     # Recalculate all events from raw data. If False, use existing cached hdf5 files.
-    reupdate_db         = True 
-
-    music_process       = False
-    music_new_list      = True
-    music_reupdate_db   = True
-
-    nprocs              = 60
-    multiproc           = True
-
-    # Classification parameters go here. ###########################################
-    classification_path = os.path.join(base_dir,'classification')
-
-    #******************************************************************************#
-    # No User Input Below This Line ***********************************************#
-    #******************************************************************************#
-    if mstid_index:
-        # Generate MSTID List and do rti_interp level processing.
-        run_helper.get_events_and_run(dct_list,process_level='rti_interp',new_list=new_list,
-                recompute=recompute,multiproc=multiproc,nprocs=nprocs,**dct)
-        # Reload RTI Data into MongoDb. ################################################
-        if reupdate_db:
-            for dct in dct_list:
-                mstid.updateDb_mstid_list(multiproc=multiproc,nprocs=nprocs,**dct)
-
-        for dct in dct_list:
-            # Determine if each event is good or bad based on:
-            #   1. Whether or not data is available.
-            #   2. Results of pyDARNmusic.utils.checkDataQuality()
-            #       (Ensures radar is operational for a minimum amount of time during the data window.
-            #        Default is to require the radar to be turned off no more than 10 minutes in the
-            #        data window.)
-            #   3. The fraction of radar scatter points present in the data window.
-            #       (Default requires minimum 67.5% data coverage.)
-            #   4. The percentage of daylight in the data window.
-            #       (Default requires 100% daylight in the data window.)
-            mstid.classify.classify_none_events(**dct) 
-
-            # Generate a web page and copy select figures into new directory to make it easier
-            # to evaluate data and see if classification algorithm is working.
-            mstid.classify.rcgb(classification_path=classification_path,**dct)
-
-        # Run FFT Level processing on unclassified events.
-        run_helper.get_events_and_run(dct_list,process_level='fft',category='unclassified',
-                multiproc=multiproc,nprocs=nprocs)
-
-        # Now run the real MSTID classification.
-        mstid.classify.run_mstid_classification(dct_list,classification_path=classification_path,
-                multiproc=multiproc,nprocs=5)
-        print("----------- DCT LIST ---------")
-        print(dct_list)
-        print('Plotting calendar plot...')
-        calendar_output_dir = os.path.join(base_dir,'calendar')
-        mstid.calendar_plot(dct_list,db_name=db_name,output_dir=calendar_output_dir)
-
-    # Run actual MUSIC Processing ##################################################
-    if music_process:
+# The pool workers of the pipeline mode are started with 'forkserver', which
+# imports this file in each worker; only the main process runs the processing.
+if __name__ == '__main__':
+    for year in years:
+        dct                             = {}
+    #    dct['fovModel']                 = 'HALF_SLANT'
+        dct['fovModel']                 = 'GS'
+        dct['radars']                   = radars
+    #    dct['list_sDate']               = datetime.datetime(year,  11,1)
+    #    dct['list_eDate']               = datetime.datetime(year+1, 5,1)
+    #    dct['list_sDate']               = datetime.datetime(year,12,1)
+    #    dct['list_eDate']               = datetime.datetime(year + 1,1,31)
+        dct['list_sDate']               = datetime.datetime(year,1,1)
+        dct['list_eDate']               = datetime.datetime(year,12,31)
+        dct['hanning_window_space']     = False # Set to False for MSTID Index Calculation
+        dct['bad_range_km']             = None  # Set to None for MSTID Index Calculation
+        #dct['mongo_port']              = mongo_port
+        dct['db_name']                  = db_name
+        dct['data_path']                = os.path.join(base_dir,'mstid_index')
+        dct['boxcar_filter']            = False
+        dct['fitacf_dir']               = '/data/sd-data_fitexfilter'
+        dct['slt_range']                     = None # Default is (6,18) # Range of local times sent to mongo_tools.generate_mongo_list()
+        dct['rti_fraction_threshold']        = 0.25 # Default is 0.675 was used in Frissel et al. [2016]; 0.25 used in Frissel et al. [2025]
+        dct['terminator_fraction_threshold'] = 1.0 # Default is 0.0
+        dct['resume']                        = False # True to continue events from their last saved processing level instead of reloading the raw data.
+        dct['instrument']                    = False # 'file', 'mongo', or 'both' to record per-stage timing; summarize with mstid.stage_timer.stage_report().
+        dct['retain_data_sets']              = 'all' # 'lean' keeps only the original and final data sets in memory and in the HDF5 files.
+        dct['hdf5_storage']                  = 'none' # 'lzf' or 'gzip' to compress the large arrays of the HDF5 files; see bench_hdf5_storage.py.
+
+        # Takes dct and explodes it into run_helper function
+        dct_list                        = run_helper.create_music_run_list(**dct)
+        #import ipdb; ipdb.set_trace()
+
+        mstid_index         = True
+        new_list            = True      # Create a completely fresh list of events in MongoDB. Delete an old list if it exists.
+        incremental_list    = False     # With new_list, only add missing events to an existing list instead of deleting it.
+        recompute           = False     # Recalculate all events from raw data. If False, use existing cached hdf5 files.
+        reupdate_db         = True 
+
+        music_process       = False
+        music_new_list      = True
+        music_reupdate_db   = True
+
+        nprocs              = 60        # Maximum number of MUSIC processes.
+        mem_budget_mb       = None      # With 'pool' or 'queue', only start events while their estimated peak memory fits in this
+                                        # many MB, e.g. 0.75*mstid.general_lib.get_total_mem_mb(). None: nprocs is the only limit.
+        multiproc           = True
+        executor            = 'subprocess' # 'subprocess' launches run_single_event.py per event; 'pool' keeps warm worker processes;
+                                        # 'queue' shares the events with other hosts running ./run_queue_worker.py (non-pipeline mode).
+        max_events_per_worker = 50      # Recycle pool workers after this many events...
+        max_rss_mb          = 4000      # ...or when a worker's memory grows beyond this (MB).
+        batch_by_day        = False     # True to load fitacf data once per radar-day and slice each window out of it.
+        use_pipeline        = False     # True to start each radar's next stage as soon as its previous stage is done (mstid.pipeline).
+        defer_plots         = False     # Render event figures from the saved HDF5 files after classification instead of
+                                        # inside each MUSIC run. The rcgb() web pages only show figures that already exist.
+        render_nprocs       = 10        # Worker processes for rendering deferred figures.
+        plot_types          = None      # List of figures to make (see mstid.more_music.MUSIC_PLOT_TYPES); None for all.
+
+        # Classification parameters go here. ###########################################
+        classification_path = os.path.join(base_dir,'classification')
+
+        #******************************************************************************#
+        # No User Input Below This Line ***********************************************#
+        #******************************************************************************#
         for dct in dct_list:
-            dct['input_mstid_list']     = dct['mstid_list']
-            dct['input_db_name']        = dct['db_name']
-            dct['input_mongo_port']     = dct['mongo_port']
-            dct['mstid_list']           = 'music_'+dct['mstid_list']
-            dct['data_path']            = os.path.join(base_dir,'music_data')
-            dct['hanning_window_space'] = True
-    #        dct['bad_range_km']         = 500 # Set to 500 for MUSIC Calculation
-            dct['bad_range_km']         = None # Set to None to match original calculations
-        run_helper.get_events_and_run(dct_list,process_level='music',
-                new_list=music_new_list,category=['mstid','quiet'],
-                multiproc=multiproc,nprocs=nprocs)
-
-        if music_reupdate_db:
-            for dct in dct_list:
-                mstid.updateDb_mstid_list(multiproc=multiproc,nprocs=nprocs,**dct)
+            dct['make_plots']   = 'deferred' if defer_plots else True
+            dct['plot_types']   = plot_types
+
+        if mstid_index and use_pipeline:
+            # Run rti_interp -> update_db -> classify_none -> fft -> classify for each
+            # radar list independently, sharing one pool of worker processes.
+            calendar_output_dir = os.path.join(base_dir,'calendar')
+            render_pool = None
+            if defer_plots:
+                render_pool = mstid.worker_pool.WorkerPool(render_nprocs,
+                        initializer=run_helper.init_event_worker,start_method='forkserver')
+            # The stages run in threads, so the workers must not be forked from this process.
+            with mstid.worker_pool.WorkerPool(nprocs,max_events_per_worker=max_events_per_worker,
+                    max_rss_mb=max_rss_mb,initializer=run_helper.init_event_worker,
+                    mem_budget_mb=mem_budget_mb,start_method='forkserver') as pool:
+                pipe = mstid.pipeline.build_mstid_index_pipeline(dct_list,pool,
+                        new_list=new_list,incremental=incremental_list,
+                        recompute=recompute,reupdate_db=reupdate_db,
+                        classification_path=classification_path,classify_nprocs=5,
+                        calendar_output_dir=calendar_output_dir,db_name=db_name,
+                        batch_by_day=batch_by_day,render_pool=render_pool,plot_types=plot_types)
+                pipe.run()
+            if render_pool is not None:
+                render_pool.close()
+        elif mstid_index:
+            # Generate MSTID List and do rti_interp level processing.
+            run_helper.get_events_and_run(dct_list,process_level='rti_interp',new_list=new_list,
+                    incremental=incremental_list,recompute=recompute,multiproc=multiproc,nprocs=nprocs,
+                    executor=executor,max_events_per_worker=max_events_per_worker,
+                    max_rss_mb=max_rss_mb,mem_budget_mb=mem_budget_mb,batch_by_day=batch_by_day,**dct)
+            # Reload RTI Data into MongoDb. ################################################
+            if reupdate_db:
+                for dct in dct_list:
+                    mstid.updateDb_mstid_list(multiproc=multiproc,nprocs=nprocs,**dct)
 
-#tunnel.kill()
-print("I'm done!")
+            for dct in dct_list:
+                # Determine if each event is good or bad based on:
+                #   1. Whether or not data is available.
+                #   2. Results of pyDARNmusic.utils.checkDataQuality()
+                #       (Ensures radar is operational for a minimum amount of time during the data window.
+                #        Default is to require the radar to be turned off no more than 10 minutes in the
+                #        data window.)
+                #   3. The fraction of radar scatter points present in the data window.
+                #       (Default requires minimum 67.5% data coverage.)
+                #   4. The percentage of daylight in the data window.
+                #       (Default requires 100% daylight in the data window.)
+                mstid.classify.classify_none_events(**dct) 
+
+                # Generate a web page and copy select figures into new directory to make it easier
+                # to evaluate data and see if classification algorithm is working.
+                mstid.classify.rcgb(classification_path=classification_path,**dct)
+
+            # Run FFT Level processing on unclassified events.
+            run_helper.get_events_and_run(dct_list,process_level='fft',category='unclassified',
+                    multiproc=multiproc,nprocs=nprocs,executor=executor,
+                    max_events_per_worker=max_events_per_worker,max_rss_mb=max_rss_mb,
+                    mem_budget_mb=mem_budget_mb,
+                    batch_by_day=batch_by_day)
+
+            # Now run the real MSTID classification.
+            mstid.classify.run_mstid_classification(dct_list,classification_path=classification_path,
+                    multiproc=multiproc,nprocs=5)
+            print("----------- DCT LIST ---------")
+            print(dct_list)
+            print('Plotting calendar plot...')
+            calendar_output_dir = os.path.join(base_dir,'calendar')
+            mstid.calendar_plot(dct_list,db_name=db_name,output_dir=calendar_output_dir)
+
+            if defer_plots:
+                for dct in dct_list:
+                    mstid.render_queue.render_mstid_list(nprocs=render_nprocs,**dct)
+
+        # Run actual MUSIC Processing ##################################################
+        if music_process:
+            for dct in dct_list:
+                dct['input_mstid_list']     = dct['mstid_list']
+                dct['input_db_name']        = dct['db_name']
+                dct['input_mongo_port']     = dct['mongo_port']
+                dct['mstid_list']           = 'music_'+dct['mstid_list']
+                dct['data_path']            = os.path.join(base_dir,'music_data')
+                dct['hanning_window_space'] = True
+        #        dct['bad_range_km']         = 500 # Set to 500 for MUSIC Calculation
+                dct['bad_range_km']         = None # Set to None to match original calculations
+            run_helper.get_events_and_run(dct_list,process_level='music',
+                    new_list=music_new_list,category=['mstid','quiet'],
+                    multiproc=multiproc,nprocs=nprocs,executor=executor,
+                    max_events_per_worker=max_events_per_worker,max_rss_mb=max_rss_mb,
+                    mem_budget_mb=mem_budget_mb,
+                    batch_by_day=batch_by_day)
+
+            if music_reupdate_db:
+                for dct in dct_list:
+                    mstid.updateDb_mstid_list(multiproc=multiproc,nprocs=nprocs,**dct)
+
+    #tunnel.kill()
+    print("I'm done!")
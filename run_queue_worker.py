@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+"""
+Help process a MUSIC run started on another host with
+run_helper.get_events_and_run(executor='queue').
+
+Events are claimed from the lease fields of the given MongoDB mstid_lists and
+run with a pool of worker processes on this host. This host must mount the
+same data_path as the host that queued the events.
+
+Usage: ./run_queue_worker.py <mstid_list> [<mstid_list> ...]
+"""
+import sys
+import matplotlib
+matplotlib.use('Agg')
+
+import mstid
+from mstid.work_queue import MongoWorkQueue, run_queue_worker
+
+db_name                 = 'mstid'
+mongo_port              = 27017
+nprocs                  = None  # Defaults to the number of CPUs.
+max_events_per_worker   = 50
+max_rss_mb              = 4000
+lease_seconds           = 900   # A crashed host's events are picked up again after this long.
+
+mstid_lists = sys.argv[1:]
+
+work_queue  = MongoWorkQueue(mstid_lists,db_name=db_name,mongo_port=mongo_port,
+        lease_seconds=lease_seconds)
+run_queue_worker(work_queue,nprocs=nprocs,max_events_per_worker=max_events_per_worker,
+        max_rss_mb=max_rss_mb)
+
+sys.exit()
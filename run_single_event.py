@@ -6,44 +6,27 @@ event to be launched as an independent process. By running each event as an
 independent system process, it makes very easy to:
     1. Stop/prevent memory leaks.
     2. Run events in parallel.
+
+If several initialization files for the same radar-day are given, they are run
+as one batch that loads the fitacf data only once.
 """
 import sys
-import os
-import datetime
 import matplotlib
 matplotlib.use('Agg')
 
-import logging
 import mstid
+from mstid.run_helper import init_event_worker, run_init_file_logged, \
+        run_init_file_batch_logged
 
-logger = logging.getLogger()
-class LogFilter(logging.Filter):
-    def __init__(self,message):
-        self.message = message
-    def filter(self, record):
-        return not record.getMessage().startswith(self.message)
-logger.addFilter(LogFilter('An error occured while defining limits.  No limits set.  Check your input values.'))
-
-init_param_file = sys.argv[1] 
-print(init_param_file)
-
-# Set up logging.
-log_dir = 'log'
-if not os.path.exists(log_dir):
-    os.makedirs(log_dir)
-log_path = os.path.join(log_dir,os.path.basename(init_param_file)+'.log')
-with open(log_path,'w') as fl:
-    fl.write('{!s}: Processing {!s}\n'.format(datetime.datetime.now(),init_param_file))
-logging.basicConfig(filename=log_path, encoding='utf-8', level=logging.WARN)
+init_event_worker()
 
-# Run MSTID/MUSIC processing.
-mstid.run_music_init_param_file(init_param_file)
+init_param_files = sys.argv[1:]
 
-# Delete log file if no real messages.
-with open(log_path,'r') as fl:
-    log = fl.readlines()
-if len(log) == 1:
-    os.remove(log_path)
+# Run MSTID/MUSIC processing, logging to log/<init_param_file>.log.
+if len(init_param_files) == 1:
+    run_init_file_logged(init_param_files[0])
+else:
+    run_init_file_batch_logged(init_param_files)
 
 # Exit the program.
 sys.exit()
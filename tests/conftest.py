@@ -0,0 +1,5 @@
+import os
+import sys
+
+# hdf5_api lives at the top of the repository, next to the mstid package.
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
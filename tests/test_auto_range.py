@@ -0,0 +1,37 @@
+"""
+more_music.auto_range_events() and auto_range_batch() against auto_range()
+on each event sliced from a synthetic radar-day.
+"""
+import datetime
+
+import numpy as np
+import pytest
+
+pyDARNmusic = pytest.importorskip('pyDARNmusic')
+
+from mstid import more_music, synthetic
+
+def test_auto_range_events_matches_auto_range():
+    day     = synthetic.make_synthetic_music_obj(sTime=datetime.datetime(2017,11,3,10),
+                eTime=datetime.datetime(2017,11,3,22),missing_fraction=0.3,seed=3)
+    # Drop the far gates in the afternoon so that the later events are
+    # sliced with fewer gates than the day has.
+    ds      = day.DS000_originalFit
+    ds.data[ds.time >= datetime.datetime(2017,11,3,15),:,55:] = np.nan
+
+    prms    = []
+    for hour in range(12,20,2):
+        for bad_range_km in [None,500]:
+            prms.append({'radar':'bks','sTime':datetime.datetime(2017,11,3,hour),
+                'eTime':datetime.datetime(2017,11,3,hour+2),'bad_range_km':bad_range_km})
+    prms.append(dict(prms[0],auto_range_on=False))
+
+    gate_limits = more_music.auto_range_events(day,prms)
+    assert gate_limits[-1] is None
+
+    for prm,limits in zip(prms[:-1],gate_limits[:-1]):
+        load_sTime,load_eTime = pyDARNmusic.filterTimes(prm['sTime'],prm['eTime'],60.,101.)
+        event   = more_music.slice_music_obj(day,load_sTime,load_eTime)
+        ref     = more_music.auto_range('bks',prm['sTime'],prm['eTime'],event,
+                    bad_range_km=prm['bad_range_km'])
+        assert tuple(limits) == tuple(ref)
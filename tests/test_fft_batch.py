@@ -0,0 +1,56 @@
+"""
+Failure reporting and logging of the deferred runs of more_music.FFTBatch.
+"""
+import datetime
+import logging
+
+import pytest
+
+pytest.importorskip('pyDARNmusic')
+
+from mstid import more_music, synthetic
+
+def make_event(seed):
+    return synthetic.make_synthetic_music_obj(sTime=datetime.datetime(2017,11,3,12),
+            eTime=datetime.datetime(2017,11,3,13),n_gates=20,waves=None,seed=seed)
+
+def test_flush_reports_failed_events_and_logs_to_their_files(tmp_path):
+    logging.getLogger().setLevel(logging.WARN)
+    log_a   = str(tmp_path/'a.json.log')
+    log_b   = str(tmp_path/'b.json.log')
+    spectra = {}
+
+    def finish_a():
+        spectra['a'] = event_a.active.spectrum
+        logging.warning('finishing a')
+
+    def finish_b():
+        logging.warning('finishing b')
+        raise ValueError('b failed')
+
+    event_a = make_event(0)
+    event_b = make_event(1)
+    batch   = more_music.FFTBatch(2,auto_flush=False)
+    batch.add(event_a,None,finish_a,name='a.json',log_path=log_a)
+    batch.add(event_b,None,finish_b,name='b.json',log_path=log_b)
+    assert batch.is_full() and len(batch) == 2
+
+    with pytest.raises(more_music.FFTBatchError) as err:
+        batch.flush()
+    assert err.value.failed == ['b.json']
+    assert len(batch) == 0
+    assert 'a' in spectra
+
+    with open(log_a) as fl:
+        assert fl.read() == 'finishing a\n'
+    with open(log_b) as fl:
+        assert fl.read() == 'finishing b\n'
+
+def test_auto_flush_on_add():
+    finished = []
+    batch   = more_music.FFTBatch(2)
+    batch.add(make_event(0),None,lambda: finished.append(0))
+    assert finished == []
+    batch.add(make_event(1),None,lambda: finished.append(1))
+    assert finished == [0,1]
+    assert len(batch) == 0
@@ -0,0 +1,121 @@
+"""
+Numerical comparison of the 'mstid' MUSIC engine (more_music.calculate_dlm(),
+calculate_karr() and detect_signals()) with pyDARNmusic on fixed inputs.
+"""
+import datetime
+
+import numpy as np
+import pytest
+
+pyDARNmusic = pytest.importorskip('pyDARNmusic')
+from pyDARNmusic.music.music_array import musicArray
+from pyDARNmusic.music.music_data_object import musicDataObj
+
+from mstid import more_music
+
+def make_spectrum_obj(nrBeams,nrGates,nrFreqs,seed=0):
+    """
+    musicArray whose active data set holds a fixed random spectrum on a
+    regular beam/gate grid with 15 km x 45 km spacing, with one plane wave
+    added so that Dlm has a clear signal eigenvalue.
+    """
+    rng     = np.random.default_rng(seed)
+    dataObj = musicArray(None)
+
+    sTime   = datetime.datetime(2017,11,3,12)
+    time    = np.array([sTime + datetime.timedelta(minutes=x) for x in range(nrFreqs)])
+    data    = np.zeros((nrFreqs,nrBeams,nrGates))
+
+    beams   = np.arange(nrBeams)
+    gates   = np.arange(nrGates)
+    rel_x, rel_y = np.meshgrid(45.*beams,15.*gates,indexing='ij')
+    fov     = {'beams':beams,'gates':gates,'relative_x':rel_x,'relative_y':rel_y}
+
+    currentData = musicDataObj(time,data,fov=fov,parent=dataObj,dataSetName='DS000_test',serial=0)
+    dataObj.DS000_test = currentData
+    currentData.setActive()
+
+    freqVec = np.linspace(-0.5,0.5,nrFreqs)
+    spect   = rng.normal(size=(nrFreqs,nrBeams,nrGates)) + 1j*rng.normal(size=(nrFreqs,nrBeams,nrGates))
+    wave    = np.exp(1j*(0.012*rel_x - 0.009*rel_y))
+    spect  += 20. * rng.normal(size=(nrFreqs,1,1)) * wave[None,:,:]
+    currentData.freqVec  = freqVec
+    currentData.spectrum = spect.astype(np.complex64)
+    return dataObj
+
+def noise_projection_karr(currentData,threshold=0.15):
+    """
+    Reference karr: 1 / |P_noise u|^2 for the steering vector u of each
+    (kx, ky), with P_noise the orthogonal projector onto the noise subspace
+    spanned by the eigenvectors numpy.linalg.eig() returns (as used by
+    pyDARNmusic.calculateKarr()).
+    """
+    eVals,eVecs = np.linalg.eig(np.transpose(currentData.Dlm))
+    noise       = eVals <= threshold*np.max(np.abs(eVals))
+    basis,_     = np.linalg.qr(eVecs[:,noise])
+
+    xm      = currentData.llLookupTable[4,:]
+    ym      = currentData.llLookupTable[3,:]
+    karr    = np.zeros((len(currentData.kxVec),len(currentData.kyVec)))
+    for ii,kx in enumerate(currentData.kxVec):
+        for jj,ky in enumerate(currentData.kyVec):
+            um  = np.exp(1j*(kx*xm + ky*ym))
+            karr[ii,jj] = 1. / np.sum(np.abs(np.dot(np.conj(basis.T),um))**2)
+    return karr
+
+def test_calculate_dlm_matches_pydarnmusic():
+    ref     = make_spectrum_obj(4,5,64)
+    new     = make_spectrum_obj(4,5,64)
+    pyDARNmusic.calculateDlm(ref)
+    more_music.calculate_dlm(new)
+
+    # pyDARNmusic accumulates Dlm in complex64, calculate_dlm() in complex128.
+    np.testing.assert_array_equal(new.active.llLookupTable,ref.active.llLookupTable)
+    np.testing.assert_allclose(new.active.Dlm,ref.active.Dlm,rtol=1e-6)
+
+def test_calculate_karr_matches_pydarnmusic_full_rank():
+    # More positive frequencies than cells: Dlm has full rank and distinct
+    # eigenvalues, so the eig() eigenvectors pyDARNmusic uses are orthonormal
+    # and both engines must agree.
+    ref     = make_spectrum_obj(4,5,64)
+    new     = make_spectrum_obj(4,5,64)
+    pyDARNmusic.calculateDlm(ref)
+    pyDARNmusic.calculateKarr(ref,kxMax=0.02,kyMax=0.02)
+    more_music.calculate_dlm(new)
+    more_music.calculate_karr(new,kxMax=0.02,kyMax=0.02)
+
+    np.testing.assert_allclose(new.active.kxVec,ref.active.kxVec)
+    np.testing.assert_allclose(new.active.kyVec,ref.active.kyVec)
+    np.testing.assert_allclose(np.abs(new.active.karr),np.abs(ref.active.karr),rtol=1e-4)
+
+def test_calculate_karr_rank_deficient():
+    # Fewer positive frequencies than cells, as in real events: the noise
+    # eigenvalues repeat and eig() returns a non-orthonormal basis for them,
+    # so pyDARNmusic's karr depends on that basis. calculate_karr() equals
+    # the karr of the orthonormalized noise subspace.
+    dataObj = make_spectrum_obj(6,8,24)
+    more_music.calculate_dlm(dataObj)
+    more_music.calculate_karr(dataObj,kxMax=0.02,kyMax=0.02)
+
+    ref     = noise_projection_karr(dataObj.active)
+    np.testing.assert_allclose(np.abs(dataObj.active.karr),ref,rtol=1e-4)
+
+def test_detect_signals_matches_pydarnmusic():
+    ref     = make_spectrum_obj(4,5,64)
+    pyDARNmusic.calculateDlm(ref)
+    pyDARNmusic.calculateKarr(ref,kxMax=0.02,kyMax=0.02)
+    new     = make_spectrum_obj(4,5,64)
+    new.active.karr     = ref.active.karr.copy()
+    new.active.kxVec    = ref.active.kxVec
+    new.active.kyVec    = ref.active.kyVec
+    for dataObj in [ref,new]:
+        dataObj.active.dominantFreq = 0.001
+
+    pyDARNmusic.detectSignals(ref,threshold=0.35,neighborhood=(10,10))
+    more_music.detect_signals(new,threshold=0.35,neighborhood=(10,10))
+
+    np.testing.assert_array_equal(new.active.sigDetect.labels,ref.active.sigDetect.labels)
+    assert len(new.active.sigDetect.info) == len(ref.active.sigDetect.info)
+    for sig_new,sig_ref in zip(new.active.sigDetect.info,ref.active.sigDetect.info):
+        for key in ['kx','ky','lambda','azm','max','area']:
+            assert sig_new[key] == pytest.approx(sig_ref[key])
@@ -0,0 +1,105 @@
+"""
+Comparison of the 'mstid' RTI engine (more_music.beam_interpolation(),
+time_interpolation() and boxcar_filter_data()) with pyDARNmusic and with a
+direct reference implementation on synthetic data with gaps.
+"""
+import datetime
+
+import numpy as np
+import pytest
+
+pyDARNmusic = pytest.importorskip('pyDARNmusic')
+from pyDARNmusic.music.music_array import musicArray
+from pyDARNmusic.music.music_data_object import musicDataObj
+
+from mstid import more_music
+
+def make_rti_obj(nrTimes=40,nrBeams=5,nrGates=12,gateLimits=(2,9),seed=0):
+    """
+    musicArray whose active data set holds random data on irregular
+    (~1 minute) times with NaN gaps: scattered missing cells, one missing
+    scan, one cell with a single valid sample and one empty cell. Beam 3
+    has a single valid gate at every time.
+    """
+    rng     = np.random.default_rng(seed)
+    dataObj = musicArray(None)
+
+    sTime   = datetime.datetime(2017,11,3,12,0,17)
+    secs    = 60.*np.arange(nrTimes) + rng.uniform(-20.,20.,nrTimes)
+    time    = np.array([sTime + datetime.timedelta(seconds=float(x)) for x in secs])
+
+    data    = rng.normal(size=(nrTimes,nrBeams,nrGates))
+    data[rng.uniform(size=data.shape) < 0.3] = np.nan
+    data[7,:,:]     = np.nan
+    data[:,1,4]     = np.nan
+    data[12,1,4]    = 3.
+    data[:,2,5]     = np.nan
+    data[:,3,:]     = np.nan
+    data[:,3,3]     = 1.
+
+    beams   = np.arange(nrBeams)
+    gates   = np.arange(nrGates)
+    ranges  = 180. + 45.*gates[None,:] + 2.*beams[:,None]
+    fov     = {'beams':beams,'gates':gates,'slantRCenter':ranges}
+
+    currentData = musicDataObj(time,data,fov=fov,parent=dataObj,dataSetName='DS000_test',serial=0)
+    if gateLimits is not None:
+        currentData.metadata['gateLimits'] = list(gateLimits)
+    dataObj.DS000_test = currentData
+    currentData.setActive()
+    return dataObj
+
+def boxcar_reference(data,min_good=5):
+    """
+    3x3x3 boxcar: the mean of the finite cells of the box around each cell,
+    cut off at the edges, or NaN with fewer than min_good finite cells.
+    """
+    nrTimes,nrBeams,nrGates = data.shape
+    filtered = np.zeros(data.shape)
+    for tt in range(nrTimes):
+        for bb in range(nrBeams):
+            for rg in range(nrGates):
+                box = data[max(tt-1,0):tt+2,max(bb-1,0):bb+2,max(rg-1,0):rg+2]
+                box = box[np.isfinite(box)]
+                if box.size < min_good:
+                    filtered[tt,bb,rg] = np.nan
+                else:
+                    filtered[tt,bb,rg] = np.mean(box)
+    return filtered
+
+@pytest.mark.parametrize('gateLimits',[(2,9),None])
+def test_beam_interpolation_matches_pydarnmusic(gateLimits):
+    ref     = make_rti_obj(gateLimits=gateLimits)
+    new     = make_rti_obj(gateLimits=gateLimits)
+    pyDARNmusic.beamInterpolation(ref)
+    more_music.beam_interpolation(new)
+
+    assert new.active.data.shape == ref.active.data.shape
+    np.testing.assert_allclose(new.active.data,ref.active.data,rtol=1e-12,atol=1e-12,equal_nan=True)
+
+def test_time_interpolation_matches_pydarnmusic():
+    ref     = make_rti_obj()
+    new     = make_rti_obj()
+    pyDARNmusic.timeInterpolation(ref,timeRes=10)
+    more_music.time_interpolation(new,timeRes=10)
+
+    np.testing.assert_array_equal(new.active.time,ref.active.time)
+    np.testing.assert_allclose(new.active.data,ref.active.data,rtol=1e-12,atol=1e-12,equal_nan=True)
+
+def test_beam_then_time_interpolation_matches_pydarnmusic():
+    ref     = make_rti_obj()
+    new     = make_rti_obj()
+    pyDARNmusic.beamInterpolation(ref)
+    pyDARNmusic.timeInterpolation(ref,timeRes=10)
+    more_music.beam_interpolation(new)
+    more_music.time_interpolation(new,timeRes=10)
+
+    np.testing.assert_array_equal(new.active.time,ref.active.time)
+    np.testing.assert_allclose(new.active.data,ref.active.data,rtol=1e-12,atol=1e-12,equal_nan=True)
+
+def test_boxcar_filter_data_matches_reference():
+    dataObj = make_rti_obj()
+    data    = dataObj.active.data.copy()
+    more_music.boxcar_filter_data(dataObj)
+
+    np.testing.assert_allclose(dataObj.active.data,boxcar_reference(data),rtol=1e-12,equal_nan=True)
@@ -55,6 +55,7 @@ from mstid.stats_support import *
 import mstid.music_support as msc
 from mstid import mongo_tools
 from mstid import more_music as mm
+from mstid import render_queue
 #HOMEPAGE Starts
 # Works
 @app.route('/')
@@ -641,6 +642,13 @@ def music_edit():
     if webData['rtiplot_yrange0'] is None: webData['rtiplot_yrange0'] = 'None'
     if webData['rtiplot_yrange0'] is None: webData['rtiplot_yrange1'] = 'None'
 
+    #Figures of events run with make_plots='deferred' are made on first view.
+    if webData['musicObjStatusClass'] == 'statusNormal' and not no_data:
+        try:
+            render_queue.ensure_event_plots(hdf5Path)
+        except:
+            pass
+
     #See if RTI Plot exists... if so, show it!
     rtiPath     = os.path.join(musicPath,'000_originalFit_RTI.png')
 